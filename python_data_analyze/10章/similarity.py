@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# 10章 ノック100の類似アンケート検索
+#
+# ノック100では all_words_df の全行について np.dot と np.linalg.norm でコサイン類似度を計算し、
+# 表全体を並べ替えて上位を見ている。
+# ここでは文書ベクトル(vectorizer.py の疎行列)を最初に1度だけ正規化しておき、
+# 上位k件の検索をブロックごとの疎行列の積と argpartition による部分ソートで行う。
+# 件数が多すぎて総当たりできない場合に備え、ランダム射影による近似検索(LSH)と、
+# 重複回答を見つけるための全ペアの類似検索も用意する。
+#
+# 使い方:
+#   from similarity import SimilarityIndex
+#   index = SimilarityIndex(X)
+#   index.query([2], k=5)                  # ノック100: 2番目のアンケートに似たもの
+#   index.near_duplicates(threshold=0.9)   # ほぼ同じ内容の回答の組
+
+import collections
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def normalize_rows(X):
+    """各行をL2ノルムで割る。単語を1つも含まない行は0のまま"""
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(X).tocsr().astype(np.float32)
+
+
+def fit_columns(X, n):
+    """語彙の大きさを n 列に揃える
+
+    索引を作った後に増えた単語の列は使わない。語彙が大きく増えたときは索引を作り直す。
+    """
+    X = normalize_rows(X)
+    if X.shape[1] < n:
+        return sparse.csr_matrix((X.data, X.indices, X.indptr), shape=(X.shape[0], n))
+    if X.shape[1] > n:
+        return X[:, :n].tocsr()
+    return X
+
+
+def _top_k(scores, k):
+    """各行の上位k件の列番号を、類似度の高い順に返す"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def _to_frame(query_ids, doc_ids, scores):
+    rows = []
+    for q, docs, sims in zip(query_ids, doc_ids, scores):
+        for rank, (doc, sim) in enumerate(zip(docs, sims)):
+            # 自分自身を除いた分、件数が足りないときの穴埋めは返さない
+            if not np.isfinite(sim):
+                continue
+            rows.append((q, int(doc), float(sim), rank))
+    return pd.DataFrame(rows, columns=["query", "doc_id", "cos_sim", "rank"])
+
+
+class SimilarityIndex(object):
+    """正規化済みの文書ベクトルに対する総当たりの類似検索"""
+
+    def __init__(self, X, block=4096):
+        self.X = normalize_rows(X)
+        self.block = block
+
+    def _queries(self, targets):
+        """文書番号のリストか、同じ語彙で作った疎行列を検索対象の行列にする"""
+        if sparse.issparse(targets):
+            return fit_columns(targets, self.X.shape[1]), None
+        ids = np.atleast_1d(np.asarray(targets, dtype=np.int64))
+        return self.X[ids], ids
+
+    def query(self, targets, k=5, exclude_self=False):
+        """targets それぞれに似ている文書を上位k件返す
+
+        ノック100と同じく、既定では検索したアンケート自身も結果に含む。
+        """
+        Q, ids = self._queries(targets)
+        n_q = Q.shape[0]
+        extra = 1 if exclude_self and ids is not None else 0
+        best_idx = np.zeros((n_q, 0), dtype=np.int64)
+        best_sim = np.zeros((n_q, 0), dtype=np.float32)
+        # 文書をブロックに分けて類似度を計算し、上位k件だけを持ち越す
+        for start in range(0, self.X.shape[0], self.block):
+            stop = min(start + self.block, self.X.shape[0])
+            scores = Q.dot(self.X[start:stop].T).toarray()
+            if extra:
+                own = (ids >= start) & (ids < stop)
+                scores[np.flatnonzero(own), ids[own] - start] = -np.inf
+            cand_sim = np.hstack([best_sim, scores])
+            cand_idx = np.hstack([best_idx, np.broadcast_to(np.arange(start, stop), scores.shape)])
+            top = _top_k(cand_sim, k)
+            best_sim = np.take_along_axis(cand_sim, top, axis=1)
+            best_idx = np.take_along_axis(cand_idx, top, axis=1)
+        query_ids = ids if ids is not None else np.arange(n_q)
+        return _to_frame(query_ids, best_idx, best_sim)
+
+    def near_duplicates(self, threshold=0.9):
+        """類似度が threshold 以上の文書の組 (doc_a < doc_b) をすべて返す"""
+        pairs = []
+        n = self.X.shape[0]
+        XT = self.X.T.tocsc()
+        for start in range(0, n, self.block):
+            stop = min(start + self.block, n)
+            scores = self.X[start:stop].dot(XT).tocoo()
+            a = scores.row + start
+            keep = (scores.data >= threshold) & (a < scores.col)
+            pairs.append(pd.DataFrame({"doc_a": a[keep], "doc_b": scores.col[keep],
+                                       "cos_sim": scores.data[keep]}))
+        if not pairs:
+            return pd.DataFrame(columns=["doc_a", "doc_b", "cos_sim"])
+        result = pd.concat(pairs, ignore_index=True)
+        return result.sort_values("cos_sim", ascending=False, kind="stable").reset_index(drop=True)
+
+
+class LSHIndex(object):
+    """ランダム射影(超平面の符号)による近似の類似検索
+
+    n_bits   : 1つのハッシュのビット数。大きいほど候補が絞られる
+    n_tables : ハッシュ表の数。多いほど取りこぼしが減る
+    候補だけを正確なコサイン類似度で並べ直して返す。
+    """
+
+    def __init__(self, X, n_bits=12, n_tables=8, seed=0):
+        self.X = normalize_rows(X)
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((n_tables, self.X.shape[1], n_bits)).astype(np.float32)
+        self.weights = (1 << np.arange(n_bits)).astype(np.int64)
+        self.tables = []
+        for t in range(n_tables):
+            table = collections.defaultdict(list)
+            for doc, key in enumerate(self._hash(self.X, t)):
+                table[key].append(doc)
+            self.tables.append(table)
+
+    def _hash(self, X, t):
+        bits = np.asarray(X.dot(self.planes[t])) > 0
+        return bits.astype(np.int64).dot(self.weights)
+
+    def add(self, X):
+        """文書を追加する(追加分の文書番号は既存の続きになる)"""
+        X = fit_columns(X, self.X.shape[1])
+        offset = self.X.shape[0]
+        for t, table in enumerate(self.tables):
+            for doc, key in enumerate(self._hash(X, t)):
+                table[key].append(offset + doc)
+        self.X = sparse.vstack([self.X, X]).tocsr()
+
+    def query(self, targets, k=5, exclude_self=False):
+        if sparse.issparse(targets):
+            Q = fit_columns(targets, self.X.shape[1])
+            query_ids = np.arange(Q.shape[0])
+            own = [None] * Q.shape[0]
+        else:
+            query_ids = np.atleast_1d(np.asarray(targets, dtype=np.int64))
+            Q = self.X[query_ids]
+            own = list(query_ids) if exclude_self else [None] * len(query_ids)
+        keys = [self._hash(Q, t) for t in range(len(self.tables))]
+        doc_ids, scores = [], []
+        for i in range(Q.shape[0]):
+            candidates = set()
+            for t, table in enumerate(self.tables):
+                candidates.update(table.get(keys[t][i], ()))
+            candidates.discard(own[i])
+            candidates = np.array(sorted(candidates), dtype=np.int64)
+            if len(candidates) == 0:
+                doc_ids.append(candidates)
+                scores.append(np.zeros(0, dtype=np.float32))
+                continue
+            sims = Q[i].dot(self.X[candidates].T).toarray()
+            top = _top_k(sims, k)[0]
+            doc_ids.append(candidates[top])
+            scores.append(sims[0, top])
+        return _to_frame(query_ids, doc_ids, scores)
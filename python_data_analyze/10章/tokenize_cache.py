@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# 10章 形態素解析の結果を1度だけ作って使い回すためのトークン表(ノック94〜99)
+#
+# ノック96〜99では、同じアンケートのコメントを毎回 tagger.parse(text).splitlines() で解析し直し、
+# 各行を空白とカンマで区切って単語と品詞を取り出している。
+# ここでは異なるコメントごとに1度だけ形態素解析し、結果を (doc_id, surface, pos) の表にまとめる。
+# 解析結果はコメントのハッシュをキーに、追加した分ごとのシャードとして保存するので、次回以降は解析し直さない。
+# 頻出単語・ストップワード・満足度・特徴量の計算は、この表に対する groupby で行う。
+#
+# 使い方:
+#   from tokenize_cache import TokenCache, count_words, words_satisfaction
+#   tokens = TokenCache("token_cache").tokenize(survey["comment"])             # 保存先のフォルダ。省くとメモリ上だけ
+#   count_words(tokens, parts=["名詞"], stop_words=["の"]).head()               # ノック96/97
+#   words_satisfaction(tokens, survey["satisfaction"], stop_words=["の"])      # ノック98
+
+import hashlib
+import multiprocessing as mp
+import os
+
+import numpy as np
+import pandas as pd
+
+TOKEN_COLUMNS = ["doc_id", "surface", "pos"]
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def parse_line(line):
+    """MeCabの出力1行を (単語, 品詞) に分ける
+
+    ipadic の「単語\\t名詞,一般,...」と、unidic の「単語\\tヨミ\\t...\\t名詞-普通名詞-一般」の両方に対応する。
+    """
+    surface, feature = line.split("\t", 1)
+    fields = feature.split("\t")
+    if "," in fields[0] or len(fields) < 4:
+        return surface, fields[0].split(",")[0]
+    return surface, fields[3].split("-")[0]
+
+
+def parse_text(tagger, text):
+    """ノック94/95と同じく、EOS と空行を除いて (単語, 品詞) のリストを返す"""
+    words = []
+    for line in tagger.parse(text).splitlines():
+        if line == "EOS" or line == "":
+            continue
+        words.append(parse_line(line))
+    return words
+
+
+# 各プロセスで1つだけ作るTagger
+_tagger = None
+
+
+def _init_worker(tagger_args):
+    global _tagger
+    import MeCab
+    _tagger = MeCab.Tagger(tagger_args)
+
+
+def _parse_item(item):
+    key, text = item
+    return key, parse_text(_tagger, text)
+
+
+class TokenCache(object):
+    """コメントのハッシュをキーに形態素解析の結果を保存しておくキャッシュ
+
+    update のたびに、新しく解析したコメントの分だけを1つのシャード(トークン表)として追加する。
+    ハッシュ → (シャード, 行の範囲) の索引で必要な行だけを取り出すので、
+    月ごとの追加にかかる時間はそれまでに解析した量によらない。
+
+    path        : 保存先のフォルダ。None(既定)ならメモリ上だけで使う
+    tagger_args : MeCab.Tagger に渡す引数(辞書の指定など)。引数ごとに別のフォルダに保存する
+    """
+
+    def __init__(self, path=None, tagger_args=""):
+        self.path = path
+        self.tagger_args = tagger_args
+        self.folder = None
+        self.shards = []
+        self.index = {}
+        if path is not None:
+            self.folder = os.path.join(path, text_hash(tagger_args)[:16])
+            names = sorted(os.listdir(self.folder)) if os.path.isdir(self.folder) else []
+            # 索引(.keys.npz)まで書き終わったシャードだけを使う
+            for name in [name for name in names if name.endswith(".keys.npz")]:
+                with np.load(os.path.join(self.folder, name)) as keys:
+                    self._add_keys(keys["hash"].tolist(), keys["start"], keys["stop"])
+                self.shards.append(None)
+
+    def _shard_path(self, number, ext):
+        return os.path.join(self.folder, "{:06d}{}".format(number, ext))
+
+    def _shard(self, number):
+        """シャードのトークン表。保存先から読むのは最初に使うときだけ"""
+        if self.shards[number] is None:
+            self.shards[number] = pd.read_pickle(self._shard_path(number, ".pkl"))
+        return self.shards[number]
+
+    def _add_keys(self, hashes, start, stop):
+        number = len(self.shards)
+        for key, a, b in zip(hashes, start.tolist(), stop.tolist()):
+            self.index[key] = (number, a, b)
+
+    def _parse_missing(self, items, workers):
+        if workers == 1 or len(items) < 2:
+            _init_worker(self.tagger_args)
+            return [_parse_item(item) for item in items]
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(self.tagger_args,)) as pool:
+            return pool.map(_parse_item, items, chunksize=max(1, len(items) // (workers * 4)))
+
+    def _missing(self, hashes, texts):
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        return missing
+
+    def _append(self, missing, workers):
+        """解析したコメントを新しいシャードにして追加し、保存先があればそのシャードだけを書き出す"""
+        if not missing:
+            return 0
+        keys, start, stop = [], [], []
+        surfaces, parts = [], []
+        for key, words in self._parse_missing(list(missing.items()), workers):
+            keys.append(key)
+            start.append(len(surfaces))
+            surfaces.extend(surface for surface, _ in words)
+            parts.extend(pos for _, pos in words)
+            stop.append(len(surfaces))
+        # 単語と品詞は種類が少ないのでカテゴリ型で持つ
+        shard = pd.DataFrame({"surface": pd.Categorical(surfaces), "pos": pd.Categorical(parts)})
+        start, stop = np.array(start, dtype=np.int64), np.array(stop, dtype=np.int64)
+        if self.folder is not None:
+            os.makedirs(self.folder, exist_ok=True)
+            number = len(self.shards)
+            path = self._shard_path(number, ".pkl")
+            shard.to_pickle(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            path = self._shard_path(number, ".keys.npz")
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, hash=np.array(keys), start=start, stop=stop)
+            os.replace(path + ".tmp", path)
+        self._add_keys(keys, start, stop)
+        self.shards.append(shard)
+        return len(missing)
+
+    def update(self, texts, workers=1):
+        """キャッシュにないコメントだけを解析して追加する。戻り値は解析したコメントの数"""
+        texts = list(texts)
+        return self._append(self._missing([text_hash(text) for text in texts], texts), workers)
+
+    def tokenize(self, texts, workers=1):
+        """コメントの列をトークン表 (doc_id, surface, pos) に変換する
+
+        doc_id はコメントの位置(survey["comment"].iloc[n] の n)。
+        """
+        texts = list(texts)
+        hashes = [text_hash(text) for text in texts]
+        self._append(self._missing(hashes, texts), workers)
+        located = np.array([self.index[key] for key in hashes], dtype=np.int64).reshape(-1, 3)
+        number, start, length = located[:, 0], located[:, 1], located[:, 2] - located[:, 1]
+        offset = np.concatenate([[0], np.cumsum(length)])
+        surface = np.empty(offset[-1], dtype=object)
+        pos = np.empty(offset[-1], dtype=object)
+        # シャードごとに、必要なコメントの行だけをまとめて取り出す
+        for shard_number in np.unique(number):
+            docs = np.flatnonzero(number == shard_number)
+            rows = _ranges(start[docs], length[docs])
+            out = _ranges(offset[docs], length[docs])
+            shard = self._shard(shard_number)
+            for values, column in ((surface, "surface"), (pos, "pos")):
+                codes = shard[column].cat.codes.to_numpy()[rows]
+                values[out] = shard[column].cat.categories.to_numpy(dtype=object)[codes]
+        return pd.DataFrame({"doc_id": np.repeat(np.arange(len(texts), dtype=np.int32), length),
+                             "surface": pd.Categorical(surface), "pos": pd.Categorical(pos)},
+                            columns=TOKEN_COLUMNS)
+
+
+def _ranges(start, length):
+    """[start[i], start[i] + length[i]) を順につないだ番号の配列"""
+    total = int(length.sum())
+    shift = np.repeat(start - np.concatenate([[0], np.cumsum(length)[:-1]]), length)
+    return shift + np.arange(total, dtype=np.int64)
+
+
+def select_words(tokens, parts=None, stop_words=None):
+    """品詞とストップワードで絞り込む(ノック95/97)"""
+    mask = np.ones(len(tokens), dtype=bool)
+    if parts is not None:
+        mask &= tokens["pos"].isin(parts).values
+    if stop_words:
+        mask &= ~tokens["surface"].isin(stop_words).values
+    return tokens.loc[mask]
+
+
+def count_words(tokens, parts=("名詞",), stop_words=None):
+    """単語ごとの出現回数を多い順に返す(ノック96/97)"""
+    words = select_words(tokens, parts, stop_words)
+    counts = words.groupby("surface", observed=True).size().rename("count")
+    return counts.sort_values(ascending=False).to_frame().rename_axis("words")
+
+
+def words_satisfaction(tokens, satisfaction, parts=("名詞",), stop_words=None, min_count=3):
+    """単語ごとの平均満足度と出現回数を返す(ノック98)
+
+    satisfaction はコメントと同じ並びの満足度。
+    """
+    words = select_words(tokens, parts, stop_words)
+    values = np.asarray(satisfaction, dtype=float)[words["doc_id"].values]
+    df = pd.DataFrame({"words": words["surface"].values, "satisfaction": values})
+    words_df = df.groupby("words", observed=True)["satisfaction"].agg(["mean", "size"])
+    words_df.columns = ["satisfaction", "count"]
+    return words_df.loc[words_df["count"] >= min_count]
+
+
+def word_features(tokens, parts=("名詞",), stop_words=None, n_docs=None):
+    """コメントごとに単語が出現したかを 0/1 で表した表を返す(ノック99)"""
+    words = select_words(tokens, parts, stop_words)
+    features = pd.crosstab(words["doc_id"].values, words["surface"].astype(object).values).clip(upper=1)
+    if n_docs is not None:
+        features = features.reindex(range(n_docs), fill_value=0)
+    return features
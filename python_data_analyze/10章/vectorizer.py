@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# 10章 ノック99の特徴量(アンケート×単語の行列)を疎行列で作る
+#
+# ノック99ではコメントごとに1行の words_df を作って単語の列を1つずつ足し、
+# pd.concat で all_words_df に積み上げてから fillna(0) している。
+# コメント数が増えると concat が2乗で遅くなり、ほとんどが0の密な表ができてしまう。
+# ここではトークン表(tokenize_cache.py)から1回の走査で CSR 形式の疎行列を作る。
+# 語彙はファイルに保存し、新しいアンケートが届いたら新出の単語だけを語彙の末尾に追加する。
+#
+# 使い方:
+#   from tokenize_cache import TokenCache
+#   from vectorizer import SurveyVectorizer
+#   tokens = TokenCache().tokenize(survey["comment"])
+#   vectorizer = SurveyVectorizer(weighting="binary", parts=["名詞"])
+#   X = vectorizer.fit_transform(tokens, n_docs=len(survey))
+#   vectorizer.save("vocabulary.json")
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from tokenize_cache import select_words
+
+WEIGHTINGS = ("binary", "count", "tf", "tfidf")
+
+
+class SurveyVectorizer(object):
+    """トークン表をアンケート×単語の疎行列に変換する
+
+    weighting : "binary"(ノック99と同じ0/1), "count"(出現回数), "tf"(出現回数/単語数), "tfidf"
+    parts     : 使う品詞。None なら全て
+    """
+
+    def __init__(self, weighting="binary", parts=("名詞",), stop_words=None):
+        if weighting not in WEIGHTINGS:
+            raise ValueError("未対応の重み付けです: " + weighting)
+        self.weighting = weighting
+        self.parts = list(parts) if parts is not None else None
+        self.stop_words = list(stop_words) if stop_words else []
+        self.vocabulary = {}
+        self.words = []
+        self.doc_freq = np.zeros(0, dtype=np.int64)
+        self.n_docs = 0
+
+    def _count_matrix(self, tokens, n_docs, grow):
+        """語彙の列番号で出現回数の疎行列を作る。grow=True なら新出の単語を語彙に追加する"""
+        words = select_words(tokens, self.parts, self.stop_words)
+        if n_docs is None:
+            n_docs = int(tokens["doc_id"].max()) + 1 if len(tokens) else 0
+        # 単語の種類ごとに1回だけ語彙を引き、各トークンへは配列の添字で割り当てる
+        codes, uniques = pd.factorize(words["surface"].astype(object))
+        columns = np.empty(len(uniques), dtype=np.int64)
+        for i, word in enumerate(uniques):
+            col = self.vocabulary.get(word)
+            if col is None:
+                if grow:
+                    col = len(self.words)
+                    self.vocabulary[word] = col
+                    self.words.append(word)
+                else:
+                    col = -1
+            columns[i] = col
+        cols = columns[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+        rows = words["doc_id"].values.astype(np.int64)
+        known = cols >= 0
+        counts = sparse.csr_matrix((np.ones(known.sum(), dtype=np.float32), (rows[known], cols[known])),
+                                   shape=(n_docs, len(self.words)))
+        counts.sum_duplicates()
+        return counts
+
+    def _update_doc_freq(self, counts):
+        doc_freq = np.zeros(len(self.words), dtype=np.int64)
+        doc_freq[:len(self.doc_freq)] = self.doc_freq
+        doc_freq += np.bincount(counts.indices, minlength=len(self.words))
+        self.doc_freq = doc_freq
+        self.n_docs += counts.shape[0]
+
+    def idf(self):
+        # 分母が0にならないよう平滑化する(scikit-learn の smooth_idf と同じ式)
+        return np.log((1 + self.n_docs) / (1 + self.doc_freq)) + 1
+
+    def _weight(self, counts):
+        X = counts.astype(np.float32)
+        if self.weighting == "binary":
+            X.data[:] = 1
+        elif self.weighting in ("tf", "tfidf"):
+            lengths = np.asarray(X.sum(axis=1)).ravel()
+            lengths[lengths == 0] = 1
+            X = sparse.diags(1 / lengths).dot(X).tocsr()
+            if self.weighting == "tfidf":
+                X = X.dot(sparse.diags(self.idf().astype(np.float32))).tocsr()
+        return X.astype(np.float32)
+
+    def partial_fit(self, tokens, n_docs=None):
+        """新しいアンケートのバッチで語彙と文書頻度を更新する(既存の列番号は変わらない)"""
+        self._update_doc_freq(self._count_matrix(tokens, n_docs, grow=True))
+        return self
+
+    def fit_transform(self, tokens, n_docs=None):
+        """語彙を更新しながら、そのバッチの疎行列を返す"""
+        counts = self._count_matrix(tokens, n_docs, grow=True)
+        self._update_doc_freq(counts)
+        return self._weight(counts)
+
+    def transform(self, tokens, n_docs=None):
+        """語彙を変えずに疎行列を作る。語彙にない単語は無視する"""
+        counts = self._count_matrix(tokens, n_docs, grow=False)
+        return self._weight(counts)
+
+    def resize(self, X):
+        """語彙が増える前に作った行列の列数を、今の語彙の大きさに揃える"""
+        X = X.tocsr()
+        return sparse.csr_matrix((X.data, X.indices, X.indptr), shape=(X.shape[0], len(self.words)))
+
+    def to_frame(self, X):
+        """ノック99の all_words_df と同じ形の DataFrame にする(小さいデータの確認用)"""
+        return pd.DataFrame.sparse.from_spmatrix(X, columns=self.words[:X.shape[1]])
+
+    def save(self, path):
+        data = {"weighting": self.weighting, "parts": self.parts, "stop_words": self.stop_words,
+                "words": self.words, "doc_freq": self.doc_freq.tolist(), "n_docs": self.n_docs}
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        vectorizer = cls(data["weighting"], data["parts"], data["stop_words"])
+        vectorizer.words = data["words"]
+        vectorizer.vocabulary = {word: i for i, word in enumerate(vectorizer.words)}
+        vectorizer.doc_freq = np.array(data["doc_freq"], dtype=np.int64)
+        vectorizer.n_docs = data["n_docs"]
+        return vectorizer
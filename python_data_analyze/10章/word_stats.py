@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# 10章 ノック98の「単語ごとの満足度」をアンケートの追加分だけで更新する
+#
+# ノック98では単語1つごとに all_words と satisfaction のリストへ追加して DataFrame にし、
+# mean() と sum() の2回の groupby を concat してから count>=3 で絞っている。
+# ここでは survey.csv をチャンクごとに読み、単語ごとの出現回数・満足度の合計・二乗和だけを持つ。
+# 毎月のアンケートが届いたら、その分だけを足し込めばいつでも順位を出せる。
+#
+# 使い方:
+#   from word_stats import WordStats
+#   stats = WordStats(stop_words=["の"])                # TokenCache("token_cache") を渡すと解析結果を保存する
+#   stats.consume_csv("survey.csv", chunksize=1000)
+#   stats.ranking(min_count=3).head()                  # 満足度の高い単語
+#   stats.ranking(min_count=3, ascending=True).head()  # 満足度の低い単語
+#   stats.save("word_stats.npz")
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from tokenize_cache import TokenCache, select_words
+
+
+def clean_comments(comment):
+    """ノック92と同じく、不要な文字と括弧書きを取り除く"""
+    comment = comment.str.replace("AA", "")
+    comment = comment.str.replace(r"\(.+?\)", "", regex=True)
+    comment = comment.str.replace(r"（.+?）", "", regex=True)
+    return comment
+
+
+class WordStats(object):
+    """単語ごとの出現回数・満足度の合計・二乗和を持ち、追加分だけで更新する
+
+    token_cache : 形態素解析に使う TokenCache。省くとメモリ上だけのキャッシュを使う(ファイルは書かない)
+    """
+
+    def __init__(self, parts=("名詞",), stop_words=None, token_cache=None):
+        self.parts = list(parts) if parts is not None else None
+        self.stop_words = list(stop_words) if stop_words else []
+        self.token_cache = token_cache
+        self.index = {}
+        self.words = []
+        self.count = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros(0, dtype=np.float64)
+        self.total_sq = np.zeros(0, dtype=np.float64)
+        self.n_docs = 0
+
+    def _grow(self, size):
+        """配列の長さが足りなければ倍々に広げる"""
+        if size <= len(self.count):
+            return
+        capacity = max(size, 2 * len(self.count), 64)
+        for name in ("count", "total", "total_sq"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def update(self, tokens, satisfaction):
+        """トークン表 (doc_id, surface, pos) と満足度の列を1バッチ分足し込む"""
+        words = select_words(tokens, self.parts, self.stop_words)
+        values = np.asarray(satisfaction, dtype=np.float64)[words["doc_id"].values]
+        codes, uniques = pd.factorize(words["surface"].astype(object))
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for i, word in enumerate(uniques):
+            idx = self.index.get(word)
+            if idx is None:
+                idx = len(self.words)
+                self.index[word] = idx
+                self.words.append(word)
+            ids[i] = idx
+        self._grow(len(self.words))
+        if len(codes):
+            word_ids = ids[codes]
+            np.add.at(self.count, word_ids, 1)
+            np.add.at(self.total, word_ids, values)
+            np.add.at(self.total_sq, word_ids, values * values)
+        self.n_docs += len(satisfaction)
+        return self
+
+    def consume(self, survey):
+        """ノック91/92の前処理をして、アンケートの DataFrame を1バッチ分足し込む"""
+        survey = survey.dropna()
+        comments = clean_comments(survey["comment"])
+        if self.token_cache is None:
+            self.token_cache = TokenCache(path=None)
+        tokens = self.token_cache.tokenize(comments)
+        return self.update(tokens, survey["satisfaction"].values)
+
+    def consume_csv(self, path, chunksize=10000):
+        """CSVをチャンクごとに読んで足し込む"""
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            self.consume(chunk)
+        return self
+
+    def frame(self):
+        """単語ごとの平均満足度・出現回数・標準偏差"""
+        n = len(self.words)
+        count = self.count[:n]
+        mean = self.total[:n] / np.maximum(count, 1)
+        var = np.maximum(self.total_sq[:n] / np.maximum(count, 1) - mean * mean, 0)
+        return pd.DataFrame({"satisfaction": mean, "count": count, "std": np.sqrt(var)},
+                            index=pd.Index(self.words, name="words"))
+
+    def ranking(self, min_count=3, ascending=False, n=None):
+        """出現回数が min_count 以上の単語を満足度順に並べる(ノック98)"""
+        words_df = self.frame()
+        words_df = words_df.loc[words_df["count"] >= min_count]
+        words_df = words_df.sort_values("satisfaction", ascending=ascending, kind="stable")
+        return words_df if n is None else words_df.head(n)
+
+    def save(self, path):
+        n = len(self.words)
+        meta = {"parts": self.parts, "stop_words": self.stop_words, "words": self.words, "n_docs": self.n_docs}
+        np.savez(path, count=self.count[:n], total=self.total[:n], total_sq=self.total_sq[:n],
+                 meta=np.array(json.dumps(meta, ensure_ascii=False)))
+
+    @classmethod
+    def load(cls, path, token_cache=None):
+        data = np.load(path)
+        meta = json.loads(str(data["meta"]))
+        stats = cls(meta["parts"], meta["stop_words"], token_cache)
+        stats.words = meta["words"]
+        stats.index = {word: i for i, word in enumerate(stats.words)}
+        stats.count = data["count"].copy()
+        stats.total = data["total"].copy()
+        stats.total_sq = data["total_sq"].copy()
+        stats.n_docs = meta["n_docs"]
+        return stats
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# 8章 口コミ・会員数シミュレーション(ノック72〜80)のストリーミング実行
+#
+# ノック72〜80では list_timeSeries に毎ステップ list_active.copy() を溜めてから
+# もう一度ループして合計を取っているため、T×N の float64 がすべてメモリに載る。
+# ここでは毎ステップの集計値(アクティブ数)だけをメモリマップファイルへ逐次書き出し、
+# 必要な場合のみ状態をビット圧縮したスナップショットとして残す。
+# チェックポイントから途中再開もできるので、ノック80の長期予測も分割して実行できる。
+#
+# 使い方:
+#   import pandas as pd
+#   from simulation import run_population, load_timeseries_num
+#   df_mem_links = pd.read_csv("links_members.csv")
+#   run_population(df_mem_links, 36, 0.0252, 0.1015, "sim/knock80", save_state=True)
+#   plt.plot(load_timeseries_num("sim/knock80"))
+
+import json
+import os
+
+import numpy as np
+
+
+def to_adjacency(df_links):
+    """links.csv / links_members.csv を 0/1 の bool 行列に変換する"""
+    values = df_links.values
+    # 1列目にノード名が入っている場合は取り除く
+    if values.shape[1] == values.shape[0] + 1:
+        values = values[:, 1:]
+    return values.astype(float) == 1
+
+
+def simulate_population_step(links, list_active, percent_percolation, percent_disapparence, rng):
+    """simulate_population と同じ手順で1ステップ進める
+
+    拡散はノード番号順に処理し、同じステップ内で新たにアクティブになったノードからも
+    拡散が起きる(元の実装と同じ挙動)。乱数は隣接ノードの分だけまとめて引く。
+    """
+    num = len(list_active)
+    # 拡散 #
+    for i in range(num):
+        if list_active[i]:
+            neighbors = np.flatnonzero(links[i])
+            hit = neighbors[rng.random(len(neighbors)) <= percent_percolation]
+            list_active[hit] = True
+    # 消滅 #
+    if percent_disapparence > 0:
+        list_active[rng.random(num) <= percent_disapparence] = False
+    return list_active
+
+
+class SimulationStream(object):
+    """シミュレーション結果(アクティブ数の時系列とスナップショット)の保存先
+
+    path を接頭辞として以下のファイルを使う。
+    - path.counts.npy : ステップごとのアクティブ数 (int32, T_NUM)
+    - path.states.npy : ステップごとの状態をビット圧縮したもの (uint8, T_NUM × ceil(N/8))
+    - path.ckpt.npy   : 最後に書き出した時点の状態(再開用)
+    - path.json       : 完了ステップ数・乱数の状態などのメタ情報
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path + ".json"
+        self.counts_path = path + ".counts.npy"
+        self.states_path = path + ".states.npy"
+        self.ckpt_path = path + ".ckpt.npy"
+
+    def exists(self):
+        return os.path.exists(self.meta_path)
+
+    def load_meta(self):
+        with open(self.meta_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def create(self, t_num, num, save_state, params):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        counts = np.lib.format.open_memmap(self.counts_path, mode="w+", dtype=np.int32, shape=(t_num,))
+        states = None
+        if save_state:
+            states = np.lib.format.open_memmap(self.states_path, mode="w+", dtype=np.uint8,
+                                               shape=(t_num, (num + 7) // 8))
+        meta = {"T_NUM": t_num, "NUM": num, "t_done": 0, "save_state": save_state, "params": params}
+        return counts, states, meta
+
+    def open(self, meta):
+        counts = np.load(self.counts_path, mmap_mode="r+")
+        states = None
+        if meta["save_state"]:
+            states = np.load(self.states_path, mmap_mode="r+")
+        return counts, states
+
+    def write_checkpoint(self, meta, list_active, rng, counts, states):
+        """集計値をディスクへ反映してから、再開用の状態とメタ情報を差し替える"""
+        counts.flush()
+        if states is not None:
+            states.flush()
+        tmp = self.ckpt_path + ".tmp.npy"
+        np.save(tmp, np.packbits(list_active))
+        os.replace(tmp, self.ckpt_path)
+        meta["rng_state"] = rng.bit_generator.state
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def read_checkpoint(self, meta):
+        packed = np.load(self.ckpt_path)
+        return np.unpackbits(packed, count=meta["NUM"]).astype(bool)
+
+    def counts(self):
+        """完了済みステップのアクティブ数(ノック73/79の時系列)"""
+        meta = self.load_meta()
+        return np.load(self.counts_path, mmap_mode="r")[:meta["t_done"]]
+
+    def state(self, t):
+        """ステップ t の状態を 0/1 配列で返す(save_state=True のときのみ)"""
+        meta = self.load_meta()
+        if not meta["save_state"]:
+            raise ValueError("状態のスナップショットは保存されていません: " + self.path)
+        if t >= meta["t_done"]:
+            raise IndexError("ステップ {} はまだ計算されていません".format(t))
+        packed = np.load(self.states_path, mmap_mode="r")[t]
+        return np.unpackbits(packed, count=meta["NUM"]).astype(float)
+
+
+def run_population(df_links, T_NUM, percent_percolation, percent_disapparence, path,
+                   list_active=None, seed=0, save_state=False, checkpoint_every=10, resume=True):
+    """会員数シミュレーション(ノック74〜80)を実行し、結果を path に逐次書き出す
+
+    resume=True で path にチェックポイントがあれば、そこから続きを計算する。
+    T_NUM を前回より大きくして呼ぶと、完了済みのステップを残したまま延長する。
+    ノック72・73の口コミ伝播は percent_disapparence=0 で同じように計算できる。
+    """
+    links = to_adjacency(df_links) if hasattr(df_links, "values") else np.asarray(df_links, dtype=bool)
+    num = len(links)
+    params = {"percent_percolation": percent_percolation,
+              "percent_disapparence": percent_disapparence, "seed": seed}
+    stream = SimulationStream(path)
+    rng = np.random.default_rng(seed)
+
+    if resume and stream.exists():
+        meta = stream.load_meta()
+        if meta["NUM"] != num or meta["params"] != params:
+            raise ValueError("チェックポイントとパラメータが一致しません: " + path)
+        counts, states = stream.open(meta)
+        if T_NUM > meta["T_NUM"]:
+            counts, states = _extend(stream, meta, counts, states, T_NUM)
+        list_active = stream.read_checkpoint(meta)
+        rng.bit_generator.state = meta["rng_state"]
+    else:
+        counts, states, meta = stream.create(T_NUM, num, save_state, params)
+        if list_active is None:
+            list_active = np.zeros(num, dtype=bool)
+            list_active[0] = True
+        else:
+            list_active = np.asarray(list_active) == 1
+
+    for t in range(meta["t_done"], T_NUM):
+        list_active = simulate_population_step(links, list_active, percent_percolation,
+                                               percent_disapparence, rng)
+        counts[t] = list_active.sum()
+        if states is not None:
+            states[t] = np.packbits(list_active)
+        meta["t_done"] = t + 1
+        if (t + 1) % checkpoint_every == 0 or t + 1 == T_NUM:
+            stream.write_checkpoint(meta, list_active, rng, counts, states)
+    return stream
+
+
+def _extend(stream, meta, counts, states, t_num):
+    """完了済みの結果を残したまま、保存領域を t_num ステップ分に広げる"""
+    counts = _grow(stream.counts_path, counts, t_num)
+    if states is not None:
+        states = _grow(stream.states_path, states, t_num)
+    meta["T_NUM"] = t_num
+    return counts, states
+
+
+def _grow(path, old, t_num, block_bytes=64 << 20):
+    """old(path のメモリマップ)を t_num 行に広げた新しいファイルを作り、path と差し替える
+
+    一時ファイルに少しずつ写してから os.replace するので、全体をメモリに載せず、
+    途中で止まっても元のファイルは壊れない。
+    """
+    tmp = path + ".tmp.npy"
+    new = np.lib.format.open_memmap(tmp, mode="w+", dtype=old.dtype, shape=(t_num,) + old.shape[1:])
+    step = max(1, block_bytes // max(1, old[:1].nbytes))
+    for i in range(0, len(old), step):
+        stop = min(i + step, len(old))
+        new[i:stop] = old[i:stop]
+    new.flush()
+    del new
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode="r+")
+
+
+def load_timeseries_num(path):
+    """ノック73/79で描く list_timeSeries_num をファイルから読み出す"""
+    return SimulationStream(path).counts()
+
+
+def active_node_coloring(path, t):
+    """ノック72の描画用に、ステップ t のアクティブノードを赤で塗り分ける"""
+    return ["r" if v == 1 else "k" for v in SimulationStream(path).state(t)]
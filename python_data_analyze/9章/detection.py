@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# 9章 画像認識(ノック84〜90)で共通して使う検出器の準備と検出処理
+
+import math
+
+import cv2
+import numpy as np
+
+# ノック84〜89と同じHOGのパラメータ
+HOG_PARAMS = {'winStride': (8, 8), 'padding': (32, 32), 'scale': 1.05, 'hitThreshold': 0, 'finalThreshold': 5}
+
+
+def create_hog():
+    """人検出用のHOGDescriptorを準備する"""
+    hog = cv2.HOGDescriptor()
+    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return hog
+
+
+def to_gray(frame, resize=1.0):
+    """グレースケール化し、resize < 1 のときは縮小する"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if resize != 1.0:
+        gray = cv2.resize(gray, None, fx=resize, fy=resize, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def detect_people(hog, gray, hog_params=None, resize=1.0):
+    """HOGで人を検出し、元画像の座標系での (x, y, w, h) の配列を返す"""
+    if hog_params is None:
+        hog_params = HOG_PARAMS
+    try:
+        human, r = hog.detectMultiScale(gray, **hog_params)
+    except cv2.error:
+        # 新しいOpenCVでは finalThreshold が groupThreshold という名前になっている
+        if 'finalThreshold' not in hog_params:
+            raise
+        hog_params = dict(hog_params)
+        hog_params['groupThreshold'] = hog_params.pop('finalThreshold')
+        human, r = hog.detectMultiScale(gray, **hog_params)
+    human = np.asarray(human, dtype=float).reshape(-1, 4)
+    if resize != 1.0:
+        human = human / resize
+    return human.astype(int)
+
+
+def draw_rectangles(img, rects, color=(255, 255, 255), pen_w=3):
+    for (x, y, w, h) in rects:
+        cv2.rectangle(img, (x, y), (x + w, y + h), color, pen_w)
+    return img
+
+
+def create_cascade(cascade_file="haarcascade_frontalface_alt.xml"):
+    """顔検出用のカスケード分類器を準備する(ノック85)"""
+    cascade = cv2.CascadeClassifier(cascade_file)
+    if cascade.empty():
+        raise IOError("カスケードファイルを読み込めません: " + cascade_file)
+    return cascade
+
+
+def detect_faces(cascade, gray, min_size=(50, 50)):
+    """カスケード分類器で顔を検出し、(x, y, w, h) の配列を返す"""
+    face_list = cascade.detectMultiScale(gray, minSize=min_size)
+    return np.asarray(face_list, dtype=int).reshape(-1, 4)
+
+
+def create_landmark(predictor_file="shape_predictor_68_face_landmarks.dat"):
+    """顔器官の検出器を準備する(ノック86)。dlibは使うときだけ読み込む"""
+    import dlib
+    predictor = dlib.shape_predictor(predictor_file)
+    detector = dlib.get_frontal_face_detector()
+    return detector, predictor
+
+
+def detect_face_direction(detector, predictor, img, num_of_points_out=17):
+    """顔を検出し、顔の輪郭と内側の器官の重心のずれから顔の向き(度)を求める
+
+    戻り値は (x, y, w, h, 角度) のリスト。角度が負なら左、正なら右を向いている。
+    """
+    results = []
+    for d in detector(img, 1):
+        shape = predictor(img, d)
+        num_of_points_in = shape.num_parts - num_of_points_out
+        points = np.array([(shape.part(i).x, shape.part(i).y) for i in range(shape.num_parts)], dtype=float)
+        gx_out = points[:num_of_points_out, 0].sum() / num_of_points_out
+        gx_in = points[num_of_points_out:, 0].sum() / num_of_points_in
+        theta = math.asin(2 * (gx_in - gx_out) / (d.right() - d.left()))
+        radian = theta * 180 / math.pi
+        results.append((d.left(), d.top(), d.right() - d.left(), d.bottom() - d.top(), radian))
+    return results
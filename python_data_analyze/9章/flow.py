@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# 9章 ノック90の移動平均を、検出しながら逐次計算する
+#
+# ノック90の moving_average(x, y) は映像をすべて処理した後に人数の列全体を畳み込んでいる。
+# ここでは検出ループから1フレームずつ人数を受け取り、リングバッファを使って
+# 移動平均・指数移動平均(EWMA)・1分ごとの集計を1フレームあたり O(1) で更新する。
+# 途中の値はいつでも参照できるので、長い映像でも2回目の集計や全フレーム分の人数の保持が要らない。
+#
+# 使い方:
+#   from flow import PeopleFlow
+#   from video_pipeline import count_people
+#   flow = PeopleFlow(window=5, max_points=3600)        # 平滑化した系列は直近3600点だけ残す
+#   count_people("mov/mov01.avi", callback=flow, keep_counts=False)
+#   ma_x, ma_y = flow.moving_average_series()
+#   plt.plot(ma_x, ma_y, label="average")
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+# 平滑化した系列を残す点数の既定値(30fpsの映像を10フレームごとに数えると約55分)
+MAX_POINTS = 10000
+
+
+class PeopleFlow(object):
+    """人数の時系列を逐次受け取り、平滑化した値を保持する
+
+    window     : 移動平均を取るフレーム数(ノック90では5)
+    alpha      : EWMA の平滑化係数
+    bucket     : 集計の単位(秒)。60なら1分ごと
+    max_points : 平滑化した系列・集計を何点まで残すか(古いものから捨てる)。
+                 None なら全て残す(映像の長さに比例してメモリを使う)
+    """
+
+    def __init__(self, window=5, alpha=0.2, bucket=60, max_points=MAX_POINTS):
+        self.window = window
+        self.alpha = alpha
+        self.bucket = bucket
+        self.ring = np.zeros(window)
+        self.times = np.zeros(window)
+        self.pos = 0
+        self.filled = 0
+        self.total = 0.0
+        self.ewma = None
+        self.count = 0
+        self.bucket_key = None
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+        self.bucket_max = 0
+        self.ma_series = collections.deque(maxlen=max_points)
+        self.ewma_series = collections.deque(maxlen=max_points)
+        self.buckets = collections.deque(maxlen=max_points)
+
+    def __call__(self, num, time, human):
+        """count_people の callback としてそのまま渡せるようにする"""
+        self.push(time, len(human))
+
+    def push(self, time, people):
+        """1フレーム分の人数を追加する"""
+        # 移動平均: 一番古い値を引いて新しい値を足す
+        self.total += people - self.ring[self.pos]
+        self.ring[self.pos] = people
+        self.times[self.pos] = time
+        self.pos = (self.pos + 1) % self.window
+        self.filled = min(self.filled + 1, self.window)
+        if self.filled == self.window:
+            # ノック90の mode='valid' と同じく、窓が埋まってから値を出す(時刻は窓の中央)
+            center = self.times[(self.pos + self.window // 2) % self.window]
+            self.ma_series.append((center, self.total / self.window))
+
+        # EWMA
+        if self.ewma is None:
+            self.ewma = float(people)
+        else:
+            self.ewma = self.alpha * people + (1 - self.alpha) * self.ewma
+        self.ewma_series.append((time, self.ewma))
+
+        # 一定時間ごとの集計
+        key = int(time // self.bucket)
+        if self.bucket_key is not None and key != self.bucket_key:
+            self._close_bucket()
+        self.bucket_key = key
+        self.bucket_sum += people
+        self.bucket_count += 1
+        self.bucket_max = max(self.bucket_max, people)
+        self.count += 1
+
+    def _close_bucket(self):
+        self.buckets.append((self.bucket_key * self.bucket, self.bucket_sum / self.bucket_count,
+                             self.bucket_max, self.bucket_count))
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+        self.bucket_max = 0
+
+    @property
+    def moving_average(self):
+        """現在の移動平均(窓が埋まるまでは埋まった分の平均)"""
+        if self.filled == 0:
+            return None
+        if self.filled < self.window:
+            return self.ring[:self.filled].mean()
+        return self.total / self.window
+
+    def moving_average_series(self):
+        """ノック90の moving_average と同じ形 (x, y) で平滑化した系列を返す"""
+        if not self.ma_series:
+            return np.array([]), np.array([])
+        x, y = zip(*self.ma_series)
+        return np.array(x), np.array(y)
+
+    def ewma_series_xy(self):
+        if not self.ewma_series:
+            return np.array([]), np.array([])
+        x, y = zip(*self.ewma_series)
+        return np.array(x), np.array(y)
+
+    def bucket_frame(self):
+        """一定時間ごとの平均・最大人数を DataFrame で返す(集計中の区間も含む)"""
+        rows = list(self.buckets)
+        if self.bucket_count > 0:
+            rows.append((self.bucket_key * self.bucket, self.bucket_sum / self.bucket_count,
+                         self.bucket_max, self.bucket_count))
+        return pd.DataFrame(rows, columns=["time", "mean", "max", "frames"])
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# 9章 ノック88/89で動きのあるフレーム・領域だけHOG検出するための判定
+#
+# 街頭の映像は人の出入りがなければほとんど変化しないが、ノック88/89では
+# 全フレームに対して画面全体・複数スケールのHOG検出を行っている。
+# ここではフレーム差分または背景差分で先に動きを調べ、動きがなければ前回の人数をそのまま使う。
+# regions=True にすると、動きのあった範囲だけを切り出して検出する。
+#
+# 使い方:
+#   from motion import MotionGate
+#   from video_pipeline import count_people, motion_report
+#   list_df, stats = count_people("mov/mov01.avi", gate=MotionGate(method="diff"))
+#   report, summary = motion_report("mov/mov01.avi", method="mog2", regions=True)
+
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    """前のフレームからの動きを調べ、検出が必要かどうかと検出する範囲を返す
+
+    method    : "diff"(前フレームとの差分) か "mog2"(背景差分)
+    threshold : 差分を動きとみなす輝度差(diff のみ)
+    min_area  : 動きとみなす領域の最小面積(検出に使う画像上のピクセル数)
+    roi       : 動きを見る範囲。0/1のマスク画像、または元画像の座標での多角形のリスト
+    regions   : True なら動きのあった範囲だけを検出する
+    margin    : 切り出す範囲の余白(検出に使う画像上のピクセル数)
+    """
+
+    # HOGの検出窓(64×128)より小さい範囲は切り出しても検出できない
+    MIN_WIDTH = 64
+    MIN_HEIGHT = 128
+
+    def __init__(self, method="diff", threshold=25, min_area=200, roi=None, regions=False, margin=32,
+                 history=100):
+        if method not in ("diff", "mog2"):
+            raise ValueError("未対応の方法です: " + method)
+        self.method = method
+        self.history = history
+        self.threshold = threshold
+        self.min_area = min_area
+        self.roi = roi
+        self.regions = regions
+        self.margin = margin
+        self.scale = 1.0
+        self.prev = None
+        self.mask = None
+        self.subtractor = None
+        if method == "mog2":
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=history, detectShadows=True)
+
+    def scaled(self, scale):
+        """同じ設定で、縮小率 scale の画像を受け取る新しい MotionGate(前のフレームなどの状態は持たない)"""
+        gate = MotionGate(self.method, self.threshold, self.min_area, self.roi, self.regions, self.margin,
+                          self.history)
+        gate.scale = scale
+        return gate
+
+    def _build_mask(self, shape):
+        height, width = shape[:2]
+        if self.roi is None:
+            return None
+        if isinstance(self.roi, np.ndarray):
+            mask = cv2.resize(self.roi.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
+            return (mask > 0).astype(np.uint8) * 255
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for polygon in self.roi:
+            points = np.round(np.asarray(polygon, dtype=float) * self.scale).astype(np.int32)
+            cv2.fillPoly(mask, [points], 255)
+        return mask
+
+    def update(self, gray):
+        """フレームを1枚進め、(動きがあるか, 検出範囲) を返す
+
+        検出範囲は (x, y, w, h)。画面全体を検出するときは None。
+        """
+        if self.prev is None and self.mask is None:
+            self.mask = self._build_mask(gray.shape)
+        if self.method == "mog2":
+            fg = self.subtractor.apply(gray)
+            # 影(127)は動きとみなさない
+            moving = (fg > 200).astype(np.uint8) * 255
+        else:
+            if self.prev is None:
+                self.prev = gray
+                return True, None
+            diff = cv2.absdiff(self.prev, gray)
+            diff = cv2.GaussianBlur(diff, (5, 5), 0)
+            moving = (diff > self.threshold).astype(np.uint8) * 255
+        first = self.prev is None
+        self.prev = gray
+        if first:
+            return True, None
+        if self.mask is not None:
+            moving = cv2.bitwise_and(moving, self.mask)
+        moving = cv2.dilate(moving, None, iterations=2)
+        contours, _ = cv2.findContours(moving, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) >= self.min_area]
+        if not boxes:
+            return False, None
+        if not self.regions:
+            return True, None
+        return True, self._union(boxes, gray.shape)
+
+    def _union(self, boxes, shape):
+        height, width = shape[:2]
+        boxes = np.array(boxes)
+        x0 = boxes[:, 0].min() - self.margin
+        y0 = boxes[:, 1].min() - self.margin
+        x1 = (boxes[:, 0] + boxes[:, 2]).max() + self.margin
+        y1 = (boxes[:, 1] + boxes[:, 3]).max() + self.margin
+        # 検出窓より小さくならないように広げる
+        if x1 - x0 < self.MIN_WIDTH:
+            x0 -= (self.MIN_WIDTH - (x1 - x0)) // 2 + 1
+            x1 = x0 + self.MIN_WIDTH
+        if y1 - y0 < self.MIN_HEIGHT:
+            y0 -= (self.MIN_HEIGHT - (y1 - y0)) // 2 + 1
+            y1 = y0 + self.MIN_HEIGHT
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1, y1 = min(width, int(x1)), min(height, int(y1))
+        if (x1 - x0) * (y1 - y0) >= 0.8 * width * height:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def in_roi(self, rects):
+        """検出枠のうち、中心が ROI の中にあるものだけを返す(元画像の座標)"""
+        if self.mask is None or len(rects) == 0:
+            return rects
+        cx = ((rects[:, 0] + rects[:, 2] / 2) * self.scale).astype(int)
+        cy = ((rects[:, 1] + rects[:, 3] / 2) * self.scale).astype(int)
+        height, width = self.mask.shape
+        cx = np.clip(cx, 0, width - 1)
+        cy = np.clip(cy, 0, height - 1)
+        return rects[self.mask[cy, cx] > 0]
+
+
+def outside(rects, region):
+    """検出枠のうち、中心が region (x, y, w, h) の外にあるものを返す"""
+    if len(rects) == 0:
+        return rects
+    x, y, w, h = region
+    cx = rects[:, 0] + rects[:, 2] / 2
+    cy = rects[:, 1] + rects[:, 3] / 2
+    inside = (cx >= x) & (cx < x + w) & (cy >= y) & (cy < y + h)
+    return rects[~inside]
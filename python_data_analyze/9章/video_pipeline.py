@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# 9章 ノック87〜89の人数カウントを複数プロセスで行うパイプライン
+#
+# ノック87〜89では1つのループの中でフレームの読み込み・HOG検出・書き出しを順番に行うため、
+# ボトルネックのHOG検出が1コアしか使えない。
+# ここでは「読み込み → 検出(複数プロセス) → 書き出し」の3段に分け、間を上限付きのキューでつなぐ。
+# 検出プロセスはそれぞれ自分のHOGDescriptorを持ち、書き出しはフレーム番号順に並べ直して行う。
+#
+# 使い方:
+#   from video_pipeline import count_people
+#   list_df, stats = count_people("mov/mov01.avi", workers=4, every=10, resize=0.5)
+#   plt.plot(list_df["time"], list_df["people"])
+#
+# gate に motion.MotionGate を渡すと、動きのないフレームは検出せずに前回の人数を使う。
+
+import heapq
+import multiprocessing as mp
+import os
+import threading
+import time
+import traceback
+
+import cv2
+import pandas as pd
+
+import numpy as np
+
+from detection import HOG_PARAMS, create_hog, detect_people, draw_rectangles, to_gray
+from motion import MotionGate, outside
+
+
+class StageStats(object):
+    """パイプラインの各段の処理枚数と処理時間"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, frames=1):
+        self.frames += frames
+        self.seconds += seconds
+
+    def fps(self):
+        return self.frames / self.seconds if self.seconds > 0 else float("inf")
+
+    def as_dict(self):
+        return {"stage": self.name, "frames": self.frames, "seconds": self.seconds, "fps": self.fps()}
+
+
+def _detect_worker(in_q, out_q, resize, hog_params, abort):
+    # 検出プロセス同士でコアを取り合わないよう、OpenCV内部のスレッドは使わない
+    cv2.setNumThreads(1)
+    try:
+        hog = create_hog()
+        while True:
+            item = in_q.get()
+            if item is None:
+                break
+            num, gray, region = item
+            if gray is None or abort.is_set():
+                # 動きがないので前回の結果を使う
+                out_q.put((num, None, 0.0, None))
+                continue
+            start = time.perf_counter()
+            human = detect_people(hog, gray, hog_params)
+            if region is not None:
+                human = human + [region[0], region[1], 0, 0]
+                region = tuple(int(v / resize) for v in region)
+            if resize != 1.0:
+                human = (human / resize).astype(int)
+            out_q.put((num, human, time.perf_counter() - start, region))
+    except Exception:
+        # 例外は親プロセスに渡して、パイプライン全体を止める
+        out_q.put(("error", traceback.format_exc(), 0.0, None))
+        # 残りのフレームを読み捨てて、読み込み側が止まらないようにする
+        while in_q.get() is not None:
+            pass
+    out_q.put(None)
+
+
+def _decode(cap, every, resize, gate, in_q, frames, slots, stop, stats, workers, errors):
+    num = 0
+    try:
+        while cap.isOpened() and not stop.is_set():
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if num % every == 0:
+                gray = to_gray(frame, resize)
+                region = None
+                if gate is not None:
+                    moved, region = gate.update(gray)
+                    if not moved:
+                        gray = None
+                    elif region is not None:
+                        x, y, w, h = region
+                        gray = gray[y:y + h, x:x + w]
+                stats.add(time.perf_counter() - start)
+                # 処理中のフレーム数が上限に達したら書き出しが追いつくまで待つ
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if frames is not None:
+                    frames[num] = frame
+                in_q.put((num, gray, region))
+            else:
+                stats.add(time.perf_counter() - start, frames=0)
+            num += 1
+    except Exception:
+        # 読み込み・gate の例外は検出プロセスの例外と同じく count_people で投げ直す
+        errors.append(("読み込み", traceback.format_exc()))
+        stop.set()
+    finally:
+        for _ in range(workers):
+            in_q.put(None)
+
+
+def count_people(movie, workers=None, every=10, resize=1.0, queue_size=32, output=None,
+                 hog_params=None, callback=None, gate=None, keep_counts=True):
+    """映像内の人数をフレームごとに数え、ノック88の list_df と各段の処理速度を返す
+
+    every    : 何フレームごとに検出するか(ノック88/89では10)
+    resize   : 検出前の縮小率。0.5なら縦横半分で検出し、座標は元の大きさに戻す
+    output   : 指定すると検出枠を描いたフレームを動画として書き出す(ノック87のタイムラプス)
+    callback : callback(num, time, human) をフレーム番号順に呼び出す
+    gate     : motion.MotionGate。動きのないフレームは検出せず前回の結果を使う
+    keep_counts : False にすると list_df を作らない(flow.PeopleFlow などの callback だけで集計するとき)
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) - 1)
+    if hog_params is None:
+        hog_params = HOG_PARAMS
+    if gate is not None:
+        # 呼び出し側の gate は書き換えず、縮小率に合わせた新しい gate を使う
+        gate = gate.scaled(resize)
+
+    cap = cv2.VideoCapture(movie)
+    if not cap.isOpened():
+        raise IOError("映像を開けません: " + movie)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video = None
+    if output is not None:
+        fourcc = cv2.VideoWriter_fourcc('X', 'V', 'I', 'D')
+        video = cv2.VideoWriter(output, fourcc, 30, (width, height))
+
+    ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+    in_q = ctx.Queue(maxsize=queue_size)
+    out_q = ctx.Queue()
+    slots = threading.Semaphore(queue_size)
+    stop = threading.Event()
+    abort = ctx.Event()
+    frames = {} if video is not None else None
+    stats = {"decode": StageStats("decode"), "detect": StageStats("detect"), "write": StageStats("write")}
+
+    procs = [ctx.Process(target=_detect_worker, args=(in_q, out_q, resize, hog_params, abort), daemon=True)
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+
+    wall_start = time.perf_counter()
+    errors = []
+    decoder = threading.Thread(target=_decode,
+                               args=(cap, every, resize, gate, in_q, frames, slots, stop, stats["decode"], workers,
+                                     errors))
+    decoder.start()
+
+    records = []
+    pending = []
+    next_num = 0
+    finished = 0
+    last_human = np.zeros((0, 4), dtype=int)
+    last_time = None
+    completed = False
+
+    def emit(num, human, region):
+        nonlocal last_human, last_time
+        start = time.perf_counter()
+        if human is None:
+            human = last_human
+        elif region is not None:
+            # 切り出した範囲の外は前回の検出結果を残す
+            human = np.vstack([outside(last_human, region), human])
+        if gate is not None:
+            human = gate.in_roi(human)
+        last_human = human
+        last_time = num / fps
+        if keep_counts:
+            records.append((num / fps, len(human)))
+        if callback is not None:
+            callback(num, num / fps, human)
+        if video is not None:
+            video.write(draw_rectangles(frames.pop(num), human))
+        slots.release()
+        stats["write"].add(time.perf_counter() - start)
+
+    try:
+        while finished < workers:
+            item = out_q.get()
+            if item is None:
+                finished += 1
+                continue
+            num, human, seconds, region = item
+            if num == "error":
+                errors.append(("検出プロセス", human))
+                stop.set()
+                continue
+            if human is not None:
+                stats["detect"].add(seconds)
+            heapq.heappush(pending, (num, human, region))
+            # フレーム番号順に揃ったものから書き出す
+            while not errors and pending and pending[0][0] == next_num:
+                emit(*heapq.heappop(pending))
+                next_num += every
+        while not errors and pending:
+            emit(*heapq.heappop(pending))
+        completed = True
+    finally:
+        stop.set()
+        decoder.join()
+        if not completed:
+            # callback などが例外を投げたときは、残りのフレームを検出せずに返させて読み捨てる。
+            # 読まずに join すると、検出プロセスが out_q に書き終わらず止まったままになる
+            abort.set()
+            while finished < workers:
+                if out_q.get() is None:
+                    finished += 1
+        for p in procs:
+            p.join()
+        cap.release()
+        if video is not None:
+            video.release()
+    if errors:
+        raise RuntimeError("{}でエラーが発生しました\n{}".format(*errors[0]))
+    wall = time.perf_counter() - wall_start
+
+    list_df = pd.DataFrame(records, columns=['time', 'people'])
+    stats_df = pd.DataFrame([s.as_dict() for s in stats.values()])
+    # 検出は複数プロセスで並列に動くので、実効的な処理速度はプロセス数倍になる
+    stats_df.loc[stats_df["stage"] == "detect", "fps"] *= workers
+    video_seconds = last_time + every / fps if last_time is not None else 0.0
+    stats_df.attrs["wall_seconds"] = wall
+    stats_df.attrs["realtime_ratio"] = video_seconds / wall if wall > 0 else float("inf")
+    stats_df.attrs["detected_frames"] = stats["detect"].frames
+    return list_df, stats_df
+
+
+def motion_report(movie, every=10, resize=1.0, workers=None, **gate_kwargs):
+    """動きによる検出の省略が、毎フレーム検出した場合と比べてどれだけ速く・どれだけずれるかを調べる
+
+    戻り値は (フレームごとの人数の比較, まとめ)。gate_kwargs は MotionGate に渡す。
+    """
+    full_df, full_stats = count_people(movie, workers=workers, every=every, resize=resize)
+    gated_df, gated_stats = count_people(movie, workers=workers, every=every, resize=resize,
+                                         gate=MotionGate(**gate_kwargs))
+    report = pd.DataFrame({"time": full_df["time"], "people_full": full_df["people"],
+                           "people_gated": gated_df["people"]})
+    report["error"] = report["people_gated"] - report["people_full"]
+    full_wall = full_stats.attrs["wall_seconds"]
+    gated_wall = gated_stats.attrs["wall_seconds"]
+    summary = {
+        "frames": len(report),
+        "detected_frames": gated_stats.attrs["detected_frames"],
+        "detected_ratio": gated_stats.attrs["detected_frames"] / max(1, len(report)),
+        "mae": float(report["error"].abs().mean()) if len(report) else 0.0,
+        "max_error": int(report["error"].abs().max()) if len(report) else 0,
+        "exact_ratio": float((report["error"] == 0).mean()) if len(report) else 1.0,
+        "wall_seconds_full": full_wall,
+        "wall_seconds_gated": gated_wall,
+        "speedup": full_wall / gated_wall if gated_wall > 0 else float("inf"),
+    }
+    return report, summary
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+# 重いノックを本のコードのまま測るためのベンチマーク定義
+#
+# 各ベンチマークは「データの読み込みなどの準備」と「測る処理」を分けて書く。
+# 準備の関数は章のフォルダ(synthetic/x10/3章 など)を受け取り、測る処理を引数なしの関数として返す。
+# 測る処理は何度呼んでも同じ結果になるように、準備で読んだ表をコピーしてから使う。
+#
+# 本のコードから変えたのは、今の環境で動かすために避けられない所だけ:
+# - pandas 3 では Series[整数] が位置指定にならないため、df.iloc[i][j] は df.iloc[i].iloc[j] にする
+# - DataFrame.append は無くなったので pd.concat にする
+# - pandas 3 の Copy-on-Write では customer_join["membership_period"].iloc[i] = ... や data["period"][i] = ... の
+#   連鎖代入は元の表に書き込まれない(警告も _quiet で隠れる)ので、.loc[i, 列名] = ... にして実際に書き込む
+# - 画面のない環境で測るため、cv2.waitKey / cv2.destroyAllWindows は呼ばない
+# - ノック43の sample(frac=1) は実行ごとに結果が変わらないよう random_state を固定する
+#
+# ノック89はノック88と同じループを別の映像(mov02.avi)で、ノック97はノック96のループに
+# ストップワードの判定を足したものを測る。
+# 使い方は runner.py を参照。
+
+import collections
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Skip(Exception):
+    """この環境・規模では測れないときに準備の関数から投げる"""
+
+
+Benchmark = collections.namedtuple("Benchmark", ["name", "chapter", "setup", "prepare", "description"])
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, chapter, description, prepare=None):
+    """準備の関数をベンチマークとして登録する
+
+    prepare : データを作る関数 (root, scale, seed)。None なら common.synthetic で章のデータを作る
+    """
+    def decorate(setup):
+        BENCHMARKS[name] = Benchmark(name, chapter, setup, prepare, description)
+        return setup
+    return decorate
+
+
+def _read(data_dir, filename, **kwargs):
+    path = os.path.join(data_dir, filename)
+    if not os.path.exists(path):
+        raise Skip(filename + " がありません")
+    return pd.read_csv(path, **kwargs)
+
+
+def _quiet(run):
+    """本のノートブックと同じく警告を表示しないで実行する"""
+    def wrapped():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return run()
+    return wrapped
+
+
+# --------------------------------------------------------------------------------------
+# 3〜5章 relativedelta のループと、月ごとの結合のループ
+# --------------------------------------------------------------------------------------
+
+@benchmark("knock28", 3, "会員期間を relativedelta で1行ずつ計算する")
+def knock28(data_dir):
+    customer = _read(data_dir, "customer_master.csv")
+    customer["start_date"] = pd.to_datetime(customer["start_date"])
+    customer["end_date"] = pd.to_datetime(customer["end_date"])
+
+    def run():
+        from dateutil.relativedelta import relativedelta
+        customer_join = customer.copy()
+        customer_join["calc_date"] = customer_join["end_date"]
+        customer_join["calc_date"] = customer_join["calc_date"].fillna(pd.to_datetime("20190430"))
+        customer_join["membership_period"] = 0
+        for i in range(len(customer_join)):
+            delta = relativedelta(customer_join["calc_date"].iloc[i], customer_join["start_date"].iloc[i])
+            customer_join.loc[i, "membership_period"] = delta.years*12 + delta.months
+        return int(customer_join["membership_period"].sum())
+    return _quiet(run)
+
+
+def _uselog_months(uselog):
+    """ノック36の前半: 年月・顧客ごとの利用回数"""
+    uselog["usedate"] = pd.to_datetime(uselog["usedate"])
+    uselog["年月"] = uselog["usedate"].dt.strftime("%Y%m")
+    uselog_months = uselog.groupby(["年月","customer_id"],as_index=False).count()
+    uselog_months.rename(columns={"log_id":"count"}, inplace=True)
+    del uselog_months["usedate"]
+    return uselog_months
+
+
+def _lag6(uselog_months):
+    """ノック36の後半: 過去6か月分の利用回数を1か月ずつ結合する"""
+    year_months = list(uselog_months["年月"].unique())
+    predict_data = pd.DataFrame()
+    for i in range(6, len(year_months)):
+        tmp = uselog_months.loc[uselog_months["年月"]==year_months[i]]
+        tmp.rename(columns={"count":"count_pred"}, inplace=True)
+        for j in range(1, 7):
+            tmp_before = uselog_months.loc[uselog_months["年月"]==year_months[i-j]]
+            del tmp_before["年月"]
+            tmp_before.rename(columns={"count":"count_{}".format(j-1)}, inplace=True)
+            tmp = pd.merge(tmp, tmp_before, on="customer_id", how="left")
+        predict_data = pd.concat([predict_data, tmp], ignore_index=True)
+    return predict_data
+
+
+@benchmark("knock36", 4, "過去6か月の利用回数を月ごとに merge して積み上げる")
+def knock36(data_dir):
+    uselog = _read(data_dir, "use_log.csv")
+
+    def run():
+        uselog_months = _uselog_months(uselog.copy())
+        return len(_lag6(uselog_months))
+    return _quiet(run)
+
+
+@benchmark("knock37", 4, "予測月の在籍期間を relativedelta で1行ずつ計算する")
+def knock37(data_dir):
+    customer = _read(data_dir, "customer_join.csv")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        predict_data = _lag6(_uselog_months(_read(data_dir, "use_log.csv")))
+    predict_data = predict_data.dropna()
+    predict_data = predict_data.reset_index(drop=True)
+    predict_data = pd.merge(predict_data, customer[["customer_id","start_date"]], on="customer_id", how="left")
+
+    def run():
+        from dateutil.relativedelta import relativedelta
+        data = predict_data.copy()
+        data["now_date"] = pd.to_datetime(data["年月"], format="%Y%m")
+        data["start_date"] = pd.to_datetime(data["start_date"])
+        data["period"] = None
+        for i in range(len(data)):
+            delta = relativedelta(data["now_date"][i], data["start_date"][i])
+            data.loc[i, "period"] = delta.years*12 + delta.months
+        return int(data["period"].sum())
+    return _quiet(run)
+
+
+def _lag1(uselog_months):
+    """ノック41: 当月と前月の利用回数を月ごとに merge して積み上げる"""
+    year_months = list(uselog_months["年月"].unique())
+    uselog = pd.DataFrame()
+    for i in range(1, len(year_months)):
+        tmp = uselog_months.loc[uselog_months["年月"]==year_months[i]]
+        tmp.rename(columns={"count":"count_0"}, inplace=True)
+        tmp_before = uselog_months.loc[uselog_months["年月"]==year_months[i-1]]
+        del tmp_before["年月"]
+        tmp_before.rename(columns={"count":"count_1"}, inplace=True)
+        tmp = pd.merge(tmp, tmp_before, on="customer_id", how="left")
+        uselog = pd.concat([uselog, tmp], ignore_index=True)
+    return uselog
+
+
+@benchmark("knock41", 5, "当月と前月の利用回数を月ごとに merge して積み上げる")
+def knock41(data_dir):
+    uselog_months = _read(data_dir, "use_log_months.csv")
+
+    def run():
+        return len(_lag1(uselog_months.copy()))
+    return _quiet(run)
+
+
+@benchmark("knock44", 5, "退会予測用データの在籍期間を relativedelta で1行ずつ計算する")
+def knock44(data_dir):
+    from dateutil.relativedelta import relativedelta
+    customer = _read(data_dir, "customer_join.csv")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        uselog = _lag1(_read(data_dir, "use_log_months.csv"))
+        # ノック42/43
+        exit_customer = customer.loc[customer["is_deleted"]==1]
+        exit_customer["exit_date"] = None
+        exit_customer["end_date"] = pd.to_datetime(exit_customer["end_date"])
+        exit_customer["exit_date"] = [d - relativedelta(months=1) for d in exit_customer["end_date"]]
+        exit_customer["年月"] = pd.to_datetime(exit_customer["exit_date"]).dt.strftime("%Y%m")
+        uselog["年月"] = uselog["年月"].astype(str)
+        exit_uselog = pd.merge(uselog, exit_customer, on=["customer_id", "年月"], how="left")
+        exit_uselog = exit_uselog.dropna(subset=["name"])
+        conti_customer = customer.loc[customer["is_deleted"]==0]
+        conti_uselog = pd.merge(uselog, conti_customer, on=["customer_id"], how="left")
+        conti_uselog = conti_uselog.dropna(subset=["name"])
+        conti_uselog = conti_uselog.sample(frac=1, random_state=0).reset_index(drop=True)
+        conti_uselog = conti_uselog.drop_duplicates(subset="customer_id")
+        predict_data = pd.concat([conti_uselog, exit_uselog],ignore_index=True)
+
+    def run():
+        data = predict_data.copy()
+        data["period"] = 0
+        data["now_date"] = pd.to_datetime(data["年月"], format="%Y%m")
+        data["start_date"] = pd.to_datetime(data["start_date"])
+        for i in range(len(data)):
+            delta = relativedelta(data["now_date"][i], data["start_date"][i])
+            data.loc[i, "period"] = int(delta.years*12 + delta.months)
+        return int(data["period"].sum())
+    return _quiet(run)
+
+
+# --------------------------------------------------------------------------------------
+# 6章 輸送コスト
+# --------------------------------------------------------------------------------------
+
+@benchmark("knock58", 6, "輸送ルートとコストの積を iloc の2重ループで合計する")
+def knock58(data_dir):
+    df_tr = _read(data_dir, "trans_route.csv", index_col="工場")
+    df_tc = _read(data_dir, "trans_cost.csv", index_col="工場")
+
+    def trans_cost(df_tr,df_tc):
+        cost = 0
+        for i in range(len(df_tc.index)):
+            for j in range(len(df_tr.columns)):
+                cost += df_tr.iloc[i].iloc[j]*df_tc.iloc[i].iloc[j]
+        return cost
+
+    def run():
+        return trans_cost(df_tr, df_tc)
+    return run
+
+
+# --------------------------------------------------------------------------------------
+# 8章 口コミのシミュレーション
+# --------------------------------------------------------------------------------------
+
+# 本では T_NUM=100, 相図は20×20。simulate_population は会員番号順に口コミを広げるので、
+# 1ステップ目でほぼ全員に広がり、1ステップに「会員数の2乗」回の iloc がかかる(540人で数分)。
+# そのため1ステップだけを測る
+SIMULATION_T_NUM = 1
+PHASE_DIAGRAM_NUM = 2
+PHASE_DIAGRAM_T_NUM = 1
+
+
+def _simulate_population():
+    """ノック72〜74の determine_link と simulate_population"""
+    def determine_link(percent):
+        rand_val = np.random.rand()
+        if rand_val<=percent:
+            return 1
+        else:
+            return 0
+
+    def simulate_population(num, list_active, percent_percolation, percent_disapparence,df_links):
+        # 拡散 #
+        for i in range(num):
+            if list_active[i]==1:
+                for j in range(num):
+                    if df_links.iloc[i].iloc[j]==1:
+                        if determine_link(percent_percolation)==1:
+                            list_active[j] = 1
+        # 消滅 #
+        for i in range(num):
+            if determine_link(percent_disapparence)==1:
+                list_active[i] = 0
+        return list_active
+    return simulate_population
+
+
+def _links(data_dir):
+    if not os.path.exists(os.path.join(data_dir, "links_members.csv")):
+        raise Skip("会員数が多く隣接行列が作られていません(links_members_edges.csv のみ)")
+    return _read(data_dir, "links_members.csv", index_col=0)
+
+
+@benchmark("knock74", 8, "会員数の時系列をシミュレーションする(T_NUM={})".format(SIMULATION_T_NUM))
+def knock74(data_dir):
+    df_links = _links(data_dir)
+    simulate_population = _simulate_population()
+
+    def run():
+        np.random.seed(0)
+        percent_percolation = 0.1
+        percent_disapparence = 0.05
+        T_NUM = SIMULATION_T_NUM
+        NUM = len(df_links.index)
+        list_active = np.zeros(NUM)
+        list_active[0] = 1
+        list_timeSeries = []
+        for t in range(T_NUM):
+            list_active = simulate_population(NUM, list_active, percent_percolation, percent_disapparence,df_links)
+            list_timeSeries.append(list_active.copy())
+        return sum(list_timeSeries[-1])
+    return run
+
+
+@benchmark("knock75", 8, "相図を計算する({0}×{0}, T_NUM={1})".format(PHASE_DIAGRAM_NUM, PHASE_DIAGRAM_T_NUM))
+def knock75(data_dir):
+    df_links = _links(data_dir)
+    simulate_population = _simulate_population()
+
+    def run():
+        np.random.seed(0)
+        T_NUM = PHASE_DIAGRAM_T_NUM
+        NUM = len(df_links.index)
+        NUM_PhaseDiagram = PHASE_DIAGRAM_NUM
+        phaseDiagram = np.zeros((NUM_PhaseDiagram,NUM_PhaseDiagram))
+        for i_p in range(NUM_PhaseDiagram):
+            for i_d in range(NUM_PhaseDiagram):
+                # 本の 0.05 刻みでは2×2がほぼ全て0%になるので、範囲全体を粗く刻む
+                percent_percolation = 0.5*i_p
+                percent_disapparence = 0.5*i_d
+                list_active = np.zeros(NUM)
+                list_active[0] = 1
+                for t in range(T_NUM):
+                    list_active = simulate_population(NUM, list_active, percent_percolation, percent_disapparence,df_links)
+                phaseDiagram[i_p][i_d] = sum(list_active)
+        return phaseDiagram.sum()
+    return run
+
+
+# --------------------------------------------------------------------------------------
+# 9章 映像からの人数の検出
+# --------------------------------------------------------------------------------------
+
+# scale=1 で5秒(HOGの検出15回分)の映像を作る
+VIDEO_FRAMES = 150
+VIDEO_FPS = 30
+
+
+def make_video(root, scale, seed=0):
+    """9章の画像(img01/img02)を少しずつずらしたフレームで、ノック88・89用の映像を作る
+
+    同梱されていない mov/mov01.avi・mov02.avi の代わり。フレーム数を scale 倍にする。
+    mov02.avi は乱数の種と場面の順番を変える。
+    """
+    import cv2
+    out = os.path.join(root, "9章", "mov")
+    images = [cv2.imread(os.path.join(BASE_DIR, "9章", "img", name)) for name in ("img01.jpg", "img02.jpg")]
+    height, width = images[0].shape[:2]
+    images = [cv2.resize(img, (width, height)) for img in images]
+    for number, order in ((1, images), (2, images[::-1])):
+        path = os.path.join(out, "mov{:02d}.avi".format(number))
+        if os.path.exists(path):
+            continue
+        os.makedirs(out, exist_ok=True)
+        rng = np.random.default_rng(seed + number - 1)
+        tmp = os.path.join(out, "tmp.avi")
+        writer = cv2.VideoWriter(tmp, cv2.VideoWriter_fourcc(*"MJPG"), VIDEO_FPS, (width, height))
+        shift = 0
+        for num in range(int(VIDEO_FRAMES * scale)):
+            # 数秒ごとに場面を切り替え、その間は人が歩くように少しずつ横へずらす
+            img = order[(num // (VIDEO_FPS * 4)) % len(order)]
+            shift = (shift + int(rng.integers(1, 4))) % width
+            writer.write(np.roll(img, shift, axis=1))
+        writer.release()
+        os.replace(tmp, path)
+
+
+def _hog_params(cv2):
+    """本の hogParams。finalThreshold が groupThreshold に改名された OpenCV ではそちらに読み替える"""
+    hogParams = {'winStride': (8, 8), 'padding': (32, 32), 'scale': 1.05, 'hitThreshold':0, 'finalThreshold':5}
+    hog = cv2.HOGDescriptor()
+    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    try:
+        hog.detectMultiScale(np.zeros((128, 64), dtype=np.uint8), **hogParams)
+    except cv2.error:
+        hogParams["groupThreshold"] = hogParams.pop("finalThreshold")
+    return hogParams
+
+
+def _people_count(data_dir, filename):
+    """ノック88・89: 映像の10フレームごとに HOG で人を検出して list_df に追加する"""
+    movie = os.path.join(data_dir, "mov", filename)
+    if not os.path.exists(movie):
+        raise Skip("mov/{} がありません".format(filename))
+    import cv2
+    hogParams = _hog_params(cv2)
+
+    def run():
+        # 映像取得 #
+        cap = cv2.VideoCapture(movie)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+
+        # hog宣言 #
+        hog = cv2.HOGDescriptor()
+        hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+        num = 0
+        list_df = pd.DataFrame( columns=['time','people'] )
+        while(cap.isOpened()):
+            ret, frame = cap.read()
+            if ret:
+                if (num%10==0):
+                    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                    human, r = hog.detectMultiScale(gray, **hogParams)
+                    if (len(human)>0):
+                        for (x, y, w, h) in human:
+                            cv2.rectangle(frame, (x, y), (x + w, y + h), (255,255,255), 3)
+                    tmp_se = pd.Series( [num/fps,len(human) ], index=list_df.columns )
+                    list_df = pd.concat([list_df, tmp_se.to_frame().T], ignore_index=True)
+            else:
+                break
+            num = num + 1
+        cap.release()
+        return len(list_df)
+    return _quiet(run)
+
+
+@benchmark("knock88", 9, "映像の10フレームごとに HOG で人を検出して表に追加する", prepare=make_video)
+def knock88(data_dir):
+    return _people_count(data_dir, "mov01.avi")
+
+
+@benchmark("knock89", 9, "2つ目の映像で、10フレームごとに HOG で人を検出して表に追加する", prepare=make_video)
+def knock89(data_dir):
+    return _people_count(data_dir, "mov02.avi")
+
+
+# --------------------------------------------------------------------------------------
+# 10章 MeCab のループ
+# --------------------------------------------------------------------------------------
+
+def _survey(data_dir):
+    """ノック91/92の前処理をしたアンケートと、MeCab の Tagger"""
+    try:
+        import MeCab
+    except ImportError:
+        raise Skip("MeCab がインストールされていません")
+    survey = _read(data_dir, "survey.csv")
+    survey = survey.dropna()
+    survey["comment"] = survey["comment"].str.replace("AA", "")
+    survey["comment"] = survey["comment"].str.replace(r"\(.+?\)", "", regex=True)
+    survey["comment"] = survey["comment"].str.replace(r"（.+?）", "", regex=True)
+    return survey, MeCab.Tagger()
+
+
+def _part(line):
+    """本の i.split()[1].split(",")[0]。unidic の出力(品詞が4列目)でも同じだけ split して品詞を取る"""
+    fields = line.split()
+    if "," in fields[1] or len(fields) < 5:
+        return fields[1].split(",")[0]
+    return fields[4].split("-")[0]
+
+
+@benchmark("knock96", 10, "コメントを1件ずつ形態素解析して名詞を集める")
+def knock96(data_dir):
+    survey, tagger = _survey(data_dir)
+
+    def run():
+        all_words = []
+        parts = ["名詞"]
+        for n in range(len(survey)):
+            text = survey["comment"].iloc[n]
+            words = tagger.parse(text).splitlines()
+            words_arr = []
+            for i in words:
+                if i == "EOS" or i == "": continue
+                word_tmp = i.split()[0]
+                part = _part(i)
+                if not (part in parts):continue
+                words_arr.append(word_tmp)
+            all_words.extend(words_arr)
+        all_words_df = pd.DataFrame({"words":all_words, "count":len(all_words)*[1]})
+        all_words_df = all_words_df.groupby("words").sum()
+        return len(all_words_df.sort_values("count",ascending=False))
+    return run
+
+
+@benchmark("knock97", 10, "ストップワードを除きながら、コメントを1件ずつ形態素解析して名詞を集める")
+def knock97(data_dir):
+    survey, tagger = _survey(data_dir)
+
+    def run():
+        stop_words = ["の"]
+        all_words = []
+        parts = ["名詞"]
+        for n in range(len(survey)):
+            text = survey["comment"].iloc[n]
+            words = tagger.parse(text).splitlines()
+            words_arr = []
+            for i in words:
+                if i == "EOS" or i == "": continue
+                word_tmp = i.split()[0]
+                part = _part(i)
+                if not (part in parts):continue
+                if word_tmp in stop_words:continue
+                words_arr.append(word_tmp)
+            all_words.extend(words_arr)
+        all_words_df = pd.DataFrame({"words":all_words, "count":len(all_words)*[1]})
+        all_words_df = all_words_df.groupby("words").sum()
+        return len(all_words_df.sort_values("count",ascending=False))
+    return run
+
+
+@benchmark("knock98", 10, "単語ごとの満足度を、単語を1つずつリストに追加して集計する")
+def knock98(data_dir):
+    survey, tagger = _survey(data_dir)
+
+    def run():
+        stop_words = ["の"]
+        parts = ["名詞"]
+        all_words = []
+        satisfaction = []
+        for n in range(len(survey)):
+            text = survey["comment"].iloc[n]
+            words = tagger.parse(text).splitlines()
+            words_arr = []
+            for i in words:
+                if i == "EOS" or i == "": continue
+                word_tmp = i.split()[0]
+                part = _part(i)
+                if not (part in parts):continue
+                if word_tmp in stop_words:continue
+                words_arr.append(word_tmp)
+                satisfaction.append(survey["satisfaction"].iloc[n])
+            all_words.extend(words_arr)
+        all_words_df = pd.DataFrame({"words":all_words, "satisfaction":satisfaction, "count":len(all_words)*[1]})
+        words_satisfaction = all_words_df.groupby("words").mean()["satisfaction"]
+        words_count = all_words_df.groupby("words").sum()["count"]
+        words_df = pd.concat([words_satisfaction, words_count], axis=1)
+        words_df = words_df.loc[words_df["count"]>=3]
+        return len(words_df.sort_values("satisfaction", ascending=False))
+    return run
+
+
+def _all_words_df(survey, tagger):
+    """ノック99: コメントごとに1行の表を作って concat で積み上げる"""
+    parts = ["名詞"]
+    all_words_df = pd.DataFrame()
+    for n in range(len(survey)):
+        text = survey["comment"].iloc[n]
+        words = tagger.parse(text).splitlines()
+        words_df = pd.DataFrame()
+        for i in words:
+            if i == "EOS" or i == "": continue
+            word_tmp = i.split()[0]
+            part = _part(i)
+            if not (part in parts):continue
+            words_df[word_tmp] = [1]
+        all_words_df = pd.concat([all_words_df, words_df] ,ignore_index=True)
+    return all_words_df.fillna(0)
+
+
+@benchmark("knock99", 10, "コメントごとの単語の有無の表を concat で積み上げる")
+def knock99(data_dir):
+    survey, tagger = _survey(data_dir)
+
+    def run():
+        return _all_words_df(survey, tagger).shape
+    return _quiet(run)
+
+
+@benchmark("knock100", 10, "全アンケートとのコサイン類似度を1行ずつ計算する")
+def knock100(data_dir):
+    survey, tagger = _survey(data_dir)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        words = _all_words_df(survey, tagger)
+
+    def run():
+        all_words_df = words.copy()
+        target_text = all_words_df.iloc[2]
+        cos_sim = []
+        for i in range(len(all_words_df)):
+            cos_text = all_words_df.iloc[i]
+            cos = np.dot(target_text, cos_text) / (np.linalg.norm(target_text) * np.linalg.norm(cos_text))
+            cos_sim.append(cos)
+        all_words_df["cos_sim"] = cos_sim
+        return len(all_words_df.sort_values("cos_sim",ascending=False).head())
+    return _quiet(run)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# 重いノックのベンチマークを規模ごとに実行し、結果をJSONに保存・比較する
+#
+# 1つのベンチマーク×規模ごとに新しいPythonのプロセスを起動して測る。
+# Linux の最大メモリ使用量(ru_maxrss)は exec をまたいで親プロセスの値を引き継ぐので、
+# 子プロセスの中で /proc/self/clear_refs に "5" を書いて最大値を今の使用量に戻し、測る処理の後に
+# /proc/self/status の VmHWM を読む。データの準備と登録されたベンチマークの一覧も子プロセスで行い、
+# 実行する側のプロセスでは pandas・cv2 などを import しない。
+# 記録する値:
+#   wall_seconds  : 測る処理の実行時間(repeat 回のうち最小)
+#   setup_rss_mb  : データの読み込みなどの準備が終わった時点のメモリ使用量
+#   peak_rss_mb   : 測る処理を実行している間の最大メモリ使用量(準備で読んだデータの分を含む)
+#   alloc_peak_mb : tracemalloc で測った、測る処理の中でのPythonのメモリ確保量の最大値
+# データは common.synthetic で synthetic/x{規模}/ に作り、次回以降は使い回す。
+#
+# 使い方(python_data_analyze のフォルダで):
+#   python -m benchmarks run --scales 1 10                     # 全ベンチマーク
+#   python -m benchmarks run --scales 1 --knocks knock28 knock58 --repeat 3
+#   python -m benchmarks compare benchmarks/results/基準.json benchmarks/results/新.json --threshold 0.2
+# compare は実行時間・メモリが threshold(0.2 なら2割)を超えて悪化したものがあれば終了コード1で終わる。
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BASE_DIR, "synthetic")
+RESULT_DIR = os.path.join(BASE_DIR, "benchmarks", "results")
+METRICS = ("wall_seconds", "peak_rss_mb", "alloc_peak_mb")
+# これより小さい差は測定のぶれとみなして悪化に数えない
+NOISE = {"wall_seconds": 0.05, "peak_rss_mb": 5.0, "alloc_peak_mb": 1.0}
+MB = 1024 * 1024
+
+
+def scale_dir(scale, root=DATA_DIR):
+    return os.path.join(root, "x{:g}".format(scale))
+
+
+def prepare_data(bench, scale, root=DATA_DIR, seed=0):
+    """ベンチマークの章のデータがなければ作る(子プロセスで呼ぶ)"""
+    out = scale_dir(scale, root)
+    if bench.prepare is not None:
+        bench.prepare(out, scale, seed)
+        return
+    if os.path.isdir(os.path.join(out, "{}章".format(bench.chapter))):
+        return
+    from common.synthetic import generate
+    # 3〜5章は同じ会員から作るので、まとめて作っておく
+    chapters = (3, 4, 5) if bench.chapter in (3, 4, 5) else (bench.chapter,)
+    generate(out, scale, chapters, seed)
+
+
+def current_rss():
+    """今のメモリ使用量(バイト)。/proc がない環境では最大使用量で代用する"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss()
+
+
+def reset_peak_rss():
+    """最大メモリ使用量を今の使用量に戻す。戻せたら True(Linux 4.0 以降)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """最大メモリ使用量(バイト)。/proc がなければ ru_maxrss(親プロセスの分を含むことがある)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def measure(name, scale, root=DATA_DIR, repeat=1, alloc=True):
+    """子プロセスの中で1つのベンチマークを測る"""
+    from benchmarks.knocks import BENCHMARKS, Skip
+    bench = BENCHMARKS[name]
+    data_dir = os.path.join(scale_dir(scale, root), "{}章".format(bench.chapter))
+    result = {"knock": name, "scale": scale}
+    try:
+        run = bench.setup(data_dir)
+    except Skip as e:
+        result.update(status="skipped", reason=str(e))
+        return result
+    result["setup_rss_mb"] = current_rss() / MB
+    result["peak_rss_reset"] = reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = run()
+        times.append(time.perf_counter() - start)
+    result.update(status="ok", wall_seconds=min(times), wall_all=times,
+                  peak_rss_mb=peak_rss() / MB, value=_plain(value))
+    if alloc:
+        # tracemalloc は処理を数倍遅くするので、時間を測った後に別に1回実行する
+        tracemalloc.start()
+        run()
+        result["alloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / MB
+        tracemalloc.stop()
+    return result
+
+
+def _plain(value):
+    """結果の確認用の値をJSONに書ける形にする"""
+    if hasattr(value, "item"):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def _child(args, timeout=None):
+    """python -m benchmarks を子プロセスで実行し、最後の行のJSONを返す"""
+    command = [sys.executable, "-m", "benchmarks"] + list(args)
+    proc = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True, timeout=timeout)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, proc.stdout, proc.stderr)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def registry():
+    """登録されているベンチマークの一覧 [{"name", "chapter", "description"}]。pandas などを読まないよう子プロセスで調べる"""
+    return _child(["_list"])
+
+
+def run_child(name, scale, root, repeat, alloc, timeout, seed=0):
+    """データの準備と測定を、それぞれ別の子プロセスで行う"""
+    measure_args = ["_measure", name, str(scale), "--root", root, "--repeat", str(repeat)]
+    if not alloc:
+        measure_args.append("--no-alloc")
+    try:
+        prepared = _child(["_prepare", name, str(scale), "--root", root, "--seed", str(seed)], timeout)
+        if prepared["status"] != "ok":
+            return prepared
+        return _child(measure_args, timeout)
+    except subprocess.TimeoutExpired:
+        return {"knock": name, "scale": scale, "status": "timeout", "reason": "{}秒を超えました".format(timeout)}
+    except subprocess.CalledProcessError as e:
+        return {"knock": name, "scale": scale, "status": "error", "reason": e.stderr.strip()[-2000:]}
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        cwd=BASE_DIR, text=True).strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, dirty
+
+
+def run_benchmarks(names=None, scales=(1,), root=DATA_DIR, repeat=1, alloc=True, timeout=3600, seed=0,
+                   output=None, log=print):
+    """ベンチマークを実行して結果の辞書を返す。output を指定するとJSONに保存する"""
+    registered = [bench["name"] for bench in registry()]
+    names = list(names) if names else registered
+    unknown = [name for name in names if name not in registered]
+    if unknown:
+        raise ValueError("未登録のベンチマークです: " + ", ".join(unknown))
+    commit, dirty = git_commit()
+    report = {
+        "commit": commit, "dirty": dirty,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpu_count": os.cpu_count()},
+        "repeat": repeat, "results": [],
+    }
+    for scale in scales:
+        for name in names:
+            result = run_child(name, scale, root, repeat, alloc, timeout, seed)
+            report["results"].append(result)
+            log(format_result(result))
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        tmp = output + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, output)
+    return report
+
+
+def format_result(result):
+    head = "{:<9} x{:<6g}".format(result["knock"], result["scale"])
+    if result["status"] != "ok":
+        return "{} {}: {}".format(head, result["status"], result.get("reason", "").splitlines()[-1:])
+    text = "{} {:9.3f}s  peak {:8.1f}MB".format(head, result["wall_seconds"], result["peak_rss_mb"])
+    if "alloc_peak_mb" in result:
+        text += "  alloc {:8.1f}MB".format(result["alloc_peak_mb"])
+    return text
+
+
+def compare(baseline, current, threshold=0.2, metrics=METRICS):
+    """2つの結果を比べて、ベンチマーク×規模×指標ごとの比を返す
+
+    戻り値の各行の regressed は、threshold を超えて悪化し、差が NOISE より大きいかどうか。
+    """
+    base = {(r["knock"], r["scale"]): r for r in baseline["results"] if r["status"] == "ok"}
+    rows = []
+    for r in current["results"]:
+        b = base.get((r["knock"], r["scale"]))
+        if b is None or r["status"] == "skipped":
+            continue
+        if r["status"] != "ok":
+            # 基準では測れていたものが時間切れ・エラーになったら悪化とみなす
+            rows.append({"knock": r["knock"], "scale": r["scale"], "metric": r["status"],
+                         "baseline": b["wall_seconds"], "current": float("nan"), "ratio": float("inf"),
+                         "regressed": True})
+            continue
+        for metric in metrics:
+            if metric not in r or metric not in b:
+                continue
+            ratio = r[metric] / b[metric] if b[metric] > 0 else float("inf")
+            regressed = ratio > 1 + threshold and r[metric] - b[metric] > NOISE[metric]
+            rows.append({"knock": r["knock"], "scale": r["scale"], "metric": metric,
+                         "baseline": b[metric], "current": r[metric], "ratio": ratio, "regressed": regressed})
+    return rows
+
+
+def _load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="重いノックのベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="ベンチマークを実行する")
+    p_run.add_argument("--knocks", nargs="*", default=None, help="ベンチマークの名前(list で表示される)")
+    p_run.add_argument("--scales", type=float, nargs="*", default=[1])
+    p_run.add_argument("--repeat", type=int, default=1)
+    p_run.add_argument("--no-alloc", action="store_true", help="tracemalloc でのメモリ確保量を測らない")
+    p_run.add_argument("--timeout", type=float, default=3600, help="1つのベンチマークの制限時間(秒)")
+    p_run.add_argument("--seed", type=int, default=0)
+    p_run.add_argument("--root", default=DATA_DIR, help="データの置き場所")
+    p_run.add_argument("--output", default=None, help="既定は benchmarks/results/{コミット}.json")
+
+    p_cmp = sub.add_parser("compare", help="2つの結果を比べ、悪化していれば終了コード1を返す")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--threshold", type=float, default=0.2)
+    p_cmp.add_argument("--metrics", nargs="*", default=list(METRICS), choices=list(METRICS))
+
+    p_list = sub.add_parser("list", help="登録されているベンチマークを表示する")
+
+    p_measure = sub.add_parser("_measure")
+    p_measure.add_argument("name")
+    p_measure.add_argument("scale", type=float)
+    p_measure.add_argument("--root", default=DATA_DIR)
+    p_measure.add_argument("--repeat", type=int, default=1)
+    p_measure.add_argument("--no-alloc", action="store_true")
+
+    p_prepare = sub.add_parser("_prepare")
+    p_prepare.add_argument("name")
+    p_prepare.add_argument("scale", type=float)
+    p_prepare.add_argument("--root", default=DATA_DIR)
+    p_prepare.add_argument("--seed", type=int, default=0)
+
+    sub.add_parser("_list")
+
+    args = parser.parse_args(argv)
+    if args.command == "_measure":
+        print(json.dumps(measure(args.name, args.scale, args.root, args.repeat, not args.no_alloc),
+                         ensure_ascii=False))
+        return 0
+    if args.command == "_prepare":
+        from benchmarks.knocks import BENCHMARKS
+        result = {"knock": args.name, "scale": args.scale, "status": "ok"}
+        try:
+            prepare_data(BENCHMARKS[args.name], args.scale, args.root, args.seed)
+        except ImportError as e:
+            result.update(status="skipped", reason=str(e))
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+    if args.command in ("list", "_list"):
+        from benchmarks.knocks import BENCHMARKS
+        if args.command == "_list":
+            print(json.dumps([{"name": b.name, "chapter": b.chapter, "description": b.description}
+                              for b in BENCHMARKS.values()], ensure_ascii=False))
+            return 0
+        for bench in BENCHMARKS.values():
+            print("{:<9} {}章  {}".format(bench.name, bench.chapter, bench.description))
+        return 0
+    if args.command == "run":
+        output = args.output
+        if output is None:
+            commit, dirty = git_commit()
+            output = os.path.join(RESULT_DIR, "{}{}.json".format(commit or "nogit", "-dirty" if dirty else ""))
+        run_benchmarks(args.knocks, args.scales, args.root, args.repeat, not args.no_alloc, args.timeout,
+                       args.seed, output, log=lambda line: print(line, flush=True))
+        print("結果を保存しました: " + output)
+        return 0
+
+    rows = compare(_load(args.baseline), _load(args.current), args.threshold, args.metrics)
+    regressed = [row for row in rows if row["regressed"]]
+    for row in rows:
+        print("{:<9} x{:<6g} {:<14} {:10.3f} -> {:10.3f}  ({:5.2f}倍){}".format(
+            row["knock"], row["scale"], row["metric"], row["baseline"], row["current"], row["ratio"],
+            "  悪化" if row["regressed"] else ""))
+    if regressed:
+        print("{}件が {:.0%} を超えて悪化しました".format(len(regressed), args.threshold))
+        return 1
+    return 0
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# 章のスクリプト・ノートブックを、画面なしでまとめて実行する
+#
+# 各章のコードは最初に matplotlib.pyplot・sklearn・networkx・cv2・dlib・MeCab などを import し、
+# グラフはノートブックの中に描く(ノック10・29・34・73〜75・79・88〜90など)。
+# 夜間の一括実行で数値だけが欲しいときも、全ての import の時間と画面に描く準備がかかる。
+# ここでは章ごとに新しいプロセスを起動し、
+# - 重いライブラリの import(一番外側に書かれたもの)をコードから外しておき、
+#   その名前(plt・nx・KMeans など)を使うノックを実行する直前に import する
+# - グラフは非対話の Agg で描き、plt.show() とノックの終わりに開いている図をファイルに書き出す。
+#   書き出し(PNGへの描画と圧縮)はプロセスプールで並行に行う。cv2.imshow の画像も同じく書き出す
+# - プロセスの起動から最初のノックを終えるまでの時間(コールドスタート)と、import ごとの時間を記録する
+# ノックの区切りと実行は common.instrument の split_knocks / run_section を使う(--trace で記録もできる)。
+#
+# 使い方(python_data_analyze のフォルダで):
+#   python -m common.batch 1 3 4 --charts charts --workers 4 --report batch.json
+#   python -m common.batch 8 --until ノック75                 # ノック75まで
+#   python -m common.batch 4 --data-root synthetic/x10         # synthetic/x10/4章 のデータで実行する
+#   python -m common.batch 4 --eager                           # 比較のため、import を遅らせずに実行する
+
+import argparse
+import ast
+import concurrent.futures
+import glob
+import json
+import multiprocessing as mp
+import os
+import pickle
+import re
+import subprocess
+import sys
+import time
+import traceback
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import を必要になるまで遅らせるライブラリ(パッケージの一番上の名前)
+HEAVY = ("matplotlib", "sklearn", "networkx", "cv2", "dlib", "MeCab", "scipy", "pulp", "ortoolpy", "seaborn")
+
+
+def chapter_script(chapter, root=BASE_DIR):
+    """章の解答のスクリプト。jupytext の _answer.py があればそれを、なければ _answer.ipynb を使う"""
+    folder = os.path.join(root, "{}章".format(chapter))
+    for pattern in ("*_answer.py", "*_answer.ipynb"):
+        found = sorted(glob.glob(os.path.join(folder, pattern)))
+        if found:
+            return found[0]
+    raise FileNotFoundError("{} に解答のスクリプトがありません".format(folder))
+
+
+def defer_imports(code, heavy=HEAVY):
+    """一番外側の重いライブラリの import をコードから外す
+
+    戻り値は (外した後のコード, [(import で付く名前, import の文, ライブラリ名)])。
+    外した行は pass にするので、エラーの行番号は変わらない。
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, []
+    lines = code.split("\n")
+    deferred = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules = [node.module]
+        else:
+            continue
+        if not all(module.split(".")[0] in heavy for module in modules):
+            continue
+        first, last = node.lineno - 1, node.end_lineno - 1
+        # 1行に他の文がある(import a; b = 1 など)ときはそのまま残す
+        if lines[first][:node.col_offset].strip() or lines[last][node.end_col_offset:].strip():
+            continue
+        statement = "\n".join(lines[first:last + 1]).strip()
+        names = [(alias.asname or alias.name).split(".")[0] for alias in node.names]
+        deferred.append((names, statement, modules[0].split(".")[0]))
+        lines[first] = lines[first][:node.col_offset] + "pass"
+        for i in range(first + 1, last + 1):
+            lines[i] = ""
+    return "\n".join(lines), deferred
+
+
+class LazyImports(object):
+    """外した import を覚えておき、名前を使うコードを実行する前に import する"""
+
+    def __init__(self, namespace, on_import=None):
+        self.namespace = namespace
+        self.on_import = on_import
+        self.pending = []
+        self.imported = []
+
+    def add(self, deferred):
+        self.pending.extend(deferred)
+
+    def before(self, code, title):
+        """code で使われている名前の import を実行する"""
+        names = set(re.findall(r"\w+", code))
+        needed = [item for item in self.pending if names.intersection(item[0])]
+        if not needed:
+            return
+        self.pending = [item for item in self.pending if item not in needed]
+        for _, statement, module in needed:
+            loaded = module in sys.modules
+            start = time.perf_counter()
+            exec(compile(statement, "<import>", "exec"), self.namespace)
+            self.imported.append({"module": module, "statement": statement, "knock": title,
+                                  "seconds": time.perf_counter() - start, "cached": loaded})
+            if self.on_import is not None:
+                self.on_import()
+
+    def remaining(self):
+        return sorted(set(module for _, _, module in self.pending))
+
+
+# --------------------------------------------------------------------------------------
+# グラフ・画像の書き出し
+# --------------------------------------------------------------------------------------
+
+def _save_figure(data, path, dpi):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    fig = pickle.loads(data)
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+def _write_image(image, path):
+    import cv2
+    cv2.imwrite(path, image)
+    return path
+
+
+class ChartExporter(object):
+    """plt.show()・cv2.imshow の代わりに、図と画像をファイルに書き出す
+
+    workers が 1 以上ならプロセスプールで書き出す。図を pickle できないときはその場で書き出す。
+    """
+
+    def __init__(self, out_dir, workers=2, fmt="png", dpi=100):
+        self.out_dir = out_dir
+        self.workers = workers
+        self.fmt = fmt
+        self.dpi = dpi
+        self.prefix = "chart"
+        self.counts = {}
+        self.files = []
+        self._futures = []
+        self._pool = None
+        self._patched = set()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def section(self, index, title):
+        self.prefix = "{:02d}_{}".format(index, title)
+
+    def _path(self, ext):
+        n = self.counts[self.prefix] = self.counts.get(self.prefix, 0) + 1
+        path = os.path.join(self.out_dir, "{}_{}.{}".format(self.prefix, n, ext))
+        self.files.append(path)
+        return path
+
+    def _submit(self, func, *args):
+        if self.workers > 0:
+            if self._pool is None:
+                # matplotlib などを import した後の状態をそのまま使えるように fork で作る
+                context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+                self._pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+            self._futures.append(self._pool.submit(func, *args))
+        else:
+            func(*args)
+
+    def show(self, *args, **kwargs):
+        """開いている図を全て書き出して閉じる(plt.show の代わり)"""
+        plt = sys.modules.get("matplotlib.pyplot")
+        if plt is None:
+            return
+        for number in plt.get_fignums():
+            fig = plt.figure(number)
+            path = self._path(self.fmt)
+            try:
+                data = pickle.dumps(fig)
+            except Exception:
+                fig.savefig(path, dpi=self.dpi)
+            else:
+                self._submit(_save_figure, data, path, self.dpi)
+            plt.close(fig)
+
+    def imshow(self, name, image):
+        self._submit(_write_image, image, self._path("png"))
+
+    def install(self):
+        """import 済みの pyplot・cv2 の表示の関数を置き換える。import のたびに呼ぶ"""
+        plt = sys.modules.get("matplotlib.pyplot")
+        if plt is not None and "pyplot" not in self._patched:
+            # pyplot はバックエンドを切り替えるときに show へ属性を付けるので、メソッドではなく関数にする
+            def show(*args, **kwargs):
+                self.show()
+            plt.show = show
+            self._patched.add("pyplot")
+        cv2 = sys.modules.get("cv2")
+        if cv2 is not None and "cv2" not in self._patched:
+            cv2.imshow = self.imshow
+            cv2.waitKey = lambda delay=0: -1
+            cv2.destroyAllWindows = lambda: None
+            self._patched.add("cv2")
+
+    def close(self):
+        errors = []
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(repr(e))
+        if self._pool is not None:
+            self._pool.shutdown()
+        return errors
+
+
+# --------------------------------------------------------------------------------------
+# 章の実行
+# --------------------------------------------------------------------------------------
+
+def run_chapter(chapter, charts=None, workers=2, until=None, data_root=None, eager=False, spawned=None):
+    """1つの章をノックごとに実行し、時間・import・書き出した図の記録を返す"""
+    from common.instrument import PREAMBLE, run_section, split_knocks, _normalize_digits
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    entered = time.time()
+    script = chapter_script(chapter)
+    sections = split_knocks(script)
+    cwd = os.path.join(data_root, "{}章".format(chapter)) if data_root else os.path.dirname(script)
+    charts_dir = os.path.join(charts or os.path.join(BASE_DIR, "charts"), "{}章".format(chapter))
+    exporter = ChartExporter(charts_dir, workers)
+    namespace = {"__name__": "__main__", "__file__": script}
+    lazy = LazyImports(namespace, on_import=exporter.install)
+    report = {"chapter": chapter, "script": os.path.relpath(script, BASE_DIR), "status": "ok", "knocks": []}
+    if spawned is not None:
+        report["interpreter_seconds"] = entered - spawned
+    stop = {until, _normalize_digits(until)} if until else set()
+    old = os.getcwd()
+    os.chdir(cwd)
+    sys.path.insert(0, os.path.dirname(script))
+    start = time.perf_counter()
+    ready = None
+    try:
+        for i, (title, code) in enumerate(sections):
+            if not eager:
+                code, deferred = defer_imports(code)
+                lazy.add(deferred)
+            exporter.section(i, title)
+            knock_start = time.perf_counter()
+            lazy.before(code, title)
+            run_section(title, code, namespace, "{}章".format(chapter), os.path.basename(script))
+            exporter.install()
+            exporter.show()
+            report["knocks"].append({"knock": title, "seconds": time.perf_counter() - knock_start,
+                                     "charts": exporter.counts.get(exporter.prefix, 0)})
+            if title != PREAMBLE and ready is None:
+                ready = time.time()
+                report["startup_seconds"] = time.perf_counter() - start
+            if title in stop:
+                break
+    except Exception:
+        report["status"] = "error"
+        report["error"] = traceback.format_exc(limit=-3)
+    finally:
+        os.chdir(old)
+        sys.path.remove(os.path.dirname(script))
+        errors = exporter.close()
+    if errors:
+        report["chart_errors"] = errors
+    if ready is None:
+        ready = time.time()
+        report["startup_seconds"] = time.perf_counter() - start
+    if spawned is not None:
+        # プロセスの起動から、準備のコードと最初のノック(ふつうは import とデータの読み込み)を終えるまで
+        report["cold_start_seconds"] = ready - spawned
+    report["imports"] = lazy.imported
+    report["deferred"] = lazy.remaining()
+    report["charts"] = [os.path.relpath(path, BASE_DIR) for path in exporter.files]
+    report["total_seconds"] = time.perf_counter() - start
+    return report
+
+
+def run_child(chapter, args):
+    """章を新しいプロセスで実行する(import 済みのライブラリの影響を受けずにコールドスタートを測るため)"""
+    command = [sys.executable, "-m", "common.batch", "_chapter", str(chapter), "--workers", str(args.workers),
+               "--spawned", repr(time.time())]
+    # 子プロセスは python_data_analyze のフォルダで動くので、パスは絶対パスにして渡す
+    if args.charts:
+        command += ["--charts", os.path.abspath(args.charts)]
+    if args.data_root:
+        command += ["--data-root", os.path.abspath(args.data_root)]
+    if args.until:
+        command += ["--until", args.until]
+    if args.eager:
+        command.append("--eager")
+    if args.trace:
+        base, ext = os.path.splitext(os.path.abspath(args.trace))
+        command += ["--trace", "{}.{}章{}".format(base, chapter, ext)]
+    proc = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True, timeout=args.timeout)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines or not lines[-1].startswith("{"):
+        return {"chapter": chapter, "status": "error", "error": proc.stderr.strip()[-2000:]}
+    return json.loads(lines[-1])
+
+
+def format_report(report):
+    if "cold_start_seconds" not in report:
+        return "{}章: {}".format(report["chapter"], report.get("error", "").strip().splitlines()[-1:])
+    text = "{}章: {} コールドスタート {:.2f}s (最初のノックまで {:.2f}s) 合計 {:.2f}s 図 {}枚".format(
+        report["chapter"], report["status"], report["cold_start_seconds"], report["startup_seconds"],
+        report["total_seconds"], len(report["charts"]))
+    for item in [item for item in report["imports"] if not item["cached"]]:
+        text += "\n    import {:<10} {:6.2f}s  {}".format(item["module"], item["seconds"], item["knock"])
+    if report["deferred"]:
+        text += "\n    使わなかった: " + ", ".join(report["deferred"])
+    if report["status"] != "ok":
+        text += "\n    " + report["error"].strip().splitlines()[-1]
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="章のスクリプトを画面なしで実行し、グラフをファイルに書き出す")
+    parser.add_argument("chapters", nargs="+", help="章の番号(_chapter は内部用)")
+    parser.add_argument("--charts", default=None, help="グラフの書き出し先(既定は charts/{章})")
+    parser.add_argument("--workers", type=int, default=2, help="グラフを書き出すプロセスの数(0 ならその場で)")
+    parser.add_argument("--until", default=None, help="このノックまで実行する(例: ノック75)")
+    parser.add_argument("--data-root", default=None, help="章のデータのフォルダの親(既定はスクリプトのフォルダ)")
+    parser.add_argument("--eager", action="store_true", help="import を遅らせない")
+    parser.add_argument("--trace", default=None, help="common.instrument の記録の出力先(章ごとに名前を変える)")
+    parser.add_argument("--report", default=None, help="章ごとの記録を保存する JSON")
+    parser.add_argument("--timeout", type=float, default=3600, help="1つの章の制限時間(秒)")
+    parser.add_argument("--spawned", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.chapters[0] == "_chapter":
+        if args.trace:
+            from common.instrument import enable
+            enable(args.trace)
+        report = run_chapter(int(args.chapters[1]), args.charts, args.workers, args.until, args.data_root,
+                             args.eager, args.spawned)
+        print(json.dumps(report, ensure_ascii=False))
+        return 0
+
+    reports = []
+    for chapter in args.chapters:
+        try:
+            report = run_child(int(chapter), args)
+        except subprocess.TimeoutExpired:
+            report = {"chapter": int(chapter), "status": "timeout", "error": "{}秒を超えました".format(args.timeout)}
+        reports.append(report)
+        print(format_report(report), flush=True)
+    if args.report:
+        tmp = args.report + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, args.report)
+    return 0 if all(report["status"] == "ok" for report in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
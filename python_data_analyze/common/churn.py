@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# 5章の退会予測の学習データ(ノック41〜46)を、ループを使わずに同じ結果になるように作る
+#
+# 本の手順では
+# - ノック41: 月ごとに絞り込んで前月と結合し、pd.concat でつなぐ
+# - ノック42: 退会日の1か月前を relativedelta で1行ずつ計算する
+# - ノック43: 継続顧客の利用月を sample(frac=1) で並べ替えて drop_duplicates する(乱数の種がなく、実行ごとに変わる)
+# - ノック44: 在籍期間を relativedelta で1行ずつ計算する
+# - ノック46: get_dummies の後、基準にする列を del で消す(データに現れた値によって列が変わる)
+# ここでは
+# - 年月を「月の通し番号」にし、前月の利用回数は通し番号を1つずらした表との1回の結合で付ける
+# - 退会前月・在籍期間は年・月・日の整数の計算にする(relativedelta と同じ結果)
+# - 継続顧客の月は、(乱数の種, customer_id, 年月) のハッシュが最小の月を選ぶ。
+#   種と入力が同じなら毎回同じ月が選ばれる。他の顧客が増えても選ばれる月は変わらないが、
+#   その顧客の月が増えると、増えた月のハッシュの方が小さければその月に変わる
+# - カテゴリの値と基準の値を Encoding に決めておき、JSON に保存して学習・予測で同じ列にする
+# 特徴量は float32、ダミー変数は uint8 の表で返す。
+#
+# 使い方:
+#   from common.churn import build
+#   data = build(customer, uselog_months, seed=0)      # customer_join.csv と use_log_months.csv
+#   data.X, data.y                                     # ノック47の X・y(is_deleted を除いた列と is_deleted)
+#   data.encoding.save("encoding.json")                # 予測のときは build(..., encoding=Encoding.load(...))
+# コマンドから(python_data_analyze のフォルダで):
+#   python -m common.churn --root synthetic/x10 --seed 0 --output churn.npz
+
+import argparse
+import collections
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ノック46の target_col と、del で消している基準の値
+CATEGORICAL = ("campaign_name", "class_name", "gender")
+NUMERIC = ("count_1", "routine_flg", "period")
+BASELINE = {"campaign_name": "通常", "class_name": "ナイト", "gender": "M"}
+TARGET = "is_deleted"
+
+TrainingSet = collections.namedtuple("TrainingSet", ["X", "y", "keys", "encoding"])
+TrainingSet.__doc__ = "特徴量(X)・目的変数(y)・行ごとの customer_id と年月(keys)・使ったエンコーディング"
+
+
+def _year_month(number):
+    return (number // 12) * 100 + number % 12 + 1
+
+
+def shift_months(uselog_months):
+    """ノック41: 2か月目以降の各月の行に、前月の利用回数(count_1)を付ける"""
+    months = pd.unique(uselog_months["年月"])
+    # 本と同じく、現れた順で1つ前の月を前月とする
+    position = pd.Series(np.arange(len(months)), index=months)
+    uselog = uselog_months.rename(columns={"count": "count_0"})
+    uselog["_position"] = position.reindex(uselog["年月"]).to_numpy()
+    before = uselog[["customer_id", "_position", "count_0"]].rename(columns={"count_0": "count_1"})
+    before["_position"] += 1
+    uselog = uselog.loc[uselog["_position"] > 0]
+    # 本は月ごとに concat しているので、月の順(同じ月の中は元の順)に並べる
+    uselog = uselog.iloc[np.argsort(uselog["_position"].to_numpy(), kind="stable")]
+    uselog = pd.merge(uselog, before, on=["customer_id", "_position"], how="left")
+    return uselog.drop(columns="_position")
+
+
+def exit_year_month(end_date):
+    """ノック42: 退会日の1か月前の年月("201903" のような文字列)"""
+    end_date = pd.to_datetime(end_date)
+    number = end_date.dt.year * 12 + (end_date.dt.month - 1) - 1
+    return _year_month(number).astype("Int64").astype(str)
+
+
+def months_between(now_date, start_date):
+    """ノック44: relativedelta(now_date, start_date) の years*12 + months"""
+    now_date, start_date = pd.to_datetime(now_date), pd.to_datetime(start_date)
+    months = (now_date.dt.year - start_date.dt.year) * 12 + (now_date.dt.month - start_date.dt.month)
+    # 日(と時刻)が開始日に届いていなければ1か月少ない。
+    # now_date が start_date より前(月の途中の入会)なら relativedelta は負の向きに数えて0の側に切り捨てる
+    now_rest = now_date - now_date.dt.to_period("M").dt.start_time
+    start_rest = start_date - start_date.dt.to_period("M").dt.start_time
+    forward = months - (now_rest < start_rest).astype(np.int64)
+    backward = months + (now_rest > start_rest).astype(np.int64)
+    return forward.where(now_date >= start_date, backward)
+
+
+def pick_one_month(uselog, seed=0, key="customer_id"):
+    """ノック43: 顧客ごとに1行を選ぶ。(seed, customer_id, 年月) のハッシュが最小の行
+
+    同じ seed と uselog なら毎回同じ行になる。顧客の月が増えると、選ばれる行が変わることがある。
+    """
+    hashes = pd.util.hash_pandas_object(uselog[[key, "年月"]].astype(str), index=False,
+                                        hash_key="{:016d}".format(seed)[-16:]).to_numpy()
+    order = np.lexsort((hashes, uselog[key].to_numpy()))
+    first = np.ones(len(order), dtype=bool)
+    customers = uselog[key].to_numpy()[order]
+    first[1:] = customers[1:] != customers[:-1]
+    # 選んだ行を元の順に戻す
+    return uselog.iloc[np.sort(order[first])]
+
+
+class Encoding(object):
+    """カテゴリの列ごとの値の並びと基準の値。基準以外の値をダミー変数(uint8)にする"""
+
+    def __init__(self, categories, baseline=None, numeric=NUMERIC):
+        self.categories = {name: list(values) for name, values in categories.items()}
+        self.baseline = dict(BASELINE if baseline is None else baseline)
+        self.numeric = list(numeric)
+
+    @classmethod
+    def fit(cls, df, columns=CATEGORICAL, baseline=None, numeric=NUMERIC):
+        """df に現れた値を get_dummies と同じく並べ替えて使う"""
+        categories = {name: sorted(df[name].dropna().unique().tolist()) for name in columns}
+        return cls(categories, baseline, numeric)
+
+    @property
+    def columns(self):
+        dummies = ["{}_{}".format(name, value) for name, values in self.categories.items()
+                   for value in values if value != self.baseline.get(name)]
+        return self.numeric + dummies
+
+    def transform(self, df):
+        """numeric の列は float32、カテゴリの列は基準以外の値ごとの uint8 の列にする"""
+        columns = {name: df[name].to_numpy(dtype=np.float32) for name in self.numeric}
+        for name, values in self.categories.items():
+            codes = pd.Index(values).get_indexer(df[name])
+            if (codes < 0).any():
+                unknown = pd.unique(df[name][codes < 0])
+                raise KeyError("{} にエンコーディングにない値があります: {}".format(name, ", ".join(map(str, unknown))))
+            for i, value in enumerate(values):
+                if value != self.baseline.get(name):
+                    columns["{}_{}".format(name, value)] = (codes == i).astype(np.uint8)
+        return pd.DataFrame(columns, index=df.index, columns=self.columns)
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"categories": self.categories, "baseline": self.baseline, "numeric": self.numeric}, f,
+                      ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["categories"], data["baseline"], data["numeric"])
+
+
+def build(customer, uselog_months, seed=0, encoding=None):
+    """ノック41〜46の predict_data を作り、TrainingSet にして返す
+
+    encoding を省くと、データに現れた値から作る(ノック46の get_dummies と同じ列になる)。
+    """
+    uselog = shift_months(uselog_months)
+    uselog["年月"] = uselog["年月"].astype(str)
+    # ノック42: 退会顧客は退会前月の行
+    exit_customer = customer.loc[customer["is_deleted"] == 1].copy()
+    exit_customer["年月"] = exit_year_month(exit_customer["end_date"])
+    exit_uselog = pd.merge(uselog, exit_customer, on=["customer_id", "年月"], how="inner")
+    # ノック43: 継続顧客は1人1か月
+    conti_customer = customer.loc[customer["is_deleted"] == 0]
+    conti_uselog = pd.merge(uselog, conti_customer, on="customer_id", how="inner")
+    conti_uselog = pick_one_month(conti_uselog, seed)
+    predict_data = pd.concat([conti_uselog, exit_uselog], ignore_index=True)
+    # ノック44・45
+    now_date = pd.to_datetime(predict_data["年月"], format="%Y%m")
+    predict_data["period"] = months_between(now_date, predict_data["start_date"])
+    predict_data = predict_data.dropna(subset=["count_1"]).reset_index(drop=True)
+    # ノック46
+    if encoding is None:
+        encoding = Encoding.fit(predict_data)
+    X = encoding.transform(predict_data)
+    y = predict_data[TARGET].astype(np.uint8)
+    return TrainingSet(X, y, predict_data[["customer_id", "年月"]], encoding)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="5章の退会予測の学習データを作る")
+    parser.add_argument("--root", default=BASE_DIR, help="5章のフォルダの親(既定は python_data_analyze)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--encoding", default=None, help="保存したエンコーディング(なければ作って保存する)")
+    parser.add_argument("--output", default=None, help="X・y・列名を保存する .npz")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    folder = os.path.join(args.root, "5章")
+    customer = pd.read_csv(os.path.join(folder, "customer_join.csv"))
+    uselog_months = pd.read_csv(os.path.join(folder, "use_log_months.csv"))
+    encoding = Encoding.load(args.encoding) if args.encoding and os.path.exists(args.encoding) else None
+    data = build(customer, uselog_months, args.seed, encoding)
+    if args.encoding and encoding is None:
+        data.encoding.save(args.encoding)
+    if args.output:
+        np.savez_compressed(args.output, X=data.X.to_numpy(dtype=np.float32), y=data.y.to_numpy(),
+                            columns=np.array(data.X.columns))
+    print("{}行 {}列 ({}件が退会) {:.2f}秒".format(len(data.X), data.X.shape[1], int(data.y.sum()),
+                                            time.perf_counter() - start))
+    print(", ".join(data.X.columns))
+
+
+if __name__ == "__main__":
+    main()
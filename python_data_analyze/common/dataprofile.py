@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+# データを読みながら、欠損の数・最小/最大・平均/分散・分位点・種類の数を数える
+#
+# ノック7の join_data.isnull().sum() と describe()、ノック22の結合後の isnull().sum()、ノック45の isna().sum() は、
+# 表を全てメモリに載せてから、確認のためだけにもう一度なめている。
+# ここでは分割して読んだ表(read_csv の chunksize)や、分割ごとの結合の結果を1回通すだけで、
+# 決まった大きさのメモリで次の値を数える。
+# - 件数・欠損の数・最小・最大
+# - 平均・分散(分割ごとの値をまとめられる形で持つ)
+# - 分位点: KLL(値を間引きながら段ごとに重みを倍にして持つ)。誤差はおよそ 1/k
+# - 種類の数: HyperLogLog(ハッシュ値の先頭の0の数の最大値を 2**p 個の箱ごとに持つ)。誤差はおよそ 1.04/sqrt(2**p)
+# 途中の値は分割ごと・プロセスごとに作って merge でまとめられる。読み終わった後に isnull() や describe() で取り出す。
+#
+# 使い方:
+#   from common.dataprofile import Profile, profiled
+#   profile = Profile()
+#   for chunk in profiled(pd.read_csv("use_log.csv", chunksize=100000), profile):
+#       ...                              # 読みながら集計などを続ける
+#   profile.isnull()                     # isnull().sum() と同じ
+#   profile.describe()                   # describe() の近似(分位点・種類の数は近似値)
+# 結合しながら数えるとき(ノック22):
+#   for chunk in merge_chunks(pd.read_csv("customer_master.csv", chunksize=10000), class_master, profile,
+#                             on="class", how="left"):
+#       ...
+# ファイルを調べるだけのとき(python_data_analyze のフォルダで):
+#   python -m common.dataprofile synthetic/x10/4章/use_log.csv --chunksize 200000
+
+import argparse
+import math
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+PERCENTILES = (0.25, 0.5, 0.75)
+
+
+class QuantileSketch(object):
+    """KLL による分位点の近似。k が大きいほど正確になり、保持する値の数はおよそ 3k"""
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return int(sum(len(level) << h for h, level in enumerate(self.levels)))
+
+    def _capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values):
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compress()
+
+    def merge(self, other):
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self._compress()
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(self.levels[h])
+                # 数が奇数なら最大の値をこの段に残し、残りを1つおきに次の段(重み2倍)へ移す
+                if len(values) % 2:
+                    self.levels[h], values = values[-1:], values[:-1]
+                else:
+                    self.levels[h] = np.empty(0)
+                offset = int(self.rng.integers(2))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], values[offset::2]])
+            h += 1
+
+    def quantile(self, q):
+        values = np.concatenate(self.levels)
+        if not len(values):
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        values, cumulative = values[order], np.cumsum(weights[order])
+        rank = np.asarray(q, dtype=np.float64) * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, rank, side="left"), len(values) - 1)
+        return values[index]
+
+
+class DistinctSketch(object):
+    """HyperLogLog による種類の数の近似。2**p バイトを使う"""
+
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def update(self, values):
+        if not len(values):
+            return
+        if not isinstance(values, pd.Series):
+            values = pd.Series(values)
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        bucket = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        # 残りのビットの先頭から最初の1までの位置
+        bits = np.where(rest > 0, np.floor(np.log2(np.maximum(rest, 1).astype(np.float64))) + 1, 0)
+        rank = (64 - self.p - bits + 1).astype(np.uint8)
+        np.maximum.at(self.registers, bucket, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # 少ないときは空の箱の数から数える(linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class ColumnProfile(object):
+    """1つの列の件数・欠損・最小/最大・平均/分散・分位点・種類の数"""
+
+    def __init__(self, kind, k=200, p=12, seed=0):
+        # kind: "number"・"datetime"・"object"(文字列やカテゴリ)
+        self.kind = kind
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.quantiles = QuantileSketch(k, seed) if kind != "object" else None
+        self.distinct = DistinctSketch(p)
+
+    def update(self, series):
+        null = series.isna().to_numpy()
+        values = series[~null]
+        self.nulls += int(null.sum())
+        if not len(values):
+            return
+        if self.kind == "object":
+            self.count += len(values)
+            self.distinct.update(values)
+            return
+        if self.kind == "datetime":
+            numbers = values.to_numpy(dtype="datetime64[ns]").view(np.int64).astype(np.float64)
+        else:
+            numbers = values.to_numpy(dtype=np.float64)
+        self.distinct.update(numbers)
+        self._add_moments(len(numbers), float(numbers.mean()), float(((numbers - numbers.mean()) ** 2).sum()),
+                          float(numbers.min()), float(numbers.max()))
+        self.quantiles.update(numbers)
+
+    def _add_moments(self, count, mean, m2, low, high):
+        # 2つのまとまりの平均と偏差平方和をまとめる(Chan らの方法)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def merge(self, other):
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        if self.kind == "object":
+            self.count += other.count
+        elif other.count:
+            self._add_moments(other.count, other.mean, other.m2, other.min, other.max)
+            self.quantiles.merge(other.quantiles)
+
+    def _value(self, number):
+        if number is None or (isinstance(number, float) and math.isnan(number)):
+            return np.nan
+        return pd.Timestamp(int(number)) if self.kind == "datetime" else number
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+    def summary(self, percentiles=PERCENTILES):
+        """describe() と同じ並びの統計量(分位点と unique は近似値)"""
+        result = {"count": self.count, "null": self.nulls, "unique": self.distinct.estimate()}
+        if self.kind == "object":
+            return pd.Series(result, dtype=object)
+        result["mean"] = self._value(self.mean if self.count else None)
+        std = self.std()
+        result["std"] = pd.Timedelta(int(std)) if self.kind == "datetime" and not math.isnan(std) else std
+        result["min"] = self._value(self.min)
+        for q, value in zip(percentiles, self.quantiles.quantile(list(percentiles))):
+            result["{:g}%".format(q * 100)] = self._value(value)
+        result["max"] = self._value(self.max)
+        return pd.Series(result, dtype=object)
+
+
+def _kind(dtype):
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+        return "number"
+    return "object"
+
+
+class Profile(object):
+    """表の列ごとの ColumnProfile。update で分割した表を順に足し、merge で他の Profile とまとめる"""
+
+    def __init__(self, k=200, p=12, seed=0):
+        self.k, self.p, self.seed = k, p, seed
+        self.rows = 0
+        self.columns = {}
+
+    def update(self, df):
+        self.rows += len(df)
+        for name in df.columns:
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = ColumnProfile(_kind(df[name].dtype), self.k, self.p, self.seed)
+                # 途中から現れた列は、それまでの行を欠損として数える
+                column.nulls = self.rows - len(df)
+            column.update(df[name])
+        for name, column in self.columns.items():
+            if name not in df.columns:
+                column.nulls += len(df)
+        return df
+
+    def merge(self, other):
+        for name, column in other.columns.items():
+            if name in self.columns:
+                self.columns[name].merge(column)
+            else:
+                self.columns[name] = column
+                column.nulls += self.rows
+        for name, column in self.columns.items():
+            if name not in other.columns:
+                column.nulls += other.rows
+        self.rows += other.rows
+        return self
+
+    def isnull(self):
+        """df.isnull().sum() と同じ Series"""
+        return pd.Series({name: column.nulls for name, column in self.columns.items()}, dtype=np.int64)
+
+    isna = isnull
+
+    def describe(self, include=None, percentiles=PERCENTILES):
+        """df.describe() の近似。既定は数値と日時の列、include="all" なら全ての列"""
+        names = [name for name, column in self.columns.items() if include == "all" or column.kind != "object"]
+        stats = ["count", "null", "unique", "mean", "std", "min"] + ["{:g}%".format(q * 100) for q in percentiles]
+        result = pd.DataFrame({name: self.columns[name].summary(percentiles) for name in names})
+        return result.reindex([stat for stat in stats + ["max"] if stat in result.index])
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def profiled(chunks, profile):
+    """分割した表を profile に足しながらそのまま返す"""
+    for chunk in chunks:
+        yield profile.update(chunk)
+
+
+def merge_chunks(chunks, right, profile, **options):
+    """分割した表ごとに pd.merge(chunk, right, **options) し、結果を profile に足しながら返す"""
+    for chunk in chunks:
+        yield profile.update(pd.merge(chunk, right, **options))
+
+
+def profile_csv(path, chunksize=100000, k=200, p=12, **options):
+    """CSV を分割して読み、Profile だけを返す(表はメモリに残さない)"""
+    profile = Profile(k, p)
+    for _ in profiled(pd.read_csv(path, chunksize=chunksize, **options), profile):
+        pass
+    return profile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CSV を分割して読みながら、欠損の数と統計量を数える")
+    parser.add_argument("path")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("--parse-dates", nargs="*", default=None, help="日時として読む列")
+    parser.add_argument("-k", type=int, default=200, help="分位点の近似の細かさ")
+    args = parser.parse_args(argv)
+    options = {"parse_dates": args.parse_dates} if args.parse_dates else {}
+    profile = profile_csv(args.path, args.chunksize, args.k, **options)
+    with pd.option_context("display.width", 200, "display.max_columns", 30):
+        print("{}行".format(profile.rows))
+        print(profile.isnull().to_string())
+        print(profile.describe(include="all").to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# 隣接行列・重み行列からネットワークをまとめて作り、大きなネットワークも短時間で描く
+#
+# ノック53〜57・62・71は df_w.iloc[i][j]・df_tr[...][...]・df_links[node_name].iloc[i] を2重ループで読み、
+# 1組ずつ G.add_edge している(ノック55は重みが0の組にも辺を張る)。ノック77は列ごとに sum(...) でリンク数を数える。
+# 節点の数を n とすると n*n 回の pandas の呼び出しになり、数千人のネットワークでも分単位かかる。
+# ここでは
+# - 行列の0でない要素だけを np.nonzero で取り出し、辺のリスト(番号の配列)にする。networkx には add_*_from でまとめて渡す
+# - リンク数は行列の列ごとの0でない要素の数として一度に数える
+# - 描画は辺を LineCollection 1つにまとめる。辺が多いときは間引くか、近くの節点をまとめて束ねて描く
+#
+# 使い方:
+#   from common import graph
+#   edges = graph.from_matrix(df_w)                         # ノック55: 重みが0でない組だけ辺にする
+#   edges = graph.from_matrix(df_tr, nodes=df_pos.columns)  # ノック57・62: 行(倉庫)と列(工場)が別の節点
+#   G = graph.to_networkx(edges)                            # networkx の Graph が必要なとき
+#   graph.draw(edges, graph.positions(df_pos), width=edges.weight * 0.1)
+#   edges = graph.from_matrix(df_links)                     # ノック71(index_col=0 で読んだ links.csv)
+#   graph.draw(edges, mode="bundle")                        # 数万の節点でも束ねて描く
+#   links_num = graph.degrees(df_mem_links)                 # ノック77
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+Edges = collections.namedtuple("Edges", ["nodes", "source", "target", "weight", "directed"])
+Edges.__doc__ = "節点のラベルと、辺の両端の節点の番号・重みの配列"
+
+# mode="auto" でこれより辺が多いときは束ねて描く
+MAX_EDGES = 20000
+# これより節点が多いときはラベルを描かない・spring_layout を使わない
+MAX_LABELS = 200
+MAX_SPRING = 2000
+
+
+def _matrix(matrix):
+    """行列を (値, 行のラベル, 列のラベル) にする。scipy の疎行列はそのまま返す"""
+    if isinstance(matrix, pd.DataFrame):
+        return matrix.to_numpy(), matrix.index, matrix.columns
+    if hasattr(matrix, "tocoo"):
+        return matrix.tocoo(), pd.RangeIndex(matrix.shape[0]), pd.RangeIndex(matrix.shape[1])
+    matrix = np.asarray(matrix)
+    return matrix, pd.RangeIndex(matrix.shape[0]), pd.RangeIndex(matrix.shape[1])
+
+
+def _nonzero(values):
+    if hasattr(values, "row"):
+        keep = values.data != 0
+        return values.row[keep], values.col[keep], values.data[keep]
+    rows, cols = np.nonzero(np.nan_to_num(values))
+    return rows, cols, values[rows, cols]
+
+
+def from_matrix(matrix, nodes=None, directed=False, self_loops=True):
+    """隣接行列・重み行列の0でない要素を辺にする
+
+    行と列のラベルが同じ(または行のラベルが 0,1,2,... の番号)なら正方行列として、列のラベルを節点にする。
+    それ以外(輸送ルートの倉庫×工場など)は、行のラベルと列のラベルの両方を節点にする。
+    nodes を指定すると節点をその順に並べる(行列にない節点は辺のない節点になる)。
+    directed=False では [i, j] と [j, i] を1本の辺にし、重みは [i, j](i <= j)を優先する。
+    """
+    values, rows, cols = _matrix(matrix)
+    square = values.shape[0] == values.shape[1] and (rows.equals(cols) or isinstance(rows, pd.RangeIndex))
+    if square:
+        labels = pd.Index(cols)
+        row_labels = labels
+    else:
+        labels = pd.Index(rows).append(pd.Index(cols)).unique()
+        row_labels = pd.Index(rows)
+    if nodes is not None:
+        labels = pd.Index(nodes)
+    source, target, weight = _nonzero(values)
+    source = labels.get_indexer(row_labels[source])
+    target = labels.get_indexer(pd.Index(cols)[target])
+    if (source < 0).any() or (target < 0).any():
+        raise KeyError("nodes にない節点の辺があります")
+    if not directed:
+        # 向きをそろえて、同じ組の辺は先に現れた(i <= j の)ものを残す
+        low, high = np.minimum(source, target), np.maximum(source, target)
+        order = np.lexsort((source > target, high, low))
+        low, high, weight = low[order], high[order], weight[order]
+        first = np.ones(len(low), dtype=bool)
+        first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+        source, target, weight = low[first], high[first], weight[first]
+    if not self_loops:
+        keep = source != target
+        source, target, weight = source[keep], target[keep], weight[keep]
+    return Edges(labels, source.astype(np.int64), target.astype(np.int64), np.asarray(weight, dtype=np.float64),
+                 directed)
+
+
+def to_networkx(edges, weight="weight"):
+    """Edges を networkx の Graph(directed なら DiGraph)にする"""
+    import networkx as nx
+    G = nx.DiGraph() if edges.directed else nx.Graph()
+    nodes = [str(node) for node in edges.nodes]
+    G.add_nodes_from(nodes)
+    names = np.asarray(nodes, dtype=object)
+    G.add_weighted_edges_from(zip(names[edges.source], names[edges.target], edges.weight.tolist()), weight=weight)
+    return G
+
+
+def degrees(matrix, weighted=False):
+    """節点ごとのリンク数(列ごとの0でない要素の数)。weighted なら重みの合計(ノック77の sum と同じ)"""
+    values, _, cols = _matrix(matrix)
+    if hasattr(values, "tocsc"):
+        values = values.tocsc()
+        result = np.asarray(values.sum(axis=0)).ravel() if weighted else np.diff(values.indptr)
+    else:
+        result = np.nansum(values, axis=0) if weighted else np.count_nonzero(np.nan_to_num(values), axis=0)
+    return pd.Series(result, index=cols)
+
+
+def degree_distribution(matrix, bins=10, range=None, weighted=False):
+    """リンク数のヒストグラム(plt.hist と同じ区切り)を、区間→人数の Series で返す"""
+    counts, edges = np.histogram(degrees(matrix, weighted).to_numpy(), bins=bins, range=range)
+    return pd.Series(counts, index=pd.IntervalIndex.from_breaks(edges, closed="left"))
+
+
+def positions(df_pos):
+    """ノック55・57の network_pos.csv / trans_route_pos.csv(列が節点、1行目がx、2行目がy)を節点→座標にする"""
+    return {name: (df_pos[name].iloc[0], df_pos[name].iloc[1]) for name in df_pos.columns}
+
+
+def layout(edges, seed=0):
+    """節点の座標の配列。節点が少なければ spring_layout、多ければ疎行列の固有ベクトルで並べる"""
+    import networkx as nx
+    G = nx.Graph()
+    G.add_nodes_from(range(len(edges.nodes)))
+    G.add_edges_from(zip(edges.source.tolist(), edges.target.tolist()))
+    if len(edges.nodes) <= MAX_SPRING:
+        pos = nx.spring_layout(G, seed=seed)
+    else:
+        pos = nx.spectral_layout(G)
+    return np.array([pos[i] for i in range(len(edges.nodes))])
+
+
+def _coordinates(edges, pos, seed):
+    if pos is None:
+        return layout(edges, seed)
+    if isinstance(pos, dict):
+        return np.array([pos.get(node, pos.get(str(node))) for node in edges.nodes], dtype=np.float64)
+    return np.asarray(pos, dtype=np.float64)
+
+
+def bundle(edges, xy, grid=64):
+    """座標を grid×grid のマスに分け、同じマスの組を結ぶ辺を1本にまとめる
+
+    戻り値は (始点の座標, 終点の座標, まとめた本数)。座標はマスに入っている節点の重心。
+    """
+    low, high = xy.min(axis=0), xy.max(axis=0)
+    cell_xy = np.floor((xy - low) / np.where(high > low, high - low, 1) * (grid - 1e-9)).astype(np.int64)
+    cell = cell_xy[:, 0] * grid + cell_xy[:, 1]
+    cells, cell = np.unique(cell, return_inverse=True)
+    counts = np.bincount(cell, minlength=len(cells))
+    center = np.column_stack([np.bincount(cell, weights=xy[:, i]) for i in (0, 1)]) / counts[:, None]
+    a, b = cell[edges.source], cell[edges.target]
+    low_cell, high_cell = np.minimum(a, b), np.maximum(a, b)
+    keep = low_cell != high_cell
+    pairs, n = np.unique(low_cell[keep] * len(cells) + high_cell[keep], return_counts=True)
+    return center[pairs // len(cells)], center[pairs % len(cells)], n
+
+
+def draw(edges, pos=None, ax=None, mode="auto", width=None, max_edges=MAX_EDGES, grid=64, node_size=None,
+         node_color="k", edge_color="k", labels=None, font_color="w", font_size=None, seed=0):
+    """Edges を matplotlib で描く
+
+    mode: "full" は全ての辺、"decimate" は max_edges 本まで無作為に間引く、
+          "bundle" は近くの節点をまとめて束ねた辺(本数に応じた太さ)で、本数の多い束から max_edges 本まで描く。
+          "auto" は辺が max_edges を超えたら bundle
+    width: 辺ごとの太さ(ノック55の edge_weights など)。bundle では使わない
+    labels: 節点の名前を描くかどうか。既定は MAX_LABELS 以下のときだけ描く
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    if ax is None:
+        ax = plt.gca()
+    xy = _coordinates(edges, pos, seed)
+    n_nodes, n_edges = len(edges.nodes), len(edges.source)
+    if mode == "auto":
+        mode = "full" if n_edges <= max_edges else "bundle"
+    if width is None:
+        width = np.ones(n_edges)
+    width = np.broadcast_to(np.asarray(width, dtype=np.float64), (n_edges,))
+    if mode == "bundle":
+        start, end, n = bundle(edges, xy, grid)
+        if len(n) > max_edges:
+            # 束ねても多すぎるときは、本数の多い束から max_edges 本だけ描く
+            top = np.argsort(n, kind="stable")[-max_edges:]
+            start, end, n = start[top], end[top], n[top]
+        segments = np.stack([start, end], axis=1)
+        linewidths = 0.2 + np.log1p(n) / np.log1p(max(n.max(), 1)) * 3 if len(n) else []
+        alpha = 0.5
+    else:
+        index = np.arange(n_edges)
+        if mode == "decimate" and n_edges > max_edges:
+            index = np.sort(np.random.default_rng(seed).choice(n_edges, max_edges, replace=False))
+        segments = np.stack([xy[edges.source[index]], xy[edges.target[index]]], axis=1)
+        linewidths = width[index]
+        alpha = 1.0 if n_edges <= max_edges else 0.3
+    ax.add_collection(LineCollection(segments, linewidths=linewidths, colors=edge_color, alpha=alpha, zorder=1))
+    if node_size is None:
+        node_size = 1000 if n_nodes <= 20 else max(1.0, 300.0 / np.sqrt(n_nodes))
+    ax.scatter(xy[:, 0], xy[:, 1], s=node_size, c=node_color, zorder=2, linewidths=0)
+    if labels is None:
+        labels = n_nodes <= MAX_LABELS
+    if labels:
+        for node, (x, y) in zip(edges.nodes, xy):
+            ax.text(x, y, str(node), color=font_color, fontsize=font_size or (16 if n_nodes <= 20 else 8),
+                    ha="center", va="center", zorder=3)
+    ax.margins(0.1)
+    ax.autoscale_view()
+    ax.set_axis_off()
+    return ax
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# ノックごとの実行時間・行数・メモリを記録する
+#
+# 1〜3章の .py やノートブックは上から順に書かれた1続きのコードなので、
+# 本番の規模で遅くなったときに、どのノックが原因なのか分からない。
+# ここではノックごとに次の値を測り、JSON Lines か Chrome のトレース形式(chrome://tracing や
+# Perfetto で開ける)で書き出す。
+#   wall_seconds / cpu_seconds : 経過時間とCPU時間
+#   rows_in / rows_out         : 受け取った表と作った表の行数
+#   memory_in / memory_out     : 受け取った表と作った表のメモリ使用量(バイト)
+#   memory_before / memory_after : スクリプトを区切って実行したときの、前後の全ての表のメモリ使用量
+#   profile                    : cProfile の結果(.prof)と時間のかかった関数の上位
+#   alloc_peak / alloc_top     : tracemalloc で測った、ノックの開始時から増えた確保量の最大値と、確保の多い行の上位
+#                                (Python 3.8 では入れ子のノックの最大値が外側のノックの分を含むことがある)
+# 記録を有効にしていないときは、knock() は何もしない共通のオブジェクトを返すだけなので、
+# ノートブックに書いたままにしておいても速度は変わらない。
+#
+# 使い方:
+#   from common.instrument import enable, knock, traced
+#   enable("trace.jsonl")                                 # 環境変数 KNOCK_TRACE=trace.jsonl でもよい
+#   with knock("ノック28", customer_join) as k:
+#       ...                                                # 本のコード
+#       k.output(customer_join)
+#
+#   @traced("ノック58")
+#   def trans_cost(df_tr, df_tc): ...
+#
+# スクリプトやノートブックを、コードを変えずにノックごとに区切って測ることもできる:
+#   python -m common.instrument 3章/3章_顧客の全体像を把握する１０本ノック.py --trace trace.json --profile cprofile
+
+import argparse
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+PROFILERS = ("cprofile", "tracemalloc")
+TOP = 10
+
+_tracer = None
+
+
+def _frames(objs):
+    """引数の中の DataFrame / Series を取り出す(リスト・タプル・辞書の中も見る)"""
+    found = []
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif hasattr(obj, "memory_usage") and hasattr(obj, "index"):
+            found.append(obj)
+    return found
+
+
+def frame_stats(objs, deep=True):
+    """DataFrame / Series の行数の合計とメモリ使用量の合計"""
+    rows, memory = 0, 0
+    seen = set()
+    for frame in _frames(objs):
+        if id(frame) in seen:
+            continue
+        seen.add(id(frame))
+        rows += len(frame)
+        usage = frame.memory_usage(deep=deep)
+        memory += int(usage.sum() if hasattr(usage, "sum") else usage)
+    return rows, memory
+
+
+class Tracer(object):
+    """ノックごとの記録を書き出す
+
+    path     : 出力先。拡張子が .json なら Chrome のトレース形式、それ以外は JSON Lines
+    fmt      : "jsonl" か "chrome"。指定すると拡張子より優先する
+    profile  : "cprofile" / "tracemalloc" またはその組(重いので必要なときだけ)
+    deep     : メモリ使用量を文字列の中身まで数えるか(memory_usage の deep)
+    """
+
+    def __init__(self, path, fmt=None, profile=(), deep=True, profile_dir=None):
+        if isinstance(profile, str):
+            profile = (profile,)
+        unknown = [p for p in profile if p not in PROFILERS]
+        if unknown:
+            raise ValueError("未対応のプロファイラです: " + ", ".join(unknown))
+        self.path = path
+        self.fmt = fmt or ("chrome" if path.endswith(".json") else "jsonl")
+        self.profile = tuple(profile)
+        self.deep = deep
+        self.profile_dir = profile_dir or os.path.splitext(path)[0] + "_profile"
+        self.events = []
+        self.count = 0
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.profiling = False
+        # tracemalloc で測っている入れ子のノック(外側から順)
+        self.alloc_stack = []
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "w", encoding="utf-8") if self.fmt == "jsonl" else None
+
+    def record(self, event):
+        with self.lock:
+            self.count += 1
+            if self.file is not None:
+                self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+                self.file.flush()
+            else:
+                self.events.append(event)
+
+    def profile_path(self, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        safe = re.sub(r"[^\w\-]+", "_", name)
+        return os.path.join(self.profile_dir, "{:03d}_{}.prof".format(self.count + 1, safe))
+
+    def chrome_events(self):
+        events = []
+        for event in self.events:
+            args = {k: v for k, v in event.items() if k not in ("name", "chapter", "start", "pid", "tid")}
+            events.append({"name": event["name"], "cat": event.get("chapter") or "knock", "ph": "X",
+                           "ts": event["start"] * 1e6, "dur": event["wall_seconds"] * 1e6,
+                           "pid": event["pid"], "tid": event["tid"], "args": args})
+        return events
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        elif self.fmt == "chrome":
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.chrome_events(), "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+
+class _NullKnock(object):
+    """記録しないときの knock()。何もしない"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, *objs):
+        pass
+
+
+_NULL = _NullKnock()
+
+
+def _reset_peak():
+    """tracemalloc の最大値を今の確保量に戻す
+
+    reset_peak のない Python 3.8 では何もしない(記録を消すと外側のノックの分も消えるため)。
+    そのときの最大値は、外側のノックでそれより前に確保した分を含むことがある。
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+
+class Knock(object):
+    """1つのノックの記録"""
+
+    def __init__(self, tracer, name, inputs=(), chapter=None, scope=None):
+        self.tracer = tracer
+        self.name = name
+        self.inputs = inputs
+        self.chapter = chapter
+        self.scope = scope
+        self.outputs = None
+        self.extra = {}
+
+    def output(self, *objs):
+        """ノックで作った表を渡す(行数とメモリ使用量を記録する)"""
+        self.outputs = objs
+
+    def __enter__(self):
+        tracer = self.tracer
+        self.rows_in, self.memory_in = frame_stats(self.inputs, tracer.deep)
+        if self.scope is not None:
+            self.extra["memory_before"] = frame_stats(self.scope(), tracer.deep)[1]
+        self.profiler = None
+        if "cprofile" in tracer.profile and not tracer.profiling:
+            # cProfile は入れ子にできないので、外側のノックだけで取る
+            tracer.profiling = True
+            self.profiler = cProfile.Profile()
+        self.snapshot = None
+        if "tracemalloc" in tracer.profile:
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            if tracer.alloc_stack:
+                # 内側のノックで最大値を戻す前に、外側のノックのここまでの最大値を覚えておく
+                outer = tracer.alloc_stack[-1]
+                outer.alloc_peak = max(outer.alloc_peak, tracemalloc.get_traced_memory()[1])
+            _reset_peak()
+            # 最大値は確保量の合計で持ち、記録するときにノックの開始時の確保量を引く
+            self.alloc_base = tracemalloc.get_traced_memory()[0]
+            self.alloc_peak = 0
+            tracer.alloc_stack.append(self)
+            self.snapshot = tracemalloc.take_snapshot()
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        tracer = self.tracer
+        event = {"name": self.name, "chapter": self.chapter, "start": self.start - tracer.origin,
+                 "wall_seconds": wall, "cpu_seconds": cpu, "rows_in": self.rows_in, "memory_in": self.memory_in,
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if self.outputs is not None:
+            event["rows_out"], event["memory_out"] = frame_stats(self.outputs, tracer.deep)
+        if self.scope is not None:
+            event["memory_after"] = frame_stats(self.scope(), tracer.deep)[1]
+        if self.snapshot is not None:
+            peak = max(self.alloc_peak, tracemalloc.get_traced_memory()[1])
+            event["alloc_peak"] = max(0, peak - self.alloc_base)
+            if tracer.alloc_stack and tracer.alloc_stack[-1] is self:
+                tracer.alloc_stack.pop()
+            if tracer.alloc_stack:
+                outer = tracer.alloc_stack[-1]
+                outer.alloc_peak = max(outer.alloc_peak, peak)
+            diff = tracemalloc.take_snapshot().compare_to(self.snapshot, "lineno")
+            event["alloc_top"] = [[str(stat.traceback), stat.size_diff] for stat in diff[:TOP]]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        if self.profiler is not None:
+            tracer.profiling = False
+            path = tracer.profile_path(self.name)
+            self.profiler.dump_stats(path)
+            event["profile"] = path
+            event["profile_top"] = _profile_top(self.profiler)
+        if exc_type is not None:
+            event["error"] = "{}: {}".format(exc_type.__name__, exc)
+        event.update(self.extra)
+        tracer.record(event)
+        return False
+
+
+def _profile_top(profiler, n=TOP):
+    """累積時間の長い関数の上位 [関数, 呼び出し回数, 自身の時間, 累積時間]"""
+    stats = pstats.Stats(profiler).stats
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in stats.items():
+        rows.append(["{}:{}({})".format(os.path.basename(filename), line, func), nc, tt, ct])
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows[:n]
+
+
+def enable(path, fmt=None, profile=(), deep=True, profile_dir=None):
+    """記録を始める。プロセスの終了時に自動で閉じる"""
+    global _tracer
+    disable()
+    _tracer = Tracer(path, fmt, profile, deep, profile_dir)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def get_tracer():
+    return _tracer
+
+
+def knock(name, *inputs, chapter=None):
+    """ノック1つ分を囲む with 文。inputs にはノックで使う表を渡す"""
+    if _tracer is None:
+        return _NULL
+    return Knock(_tracer, name, inputs, chapter)
+
+
+def traced(name=None, chapter=None):
+    """関数をノックとして記録するデコレータ。引数の表を入力、戻り値を出力として数える"""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Knock(_tracer, label, (args, kwargs), chapter) as k:
+                result = func(*args, **kwargs)
+                k.output(result)
+                return result
+        return wrapper
+    return decorate
+
+
+# --------------------------------------------------------------------------------------
+# スクリプト・ノートブックをノックごとに区切って実行する
+# --------------------------------------------------------------------------------------
+
+KNOCK_HEADER = re.compile(r"^#+\s*(ノック[0-9０-９]+)")
+PREAMBLE = "準備"
+
+
+def _section_title(markdown):
+    match = KNOCK_HEADER.match(markdown.strip())
+    return match.group(1) if match else None
+
+
+def split_knocks(path):
+    """jupytext の .py かノートブックを、ノックの見出しごとに [(ノック名, コード)] に分ける
+
+    最初の見出しより前のコード(警告の非表示など)は「準備」とする。
+    ノートブックの %matplotlib などのマジックと ! のシェルコマンドは取り除く。
+    """
+    sections = [[PREAMBLE, []]]
+    if path.endswith(".ipynb"):
+        with open(path, encoding="utf-8") as f:
+            cells = json.load(f)["cells"]
+        for cell in cells:
+            source = "".join(cell["source"])
+            if cell["cell_type"] == "markdown":
+                title = _section_title(source)
+                if title:
+                    sections.append([title, []])
+            elif cell["cell_type"] == "code":
+                lines = [line for line in source.splitlines() if not line.lstrip().startswith(("%", "!"))]
+                sections[-1][1].append("\n".join(lines))
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                # jupytext では見出しが「# ### ノック１：...」というコメントになる
+                title = _section_title(line[1:]) if line.startswith("# ") else None
+                if title:
+                    sections.append([title, []])
+                else:
+                    sections[-1][1].append(line.rstrip("\n"))
+    return [(title, "\n".join(code)) for title, code in sections if "\n".join(code).strip()]
+
+
+def _namespace_frames(namespace):
+    return {name: obj for name, obj in namespace.items()
+            if not name.startswith("_") and _frames([obj])}
+
+
+def run_section(title, code, namespace, chapter=None, filename="<knock>"):
+    """1つのノックのコードを namespace で実行して記録する
+
+    入力は、コードの中で名前が使われている実行前の表。出力は、実行後に新しく作られたか
+    置き換えられた表。memory_in / memory_out は namespace にある全ての表の合計。
+    """
+    compiled = compile(code, "{}:{}".format(filename, title), "exec")
+    if _tracer is None:
+        exec(compiled, namespace)
+        return
+    before = _namespace_frames(namespace)
+    names = set(re.findall(r"\w+", code))
+    inputs = [obj for name, obj in before.items() if name in names]
+    k = Knock(_tracer, title, inputs, chapter, scope=lambda: list(_namespace_frames(namespace).values()))
+    with k:
+        try:
+            exec(compiled, namespace)
+        finally:
+            after = _namespace_frames(namespace)
+            changed = sorted(name for name, obj in after.items() if before.get(name) is not obj)
+            k.output([after[name] for name in changed])
+            k.extra["outputs"] = changed
+
+
+def run_script(path, knocks=None, chapter=None, cwd=None):
+    """スクリプトかノートブックをノックごとに実行する。knocks を指定するとそこまで実行して止める
+
+    cwd を指定しなければスクリプトのあるフォルダで実行する(ノートブックと同じく相対パスでCSVを読むため)。
+    """
+    path = os.path.abspath(path)
+    sections = split_knocks(path)
+    if chapter is None:
+        chapter = os.path.basename(os.path.dirname(path))
+    namespace = {"__name__": "__main__", "__file__": path}
+    last = None
+    if knocks:
+        titles = [title for title, _ in sections]
+        found = [titles.index(title) for title in knocks if title in titles]
+        if not found:
+            raise ValueError("ノックが見つかりません: " + ", ".join(knocks))
+        last = max(found)
+    old = os.getcwd()
+    os.chdir(cwd or os.path.dirname(path))
+    try:
+        for i, (title, code) in enumerate(sections):
+            run_section(title, code, namespace, chapter, os.path.basename(path))
+            if last is not None and i >= last:
+                break
+    finally:
+        os.chdir(old)
+    return namespace
+
+
+def _normalize_digits(title):
+    return title.translate(str.maketrans("0123456789", "０１２３４５６７８９"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スクリプト・ノートブックをノックごとに測って記録する")
+    parser.add_argument("script", help="jupytext の .py かノートブック(.ipynb)")
+    parser.add_argument("--trace", default="trace.jsonl", help="出力先(.json なら Chrome のトレース形式)")
+    parser.add_argument("--format", choices=["jsonl", "chrome"], default=None)
+    parser.add_argument("--profile", nargs="*", default=[], choices=list(PROFILERS))
+    parser.add_argument("--shallow", action="store_true", help="文字列の中身をメモリ使用量に数えない")
+    parser.add_argument("--until", default=None, help="このノックまで実行する(例: ノック28)")
+    parser.add_argument("--cwd", default=None, help="データを読むフォルダ(既定はスクリプトのフォルダ)")
+    args = parser.parse_args(argv)
+    # グラフはファイルにも画面にも出さない
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    enable(args.trace, args.format, args.profile, not args.shallow)
+    knocks = [args.until, _normalize_digits(args.until)] if args.until else None
+    try:
+        run_script(args.script, knocks, cwd=args.cwd)
+    finally:
+        disable()
+
+
+atexit.register(disable)
+
+if os.environ.get("KNOCK_TRACE"):
+    enable(os.environ["KNOCK_TRACE"], profile=[p for p in os.environ.get("KNOCK_PROFILE", "").split(",") if p])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# 会員の在籍期間(start_date〜end_date)の索引
+#
+# ノック24では end_date >= 20190331 または end_date が欠損、という条件を全行に対して計算して在籍中の会員を数え、
+# 4・5章でも月ごとに start_date / end_date と比べて在籍しているかを調べている。
+# 複数年の毎日について「その日に在籍していた会員」を求めると、日数×会員数の比較になる。
+# ここでは入会日と退会日をそれぞれ並べ替えた配列を1度だけ作り、二分探索で数える。
+#   ある日の在籍数 = (入会日 <= その日 の人数) - (退会日 < その日 の人数)
+# 1回の問い合わせは O(log n)。会員区分・キャンペーン区分・性別ごとの配列も作っておくので、内訳も同じ手間で出せる。
+# 退会日は在籍の最終日として扱う(ノック24と同じく end_date 当日は在籍に数える)。end_date の欠損は在籍中。
+#
+# 使い方:
+#   from common.membership import MembershipIndex
+#   index = MembershipIndex(customer_join)
+#   index.active("2019-03-31")                          # ノック24: 在籍中の会員数
+#   index.active("2019-03-31", by="class_name")         # 会員区分ごとの在籍数
+#   index.joins("2018-04-01", "2019-03-31")             # 期間中の入会数
+#   index.leavers("2018-04-01", "2019-03-31", by="gender")
+#   index.active_series("2015-05-01", "2019-04-30")     # 毎日の在籍数を一度に
+
+import numpy as np
+import pandas as pd
+
+DIMENSIONS = ("class_name", "campaign_name", "gender")
+# 退会日がない(在籍中)の会員の退会日として使う値
+FOREVER = np.datetime64("2262-04-11", "D")
+
+
+def _day(date):
+    return np.datetime64(pd.Timestamp(date).date(), "D")
+
+
+def _days(dates):
+    """日付の列を日単位の datetime64 の配列にする。欠損は FOREVER"""
+    values = pd.to_datetime(pd.Series(dates)).dt.normalize()
+    return values.fillna(pd.Timestamp(FOREVER)).values.astype("datetime64[D]")
+
+
+class _Intervals(object):
+    """入会日と退会日をそれぞれ並べ替えた配列"""
+
+    def __init__(self, start, end):
+        self.start = np.sort(start)
+        self.end = np.sort(end)
+
+    def __len__(self):
+        return len(self.start)
+
+    def active(self, days):
+        return np.searchsorted(self.start, days, side="right") - np.searchsorted(self.end, days, side="left")
+
+    def joins(self, first, last):
+        return np.searchsorted(self.start, last, side="right") - np.searchsorted(self.start, first, side="left")
+
+    def leavers(self, first, last):
+        return np.searchsorted(self.end, last, side="right") - np.searchsorted(self.end, first, side="left")
+
+
+class MembershipIndex(object):
+    """会員の在籍期間に対する、ある日・ある期間の人数の問い合わせ
+
+    customers : customer_join のように start_date / end_date を持つ表
+    by        : 内訳を出せるようにしておく列(存在する列だけ使う)
+    """
+
+    def __init__(self, customers, start="start_date", end="end_date", by=DIMENSIONS, id_column="customer_id"):
+        self.start = _days(customers[start])
+        self.end = _days(customers[end])
+        self.ids = customers[id_column].values if id_column in customers else np.arange(len(customers))
+        self.all = _Intervals(self.start, self.end)
+        # 入会日順の並びを持っておき、在籍中の会員の一覧を出すときに使う
+        self.by_start = np.argsort(self.start, kind="stable")
+        self.groups = {}
+        for column in by:
+            if column not in customers:
+                continue
+            codes, values = pd.factorize(customers[column], sort=True)
+            self.groups[column] = [(value, _Intervals(self.start[codes == i], self.end[codes == i]))
+                                   for i, value in enumerate(values)]
+
+    def __len__(self):
+        return len(self.all)
+
+    def _query(self, by, func):
+        if by is None:
+            return func(self.all)
+        if by not in self.groups:
+            raise KeyError("索引を作るときに by に指定していない列です: " + by)
+        return pd.Series({value: func(intervals) for value, intervals in self.groups[by]}, name=by)
+
+    def active(self, date, by=None):
+        """date に在籍していた会員数(by を指定すると内訳の Series)"""
+        day = _day(date)
+        return self._query(by, lambda iv: int(iv.active(day)))
+
+    def joins(self, first, last, by=None):
+        """first〜last(両端を含む)に入会した会員数"""
+        first, last = _day(first), _day(last)
+        return self._query(by, lambda iv: int(iv.joins(first, last)))
+
+    def leavers(self, first, last, by=None):
+        """first〜last(両端を含む)が退会日(在籍の最終日)の会員数"""
+        first, last = _day(first), _day(last)
+        return self._query(by, lambda iv: int(iv.leavers(first, last)))
+
+    def active_ids(self, date):
+        """date に在籍していた会員の ID。入会日が date 以前の会員だけを見る"""
+        day = _day(date)
+        candidates = self.by_start[:np.searchsorted(self.start[self.by_start], day, side="right")]
+        return self.ids[candidates[self.end[candidates] >= day]]
+
+    def active_series(self, first, last, freq="D", by=None):
+        """first〜last の日付(freq 刻み)ごとの在籍数を、並べ替えた配列との二分探索でまとめて求める
+
+        by を指定すると、列が内訳の値の表を返す。
+        """
+        dates = pd.date_range(first, last, freq=freq)
+        days = dates.values.astype("datetime64[D]")
+        if by is None:
+            return pd.Series(self.all.active(days), index=dates, name="active")
+        if by not in self.groups:
+            raise KeyError("索引を作るときに by に指定していない列です: " + by)
+        return pd.DataFrame({value: intervals.active(days) for value, intervals in self.groups[by]}, index=dates)
+
+    def flow_series(self, first, last, freq="MS"):
+        """期間(freq 刻み)ごとの入会数・退会数・期末の在籍数"""
+        edges = pd.date_range(first, last, freq=freq)
+        starts = edges.values.astype("datetime64[D]")
+        ends = np.append(starts[1:] - np.timedelta64(1, "D"), _day(last))
+        return pd.DataFrame({"joins": self.all.joins(starts, ends), "leavers": self.all.leavers(starts, ends),
+                             "active": self.all.active(ends)}, index=edges)
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# 章をまたいで使う加工済みデータを、入力が変わったときだけ作り直す
+#
+# 3章で作る customer_join.csv は4・5章で使われ、5章の use_log_months.csv は4章で use_log から作り直している。
+# どちらも手作業で作り直したり読み直したりしているので、元のデータが変わっても古いまま使われることがある。
+# ここでは加工済みのデータを「入力と作り方を持つノード」として宣言し、結果を保存しておく。
+# - ノードのキーは、作り方(関数のソース)と入力の内容のハッシュ。キーが同じなら保存した結果を使う
+# - 結果の内容のハッシュを次のノードのキーに使うので、作り直しても結果が同じなら下流は作り直さない
+# - use_log のような大きな履歴は月ごとに分けて作り、新しい月(内容の変わった月)の分だけを計算する
+# - 依存関係のないノード(会員の結合と利用履歴の集計など)はプロセスプールで並行に計算する
+#
+# 使い方:
+#   from common.pipeline import gym_pipeline
+#   pipeline = gym_pipeline(root="synthetic/x10")       # 3章のフォルダのCSVを元にする
+#   pipeline.build(["customer_join"], workers=4)          # ノードごとの状態と時間の表を返す
+#   customer_join = pipeline.load("customer_join")
+# コマンドから(python_data_analyze のフォルダで):
+#   python -m common.pipeline --root synthetic/x10 --workers 4 --export synthetic/x10
+
+import argparse
+import concurrent.futures
+import hashlib
+import inspect
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORE_DIR = os.path.join(BASE_DIR, ".pipeline")
+
+
+def frame_hash(df, index=True):
+    """DataFrame の内容(列名・型・値。index=True ならインデックスも)のハッシュ"""
+    h = hashlib.sha1()
+    h.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=index).values.tobytes())
+    return h.hexdigest()
+
+
+def file_hash(path, block=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def code_hash(func):
+    """関数の作り方のハッシュ。ソースが取れないときは名前で代用する"""
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = getattr(func, "__module__", "") + "." + getattr(func, "__qualname__", repr(func))
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def _key(*parts):
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _write(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    df.to_pickle(tmp)
+    os.replace(tmp, path)
+    return frame_hash(df)
+
+
+# プロセスプールで実行する処理(pickle で渡せるように関数はモジュールの先頭に置く)
+
+def _run_source(read, path, out):
+    start = time.perf_counter()
+    return _write(read(path), out), time.perf_counter() - start
+
+
+def _run_node(func, inputs, out):
+    start = time.perf_counter()
+    return _write(func(*[pd.read_pickle(p) for p in inputs]), out), time.perf_counter() - start
+
+
+def _run_part(func, part, out):
+    start = time.perf_counter()
+    _write(func(part), out)
+    return time.perf_counter() - start
+
+
+def read_csv(path):
+    return pd.read_csv(path, encoding="utf-8-sig")
+
+
+class Pipeline(object):
+    """加工済みデータのノードと、その結果の保存先
+
+    store : 結果と manifest.json を置くフォルダ
+    """
+
+    def __init__(self, store=STORE_DIR):
+        self.store = store
+        self.nodes = {}
+        self.order = []
+        self.manifest_path = os.path.join(store, "manifest.json")
+        self.manifest = {"sources": {}, "nodes": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def source(self, name, path, read=read_csv):
+        """元データ(CSVなど)のノード。ファイルの内容が変わったら読み直す"""
+        self._add(name, {"kind": "source", "path": path, "read": read, "inputs": []})
+
+    def node(self, name, func, inputs, partition=None):
+        """func(*inputs) で作るノード
+
+        partition : 1つ目の入力を分ける関数(df -> 分け方の列)。指定すると分けた単位ごとに
+                    func(部分) を計算して保存し、内容の変わった部分だけを計算し直して縦に繋げる
+        """
+        missing = [name_ for name_ in inputs if name_ not in self.nodes]
+        if missing:
+            raise KeyError("{} の入力が宣言されていません: {}".format(name, ", ".join(missing)))
+        if partition is not None and len(inputs) != 1:
+            raise ValueError("分けて計算するノードの入力は1つにしてください: " + name)
+        self._add(name, {"kind": "node", "func": func, "inputs": list(inputs), "partition": partition,
+                         "code": code_hash(func) + (code_hash(partition) if partition else "")})
+
+    def _add(self, name, spec):
+        if name in self.nodes:
+            raise ValueError("同じ名前のノードがあります: " + name)
+        self.nodes[name] = spec
+        self.order.append(name)
+
+    def path(self, name):
+        return os.path.join(self.store, name + ".pkl")
+
+    def _part_path(self, name, key):
+        return os.path.join(self.store, name, key + ".pkl")
+
+    def load(self, name):
+        if name not in self.manifest["nodes"] or not os.path.exists(self.path(name)):
+            raise KeyError(name + " はまだ作られていません。build() を実行してください")
+        return pd.read_pickle(self.path(name))
+
+    def export(self, name, path, **kwargs):
+        """結果を CSV に書き出す(ノートブックが読むファイルを作り直すとき)"""
+        df = self.load(name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = path + ".tmp"
+        df.to_csv(tmp, **dict({"index": False}, **kwargs))
+        os.replace(tmp, path)
+
+    def _needed(self, targets):
+        needed, stack = set(), list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in self.nodes:
+                raise KeyError("宣言されていないノードです: " + name)
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.nodes[name]["inputs"])
+        return [name for name in self.order if name in needed]
+
+    def _source_hash(self, name, path):
+        """ファイルの大きさと更新時刻が前回と同じなら、前回のハッシュを使う"""
+        stat = os.stat(path)
+        cached = self.manifest["sources"].get(name)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns \
+                and cached["path"] == os.path.abspath(path):
+            return cached["hash"]
+        digest = file_hash(path)
+        self.manifest["sources"][name] = {"path": os.path.abspath(path), "size": stat.st_size,
+                                          "mtime_ns": stat.st_mtime_ns, "hash": digest}
+        return digest
+
+    def _save_manifest(self):
+        os.makedirs(self.store, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def build(self, targets=None, workers=None):
+        """targets(既定は全て)と、その上流のノードのうち入力が変わったものだけを作り直す
+
+        戻り値はノードごとの status(cached / computed)、計算した部分の数、かかった時間の表。
+        """
+        names = self._needed(targets or self.order)
+        workers = workers or os.cpu_count() or 1
+        executor = None
+        if workers > 1:
+            ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+            executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx)
+        try:
+            return self._schedule(names, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._save_manifest()
+
+    def _submit(self, executor, fn, *args):
+        if executor is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return executor.submit(fn, *args)
+
+    def _schedule(self, names, executor):
+        hashes, report = {}, {}
+        pending = {}   # future -> (ノード名, 部分のキー または None)
+        parts_left = {}
+        waiting = list(names)
+        start = time.perf_counter()
+        while waiting or pending:
+            for name in list(waiting):
+                spec = self.nodes[name]
+                if any(i not in hashes for i in spec["inputs"]):
+                    continue
+                waiting.remove(name)
+                self._start(name, spec, hashes, report, pending, parts_left, executor)
+            if not pending:
+                if waiting:
+                    raise RuntimeError("ノードの依存関係が循環しています: " + ", ".join(waiting))
+                break
+            done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, part = pending.pop(future)
+                result = future.result()
+                if part is None:
+                    digest, seconds = result
+                    self._finish(name, digest, hashes, report, seconds)
+                    continue
+                report[name]["seconds"] += result
+                parts_left[name].discard(part)
+                if not parts_left[name]:
+                    self._combine(name, hashes, report)
+        for name in report:
+            report[name]["elapsed"] = report[name].pop("finished", 0) - start
+        return pd.DataFrame([dict(node=name, **report[name]) for name in names if name in report])
+
+    def _start(self, name, spec, hashes, report, pending, parts_left, executor):
+        entry = self.manifest["nodes"].get(name)
+        if spec["kind"] == "source":
+            key = _key("source", self._source_hash(name, spec["path"]))
+        else:
+            key = _key(spec["code"], *[hashes[i] for i in spec["inputs"]])
+        report[name] = {"status": "cached", "parts": 0, "parts_computed": 0, "seconds": 0.0}
+        if entry and entry["key"] == key and os.path.exists(self.path(name)):
+            hashes[name] = entry["hash"]
+            report[name]["finished"] = time.perf_counter()
+            return
+        report[name]["status"] = "computed"
+        report[name]["key"] = key
+        if spec["kind"] == "source":
+            future = self._submit(executor, _run_source, spec["read"], spec["path"], self.path(name))
+            pending[future] = (name, None)
+        elif spec["partition"] is None:
+            inputs = [self.path(i) for i in spec["inputs"]]
+            future = self._submit(executor, _run_node, spec["func"], inputs, self.path(name))
+            pending[future] = (name, None)
+        else:
+            self._start_parts(name, spec, report, pending, parts_left, executor)
+
+    def _start_parts(self, name, spec, report, pending, parts_left, executor):
+        """入力を分け、保存していない部分だけを計算に回す"""
+        df = pd.read_pickle(self.path(spec["inputs"][0]))
+        keys = pd.Series(np.asarray(spec["partition"](df)), index=df.index)
+        parts = []
+        for value, index in keys.groupby(keys, sort=True).groups.items():
+            # 行のラベルは前の月の行数で変わるので、キーには値だけを使う
+            part = df.loc[index].reset_index(drop=True)
+            parts.append((_key(spec["code"], str(value), frame_hash(part, index=False)), part))
+        report[name]["parts"] = len(parts)
+        report[name]["part_keys"] = [key for key, _ in parts]
+        parts_left[name] = set()
+        for key, part in parts:
+            path = self._part_path(name, key)
+            if os.path.exists(path):
+                continue
+            parts_left[name].add(key)
+            report[name]["parts_computed"] += 1
+            pending[self._submit(executor, _run_part, spec["func"], part, path)] = (name, key)
+        if not parts_left[name]:
+            # 全ての部分が保存済み(並び替えや削除だけの変更)なら、繋げ直すだけ
+            pending[self._submit(None, self._combine_parts, name, report[name]["part_keys"])] = (name, None)
+
+    def _combine_parts(self, name, part_keys):
+        start = time.perf_counter()
+        frames = [pd.read_pickle(self._part_path(name, key)) for key in part_keys]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        digest = _write(df, self.path(name))
+        # 今回使わなかった部分は消す
+        folder = os.path.join(self.store, name)
+        used = set(key + ".pkl" for key in part_keys)
+        for filename in os.listdir(folder) if os.path.isdir(folder) else []:
+            if filename.endswith(".pkl") and filename not in used:
+                os.remove(os.path.join(folder, filename))
+        return digest, time.perf_counter() - start
+
+    def _combine(self, name, hashes, report):
+        digest, seconds = self._combine_parts(name, report[name]["part_keys"])
+        self._finish(name, digest, hashes, report, seconds)
+
+    def _finish(self, name, digest, hashes, report, seconds):
+        hashes[name] = digest
+        info = report[name]
+        info.pop("part_keys", None)
+        info["seconds"] += seconds
+        info["finished"] = time.perf_counter()
+        self.manifest["nodes"][name] = {"key": info.pop("key"), "hash": digest}
+
+
+# --------------------------------------------------------------------------------------
+# 3〜5章 スポーツジムの会員データ
+# --------------------------------------------------------------------------------------
+
+CALC_DATE = pd.Timestamp("2019-04-30")
+
+
+def use_month(use_log):
+    """利用日の年月(ノック25の「年月」)で分ける"""
+    return use_log["usedate"].astype(str).str[:7].str.replace("-", "", regex=False)
+
+
+def month_counts(use_log):
+    """ノック25/36: 年月・顧客ごとの利用回数(5章の use_log_months.csv と同じ形)"""
+    months = use_log.assign(年月=use_month(use_log))
+    months = months.groupby(["年月", "customer_id"], as_index=False).size()
+    return months.rename(columns={"size": "count"})
+
+
+def weekday_counts(use_log):
+    """ノック26の前半: 顧客・年月ごとに、同じ曜日に来た回数の最大"""
+    log = use_log.assign(年月=use_month(use_log), weekday=pd.to_datetime(use_log["usedate"]).dt.weekday)
+    counts = log.groupby(["customer_id", "年月", "weekday"]).size()
+    return counts.groupby(["customer_id", "年月"]).max().rename("count").reset_index()
+
+
+def customer_base(customer_master, class_master, campaign_master):
+    """ノック22: 会員データに会員区分とキャンペーン区分を結合する"""
+    df = pd.merge(customer_master, class_master, on="class", how="left")
+    return pd.merge(df, campaign_master, on="campaign_id", how="left")
+
+
+def customer_join(customer, uselog_months, uselog_weekday):
+    """ノック25〜28: 月ごとの利用回数の統計量・定期利用フラグ・会員期間を付ける"""
+    stats = uselog_months.groupby("customer_id")["count"].agg(["mean", "median", "max", "min"])
+    weekly = uselog_weekday.groupby("customer_id")["count"].max()
+    df = customer.merge(stats, left_on="customer_id", right_index=True, how="left")
+    df["routine_flg"] = (df["customer_id"].map(weekly).fillna(0) >= 4).astype(int)
+    start = pd.to_datetime(df["start_date"])
+    end = pd.to_datetime(df["end_date"])
+    calc = end.fillna(CALC_DATE)
+    # relativedelta(calc, start) の years*12+months と同じ値
+    period = (calc.dt.year - start.dt.year) * 12 + (calc.dt.month - start.dt.month) - (calc.dt.day < start.dt.day)
+    df["start_date"] = start.dt.strftime("%Y-%m-%d")
+    df["end_date"] = end.dt.strftime("%Y-%m-%d")
+    df["calc_date"] = calc.dt.strftime("%Y-%m-%d")
+    df["membership_period"] = period.astype(int)
+    return df
+
+
+def gym_pipeline(root=None, store=None):
+    """3章のCSVから customer_join と use_log_months を作るノード"""
+    folder = os.path.join(root or BASE_DIR, "3章")
+    pipeline = Pipeline(store or os.path.join(root or BASE_DIR, ".pipeline"))
+    for name in ("customer_master", "class_master", "campaign_master", "use_log"):
+        pipeline.source(name, os.path.join(folder, name + ".csv"))
+    pipeline.node("customer", customer_base, ["customer_master", "class_master", "campaign_master"])
+    pipeline.node("uselog_months", month_counts, ["use_log"], partition=use_month)
+    pipeline.node("uselog_weekday", weekday_counts, ["use_log"], partition=use_month)
+    pipeline.node("customer_join", customer_join, ["customer", "uselog_months", "uselog_weekday"])
+    return pipeline
+
+
+# 書き出すノードと、4・5章のノートブックが読むファイル
+EXPORTS = [("customer_join", "4章/customer_join.csv"), ("customer_join", "5章/customer_join.csv"),
+           ("uselog_months", "5章/use_log_months.csv")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="3章のデータから4・5章で使うデータを作る(変わった所だけ)")
+    parser.add_argument("--root", default=None, help="章のフォルダの親(既定は python_data_analyze)")
+    parser.add_argument("--store", default=None, help="結果の保存先(既定は {root}/.pipeline)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--export", default=None, help="指定したフォルダの4章・5章にCSVを書き出す")
+    args = parser.parse_args(argv)
+    pipeline = gym_pipeline(args.root, args.store)
+    with pd.option_context("display.width", 200):
+        print(pipeline.build(workers=args.workers).to_string(index=False))
+    if args.export:
+        for name, filename in EXPORTS:
+            pipeline.export(name, os.path.join(args.export, filename))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# 複数の列の組み合わせごとの集計(ロールアップ)を、表を1回なめるだけで作る
+#
+# ノック23では is_deleted・class_name・campaign_name・gender ごとに groupby(...).count() を4回呼び、
+# ノック24では最新の会員だけに絞った表で同じ集計をもう一度、4章のノック33・35では cluster ごとにまた集計している。
+# 列の組み合わせを変えるたびに会員の表全体を読み直すことになる。
+# ここでは
+# - 集計に使う列をカテゴリの番号(コード)にし、全ての列のコードを1つの整数にまとめる
+# - その整数ごとの件数・合計を np.bincount で1回だけ数える(空でない組み合わせだけの小さな表になる)
+# - 「在籍中の会員」のような絞り込みは 0/1 の列として同じ表に入れておく
+# どの列の組み合わせの集計も、この小さな表を足し合わせるだけで作れる。作った集計は覚えておき、次からはそのまま返す。
+#
+# 使い方:
+#   from common.rollup import Cube
+#   current = (customer_join["end_date"] >= pd.to_datetime("20190331")) | customer_join["end_date"].isna()
+#   cube = Cube(customer_join, ["is_deleted", "class_name", "campaign_name", "gender"], filters={"current": current})
+#   cube.count("class_name")                        # ノック23: groupby("class_name").count()["customer_id"]
+#   cube.count("class_name", where="current")       # ノック24: 最新の会員だけ
+#   cube.count("class_name", "gender")              # 2つの列の組み合わせ
+#   cube.grouping_sets([("class_name",), ("campaign_name",), ("gender",)])   # まとめて
+#   cube = Cube(customer_clustering, ["cluster", "is_deleted"], measures=["月内平均値", "会員期間"])
+#   cube.mean("cluster")                            # ノック33: groupby("cluster").mean()
+
+import itertools
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# まとめた整数がこれを超えるほど列の種類が多いときは、まとめずに列ごとのコードで数える
+_MAX_CELLS = 2 ** 62
+
+
+def _codes(values):
+    """列をコードとラベルにする。カテゴリ型はカテゴリの順、それ以外は値の順。欠損は -1"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.values.astype(np.int64), values.cat.categories
+    codes, labels = pd.factorize(values, sort=True)
+    return codes.astype(np.int64), labels
+
+
+class Cube(object):
+    """列の全ての組み合わせについての件数・合計を持つ表
+
+    df         : 集計する表
+    dimensions : 集計に使う列(カテゴリ型か、種類の少ない列)
+    measures   : 合計・平均を出す数値の列
+    filters    : 名前→行ごとの True/False。count などの where に名前を指定して絞り込む
+    """
+
+    def __init__(self, df, dimensions, measures=(), filters=None):
+        self.dimensions = list(dimensions)
+        self.measures = list(measures)
+        self.filters = list(filters or {})
+        self.labels = {}
+        columns = []
+        for name in self.dimensions:
+            codes, self.labels[name] = _codes(df[name])
+            columns.append(codes)
+        for name in self.filters:
+            columns.append(np.asarray(filters[name], dtype=bool).astype(np.int64))
+        # 欠損(-1)も1つの種類として数え、集計のときに除く
+        sizes = [int(c.max()) + 2 if len(c) else 1 for c in columns]
+        if np.prod([float(s) for s in sizes]) < _MAX_CELLS:
+            key = np.zeros(len(df), dtype=np.int64)
+            for codes, size in zip(columns, sizes):
+                key = key * size + (codes + 1)
+            cells, inverse = np.unique(key, return_inverse=True)
+            base = {}
+            remainder = cells
+            for name, size in reversed(list(zip(self.dimensions + self.filters, sizes))):
+                base[name] = remainder % size - 1
+                remainder = remainder // size
+        else:
+            cells, inverse = np.unique(np.column_stack(columns), axis=0, return_inverse=True)
+            base = {name: cells[:, i] for i, name in enumerate(self.dimensions + self.filters)}
+        inverse = inverse.ravel()
+        n_cells = len(cells)
+        base["count"] = np.bincount(inverse, minlength=n_cells)
+        for name in self.measures:
+            values = pd.to_numeric(df[name]).to_numpy(dtype=np.float64, na_value=np.nan)
+            valid = ~np.isnan(values)
+            base[name + "_sum"] = np.bincount(inverse[valid], weights=values[valid], minlength=n_cells)
+            base[name + "_count"] = np.bincount(inverse[valid], minlength=n_cells)
+        self.base = pd.DataFrame(base, columns=list(base))
+        self._cache = {}
+
+    def __len__(self):
+        return int(self.base["count"].sum())
+
+    def rollup(self, *dimensions, where=None):
+        """dimensions の組み合わせごとの件数と、measures の合計・平均の表"""
+        dimensions = tuple(dimensions)
+        where = (where,) if isinstance(where, str) else tuple(where or ())
+        key = (dimensions, where)
+        if key in self._cache:
+            return self._cache[key]
+        unknown = [name for name in dimensions if name not in self.labels]
+        if unknown:
+            raise KeyError("Cube を作るときに dimensions に指定していない列です: " + ", ".join(unknown))
+        base = self.base
+        for name in where:
+            if name not in self.filters:
+                raise KeyError("Cube を作るときに filters に指定していない絞り込みです: " + name)
+            base = base.loc[base[name] == 1]
+        for name in dimensions:
+            # groupby と同じく、欠損の行はその列で集計するときだけ除く
+            base = base.loc[base[name] >= 0]
+        values = ["count"] + [name + suffix for name in self.measures for suffix in ("_sum", "_count")]
+        if dimensions:
+            result = base.groupby(list(dimensions), sort=True)[values].sum()
+            result.index = self._index(result.index, dimensions)
+        else:
+            result = pd.DataFrame({name: [base[name].sum()] for name in values})
+        for name in self.measures:
+            result[name] = result[name + "_sum"] / result[name + "_count"].where(result[name + "_count"] > 0)
+        self._cache[key] = result
+        return result
+
+    def _index(self, index, dimensions):
+        if len(dimensions) == 1:
+            name = dimensions[0]
+            return pd.Index(self.labels[name].take(index.values), name=name)
+        arrays = [self.labels[name].take(index.get_level_values(i).values) for i, name in enumerate(dimensions)]
+        return pd.MultiIndex.from_arrays(arrays, names=list(dimensions))
+
+    def count(self, *dimensions, where=None):
+        """groupby(dimensions).size() と同じ件数の Series"""
+        result = self.rollup(*dimensions, where=where)["count"]
+        return result.iloc[0] if not dimensions else result
+
+    def sum(self, measure, *dimensions, where=None):
+        result = self.rollup(*dimensions, where=where)[measure + "_sum"].rename(measure)
+        return result.iloc[0] if not dimensions else result
+
+    def mean(self, *dimensions, where=None, measures=None):
+        """groupby(dimensions)[measures].mean() と同じ表(欠損は除いて平均する)"""
+        result = self.rollup(*dimensions, where=where)[list(measures or self.measures)]
+        return result.iloc[0] if not dimensions else result
+
+    def grouping_sets(self, sets, where=None):
+        """列の組み合わせのリストそれぞれの rollup を、組み合わせ→表の辞書で返す"""
+        return {tuple(dims): self.rollup(*dims, where=where) for dims in sets}
+
+    def cube(self, where=None, max_dimensions=None):
+        """dimensions の全ての組み合わせ(空の組み合わせ=全体を含む)の rollup"""
+        max_dimensions = len(self.dimensions) if max_dimensions is None else max_dimensions
+        sets = [dims for r in range(max_dimensions + 1) for dims in itertools.combinations(self.dimensions, r)]
+        return self.grouping_sets(sets, where)
+
+    def save(self, path):
+        """元の表を読み直さずに使えるように保存する"""
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
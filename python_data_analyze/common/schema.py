@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# 各章のCSVを、ファイルごとに決めた型で読み込む
+#
+# どの章も pd.read_csv をそのまま呼んでいるので、列の型は毎回推測される。
+# customer_master.csv / customer_join.csv は1・3・4・5章で読み直され、日付は後から pd.to_datetime で変換し、
+# gender・class_name・campaign_name・WHRegion・item_name のように種類の少ない列も文字列(object)のまま残る。
+# ここではファイルごとに列の型を宣言しておき、
+# - 種類の少ない列はカテゴリ型、数値は必要なだけの幅の型で読む
+# - 日付は読み込みと同時に変換する
+# - 必要な列だけを読む(usecols)
+# - engine="pyarrow" で速いパーサを使う
+# report=True なら型を推測する普通の読み込みと、時間・メモリ使用量を比べた結果を df.attrs["load_report"] に入れる。
+#
+# 使い方:
+#   from common.schema import read_table
+#   customer = read_table(3, "customer_master.csv")                 # 3章のフォルダから読む
+#   uselog = read_table(4, "use_log.csv", root="synthetic/x10")     # synthetic/x10/4章/use_log.csv
+#   customer = read_table(4, "customer_join.csv", usecols=["customer_id", "start_date"], engine="pyarrow")
+# まとめて比べるとき(python_data_analyze のフォルダで):
+#   python -m common.schema --root synthetic/x10 --engine pyarrow
+
+import argparse
+import collections
+import inspect
+import os
+import time
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ISO8601 なら「2015-05-01」と「2015-05-01 00:00:00」のどちらも読める
+ISO = "ISO8601"
+
+Schema = collections.namedtuple("Schema", ["dtypes", "dates", "index_col", "default"])
+
+
+def schema(dtypes=None, dates=None, index_col=None, default=None):
+    """dtypes: 列名→型、dates: 列名→日付の書式、default: dtypes にない列の型"""
+    return Schema(dtypes or {}, dates or {}, index_col, default)
+
+
+# 会員の基本情報(3章)。4・5章の customer_join.csv はこれに集計列を足したもの
+_GYM_CUSTOMER = {"customer_id": "str", "name": "category", "class": "category", "gender": "category",
+                 "campaign_id": "category", "is_deleted": "int8"}
+_GYM_CUSTOMER_JOIN = dict(_GYM_CUSTOMER, class_name="category", price="int32", campaign_name="category",
+                          mean="float64", median="float64", max="int16", min="int16", routine_flg="int8",
+                          membership_period="int16")
+
+SCHEMAS = {
+    (1, "customer_master.csv"): schema(
+        {"customer_id": "str", "customer_name": "str", "customer_name_kana": "str", "email": "str",
+         "gender": "category", "age": "int16", "birth": "str", "pref": "category"},
+        {"registration_date": "%Y-%m-%d %H:%M:%S"}),
+    (1, "item_master.csv"): schema({"item_id": "category", "item_name": "category", "item_price": "int32"}),
+    (1, "transaction_1.csv"): schema({"transaction_id": "str", "price": "int32", "customer_id": "str"},
+                                     {"payment_date": "%Y-%m-%d %H:%M:%S"}),
+    (1, "transaction_2.csv"): schema({"transaction_id": "str", "price": "int32", "customer_id": "str"},
+                                     {"payment_date": "%Y-%m-%d %H:%M:%S"}),
+    (1, "transaction_detail_1.csv"): schema({"detail_id": "int64", "transaction_id": "str",
+                                             "item_id": "category", "quantity": "int16"}),
+    (1, "transaction_detail_2.csv"): schema({"detail_id": "int64", "transaction_id": "str",
+                                             "item_id": "category", "quantity": "int16"}),
+    # 商品名は表記揺れのあるまま読む(揺れがあっても種類は少ない)。価格は欠損があるので float
+    (2, "uriage.csv"): schema({"item_name": "category", "item_price": "float64", "customer_name": "str"},
+                              {"purchase_date": "%Y-%m-%d %H:%M:%S"}),
+    (2, "dump_data.csv"): schema(
+        {"item_name": "category", "item_price": "float64", "purchase_month": "int32", "顧客名": "str",
+         "かな": "str", "地域": "category", "メールアドレス": "str", "登録月": "int32"},
+        {"purchase_date": "%Y-%m-%d %H:%M:%S", "登録日": "%Y-%m-%d %H:%M:%S"}),
+    (3, "customer_master.csv"): schema(_GYM_CUSTOMER, {"start_date": ISO, "end_date": ISO}),
+    (3, "class_master.csv"): schema({"class": "category", "class_name": "category", "price": "int32"}),
+    (3, "campaign_master.csv"): schema({"campaign_id": "category", "campaign_name": "category"}),
+    (3, "use_log.csv"): schema({"log_id": "str", "customer_id": "str"}, {"usedate": "%Y-%m-%d"}),
+    (4, "use_log.csv"): schema({"log_id": "str", "customer_id": "str"}, {"usedate": "%Y-%m-%d"}),
+    (4, "customer_join.csv"): schema(_GYM_CUSTOMER_JOIN, {"start_date": ISO, "end_date": ISO, "calc_date": ISO}),
+    (5, "use_log.csv"): schema({"log_id": "str", "customer_id": "str"}, {"usedate": "%Y-%m-%d"}),
+    (5, "customer_join.csv"): schema(_GYM_CUSTOMER_JOIN, {"start_date": ISO, "end_date": ISO, "calc_date": ISO}),
+    # 年月は本と同じく整数で読む(ノック42で astype(str) してから結合する)
+    (5, "use_log_months.csv"): schema({"年月": "int32", "customer_id": "str", "count": "int16"}),
+    (6, "tbl_factory.csv"): schema({"FCID": "str", "FCName": "str", "FCDemand": "int32", "FCRegion": "category"},
+                                   index_col=0),
+    (6, "tbl_warehouse.csv"): schema({"WHID": "str", "WHName": "str", "WHSupply": "int32",
+                                      "WHRegion": "category"}, index_col=0),
+    (6, "rel_cost.csv"): schema({"RCostID": "int32", "FCID": "category", "WHID": "category", "Cost": "float64"},
+                                index_col=0),
+    (6, "tbl_transaction.csv"): schema({"TRID": "int64", "ToFC": "category", "FromWH": "category",
+                                        "Quantity": "int32"},
+                                       {"TransactionDate": "%Y-%m-%d %H:%M:%S"}, index_col=0),
+    # 8章の隣接行列と会員の利用状況は 0/1 だけなので、1列あたり4バイトにする
+    (8, "links.csv"): schema(index_col=0, default="float32"),
+    (8, "links_members.csv"): schema(index_col=0, default="float32"),
+    (8, "info_members.csv"): schema(index_col=0, default="float32"),
+    (10, "survey.csv"): schema({"comment": "str", "satisfaction": "int8"}, {"datetime": "%Y/%m/%d"}),
+}
+
+_HAS_DATE_FORMAT = "date_format" in inspect.signature(pd.read_csv).parameters
+
+
+def table_path(chapter, filename, root=None):
+    return os.path.join(root or BASE_DIR, "{}章".format(chapter), filename)
+
+
+def read_options(chapter, filename, usecols=None, engine=None, path=None):
+    """SCHEMAS から pd.read_csv の引数を作る"""
+    table = SCHEMAS.get((chapter, filename))
+    if table is None:
+        raise KeyError("{}章の {} の型が宣言されていません".format(chapter, filename))
+    if table.default is not None:
+        # 全ての列を同じ型で読む表。列名は1行目を読んで決める
+        header = pd.read_csv(path, nrows=0, encoding="utf-8-sig", index_col=table.index_col)
+        dtypes = {name: table.default for name in header.columns}
+    else:
+        dtypes = dict(table.dtypes)
+    dates = dict(table.dates)
+    if usecols is not None:
+        usecols = list(usecols)
+        dtypes = {k: v for k, v in dtypes.items() if k in usecols}
+        dates = {k: v for k, v in dates.items() if k in usecols}
+    # 文字列の列は型を指定しない(pandas のバージョンに合った既定の文字列型になる)
+    dtypes = {k: v for k, v in dtypes.items() if v != "str"}
+    options = {"encoding": "utf-8-sig"}
+    if table.index_col is not None and usecols is None:
+        options["index_col"] = table.index_col
+    if usecols is not None:
+        options["usecols"] = usecols
+    if engine == "pyarrow":
+        # pyarrow は ISO 形式の日付を型の指定だけで速く読める。それ以外の書式は parse_dates に回す
+        for column in [k for k, v in dates.items() if v == ISO or v.startswith("%Y-%m-%d")]:
+            dtypes[column] = "datetime64[ns]"
+            del dates[column]
+    if dates:
+        options["parse_dates"] = list(dates)
+        if _HAS_DATE_FORMAT:
+            options["date_format"] = dates
+    options["dtype"] = dtypes
+    if engine is not None:
+        options["engine"] = engine
+    return options
+
+
+def _memory(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def read_table(chapter, filename, usecols=None, engine=None, root=None, path=None, report=False):
+    """宣言した型で CSV を読む
+
+    root   : 章のフォルダの親(既定は python_data_analyze)。synthetic/x10 などを指定できる
+    path   : ファイルを直接指定する(型は chapter と filename で選ぶ)
+    report : True なら型を推測する普通の読み込みと比べた結果を df.attrs["load_report"] に入れる
+    """
+    path = path or table_path(chapter, filename, root)
+    options = read_options(chapter, filename, usecols, engine, path)
+    start = time.perf_counter()
+    df = pd.read_csv(path, **options)
+    seconds = time.perf_counter() - start
+    if report:
+        df.attrs["load_report"] = compare_default(path, df, seconds, options)
+    return df
+
+
+def compare_default(path, typed, typed_seconds, options):
+    """型を指定しない pd.read_csv(日付は後から pd.to_datetime)と時間・メモリを比べる"""
+    start = time.perf_counter()
+    default = pd.read_csv(path, encoding="utf-8-sig", usecols=options.get("usecols"),
+                          index_col=options.get("index_col"))
+    for column in typed.columns:
+        if str(typed[column].dtype).startswith("datetime64") and column in default:
+            default[column] = pd.to_datetime(default[column])
+    default_seconds = time.perf_counter() - start
+    typed_memory, default_memory = _memory(typed), _memory(default)
+    return {"file": path, "rows": len(typed), "engine": options.get("engine", "c"),
+            "typed_seconds": typed_seconds, "default_seconds": default_seconds,
+            "typed_memory": typed_memory, "default_memory": default_memory,
+            "memory_ratio": typed_memory / default_memory if default_memory else 1.0}
+
+
+def report_all(root=None, chapters=None, engine=None):
+    """宣言したファイルのうち存在するものを全て読み、比べた結果を表にする"""
+    rows = []
+    for chapter, filename in SCHEMAS:
+        if chapters and chapter not in chapters:
+            continue
+        path = table_path(chapter, filename, root)
+        if not os.path.exists(path):
+            continue
+        df = read_table(chapter, filename, engine=engine, path=path, report=True)
+        rows.append(dict(df.attrs["load_report"], chapter=chapter, filename=filename))
+    return pd.DataFrame(rows, columns=["chapter", "filename", "rows", "engine", "typed_seconds",
+                                       "default_seconds", "typed_memory", "default_memory", "memory_ratio"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="宣言した型での読み込みと、型を推測する読み込みを比べる")
+    parser.add_argument("--root", default=None, help="章のフォルダの親(既定は python_data_analyze)")
+    parser.add_argument("--chapters", type=int, nargs="*", default=None)
+    parser.add_argument("--engine", default=None, choices=["c", "python", "pyarrow"])
+    args = parser.parse_args(argv)
+    result = report_all(args.root, args.chapters, args.engine)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print(result.to_string(index=False))
+    print("合計 メモリ {:.1f}MB -> {:.1f}MB, 時間 {:.2f}s -> {:.2f}s".format(
+        result["default_memory"].sum() / 2**20, result["typed_memory"].sum() / 2**20,
+        result["default_seconds"].sum(), result["typed_seconds"].sum()))
+
+
+if __name__ == "__main__":
+    main()
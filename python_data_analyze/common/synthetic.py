@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+# 各章のデータと同じ形式・同じような分布のデータを、任意の倍率で作る
+#
+# 同梱のCSVはどれも小さい(1章の transaction_1.csv は5,000行、customer_join.csv は4,192人、
+# links_members.csv は540人、trans_cost.csv は4×3)ため、本番規模で遅くなる箇所を手元で再現できない。
+# ここでは同梱のデータを元に、10倍・100倍・1000倍といった規模のデータを作る。
+# - 顧客ID・取引IDなどのキーは一意で、取引が参照する顧客・商品・工場などは必ず存在する
+# - 日付の範囲、全角スペース・Excelのシリアル値・価格の欠損などの汚れ方は同梱のデータに合わせる
+# - 8章のネットワークは同梱データのリンク数の分布を保つ
+# - 同じ seed と chunksize なら常に同じデータになり、大きな表はチャンクごとに直接書き出す
+#
+# 9章の画像・映像は対象外。
+#
+# 使い方(python_data_analyze のフォルダで):
+#   python -m common.synthetic --scale 10 --out synthetic/x10
+#   python -m common.synthetic --scale 100 --chapters 1 3 --out synthetic/x100
+# 出力先には章ごとのフォルダ(synthetic/x10/1章 など)ができるので、ノートブックの読み込み先を差し替えて使う。
+
+import argparse
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from common.pipeline import customer_base, customer_join, month_counts, weekday_counts
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def seed_path(chapter, filename):
+    return os.path.join(BASE_DIR, "{}章".format(chapter), filename)
+
+
+def read_seed(chapter, filename, **kwargs):
+    return pd.read_csv(seed_path(chapter, filename), encoding="utf-8-sig", **kwargs)
+
+
+def _rng(seed, *keys):
+    """表・チャンクごとに独立した乱数。チャンクを作る順番に結果が左右されない"""
+    return np.random.default_rng([seed] + list(keys))
+
+
+def _chunks(total, chunksize):
+    for i, start in enumerate(range(0, total, chunksize)):
+        yield i, start, min(start + chunksize, total)
+
+
+class CsvSink(object):
+    """CSVにチャンクごとに追記する。最初の書き込みだけヘッダを付ける"""
+
+    def __init__(self, path, encoding="utf-8", index=False):
+        self.path = path
+        self.encoding = encoding
+        self.index = index
+        self.rows = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, df):
+        first = self.rows == 0 and not os.path.exists(self.path)
+        df.to_csv(self.path, mode="w" if first else "a", header=first, index=self.index,
+                  encoding=self.encoding if first else self.encoding.replace("-sig", ""))
+        self.rows += len(df)
+
+
+def make_ids(prefixes, index, width):
+    """連番から「英字2文字+数字」の一意なIDを作る(1章・3章の customer_id と同じ形)"""
+    index = np.asarray(index)
+    letters = np.asarray(prefixes)[index % len(prefixes)]
+    numbers = pd.Series(index).astype(str).str.zfill(width).values
+    return pd.Series(letters, dtype=object).str.cat(numbers).values
+
+
+def id_prefixes(ids):
+    return sorted(set(re.match(r"[A-Z]+", i).group(0) for i in ids))
+
+
+def random_times(rng, start, end, n, sort=True):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    seconds = rng.integers(0, int((end - start).total_seconds()) + 1, n)
+    if sort:
+        seconds = np.sort(seconds)
+    return start + pd.to_timedelta(seconds, unit="s")
+
+
+def sample_from(rng, values, n, weights=None):
+    values = np.asarray(values)
+    return values[rng.choice(len(values), size=n, p=weights)]
+
+
+def value_weights(series):
+    counts = series.value_counts()
+    return counts.index.values, (counts / counts.sum()).values
+
+
+# --------------------------------------------------------------------------------------
+# 1章 ECサイトの注文データ
+# --------------------------------------------------------------------------------------
+
+def generate_chapter1(out_dir, scale, seed, chunksize):
+    customer = read_seed(1, "customer_master.csv")
+    item = read_seed(1, "item_master.csv")
+    tr1, tr2 = read_seed(1, "transaction_1.csv"), read_seed(1, "transaction_2.csv")
+    detail = pd.concat([read_seed(1, "transaction_detail_1.csv"), read_seed(1, "transaction_detail_2.csv")])
+    out = os.path.join(out_dir, "1章")
+
+    n_customer = int(len(customer) * scale)
+    prefixes = id_prefixes(customer["customer_id"])
+    width = max(6, len(str(n_customer)))
+    reg = pd.to_datetime(customer["registration_date"])
+    sink = CsvSink(os.path.join(out, "customer_master.csv"))
+    for c, start, stop in _chunks(n_customer, chunksize):
+        rng = _rng(seed, 1, 0, c)
+        rows = customer.iloc[rng.integers(0, len(customer), stop - start)].reset_index(drop=True)
+        rows["customer_id"] = make_ids(prefixes, np.arange(start, stop), width)
+        rows["registration_date"] = random_times(rng, reg.min(), reg.max(), stop - start).strftime(DATE_FORMAT)
+        sink.write(rows)
+    item.to_csv(os.path.join(out, "item_master.csv"), index=False)
+
+    # 取引ごとの明細の数・商品・数量の分布を元データから取る
+    per_tr, per_tr_w = value_weights(detail.groupby("transaction_id").size())
+    items, items_w = value_weights(detail["item_id"])
+    quantities, quantities_w = value_weights(detail["quantity"])
+    price_of = item.set_index("item_id")["item_price"]
+    pay = pd.to_datetime(pd.concat([tr1, tr2])["payment_date"])
+    n_tr = int((len(tr1) + len(tr2)) * scale)
+    n_tr1 = int(len(tr1) * scale)
+    span = (pay.max() - pay.min()) / max(1, math.ceil(n_tr / chunksize))
+    first_tr = int(tr1["transaction_id"].str[1:].astype(int).min())
+    sinks = {1: CsvSink(os.path.join(out, "transaction_1.csv")), 2: CsvSink(os.path.join(out, "transaction_2.csv"))}
+    detail_sinks = {1: CsvSink(os.path.join(out, "transaction_detail_1.csv")),
+                    2: CsvSink(os.path.join(out, "transaction_detail_2.csv"))}
+    detail_id = 0
+    for c, start, stop in _chunks(n_tr, chunksize):
+        rng = _rng(seed, 1, 1, c)
+        n = stop - start
+        tr_ids = np.array(["T{:010d}".format(first_tr + i) for i in range(start, stop)], dtype=object)
+        n_detail = sample_from(rng, per_tr, n, per_tr_w)
+        d = pd.DataFrame({"transaction_id": np.repeat(tr_ids, n_detail),
+                          "item_id": sample_from(rng, items, n_detail.sum(), items_w),
+                          "quantity": sample_from(rng, quantities, n_detail.sum(), quantities_w)})
+        d.insert(0, "detail_id", np.arange(detail_id, detail_id + len(d)))
+        detail_id += len(d)
+        # 取引の金額は明細の合計に合わせる(ノック6の検算が通るように)
+        price = (d["quantity"] * price_of.reindex(d["item_id"]).values).groupby(d["transaction_id"]).sum()
+        t = pd.DataFrame({"transaction_id": tr_ids, "price": price.reindex(tr_ids).values,
+                          "payment_date": random_times(rng, pay.min() + span * c, pay.min() + span * (c + 1),
+                                                       n).strftime(DATE_FORMAT),
+                          "customer_id": make_ids(prefixes, rng.integers(0, n_customer, n), width)})
+        part = np.where(np.arange(start, stop) < n_tr1, 1, 2)
+        for p in (1, 2):
+            if (part == p).any():
+                sinks[p].write(t.loc[part == p])
+                detail_sinks[p].write(d.loc[d["transaction_id"].isin(tr_ids[part == p])])
+
+
+# --------------------------------------------------------------------------------------
+# 2章 小売店のデータ(表記ゆれ・欠損・Excelのシリアル値を含む)
+# --------------------------------------------------------------------------------------
+
+def _name_pools(kokyaku):
+    """顧客台帳から (漢字, かな, ローマ字) の姓と名の組を取り出す"""
+    sei, mei = [], []
+    for name, kana, mail in zip(kokyaku["顧客名"], kokyaku["かな"], kokyaku["メールアドレス"]):
+        parts = name.split()
+        kana_parts = kana.split()
+        romaji = mail.split("@")[0].split("_")
+        if len(parts) == 2 and len(kana_parts) == 2 and len(romaji) == 2:
+            sei.append((parts[0], kana_parts[0], romaji[0]))
+            mei.append((parts[1], kana_parts[1], romaji[1]))
+    return sei, mei
+
+
+def _dirty_item_names(rng, names, rate):
+    """ノック12で直す表記ゆれ(半角・全角スペース、小文字)を rate の割合で入れる"""
+    names = names.astype(object).copy()
+    for i in np.flatnonzero(rng.random(len(names)) < rate):
+        name = names[i]
+        kind = rng.integers(0, 3)
+        if kind == 0:
+            pos = rng.integers(1, len(name))
+            name = name[:pos] + rng.choice([" ", "　"]) + name[pos:]
+        elif kind == 1:
+            name = name[:-1] + name[-1].lower()
+        else:
+            name = name[:1] + " " + name[1:-1] + " " + name[-1].lower()
+        names[i] = name
+    return names
+
+
+def generate_chapter2(out_dir, scale, seed, chunksize):
+    uriage = read_seed(2, "uriage.csv")
+    kokyaku = pd.read_excel(seed_path(2, "kokyaku_daicho.xlsx"))
+    out = os.path.join(out_dir, "2章")
+    os.makedirs(out, exist_ok=True)
+
+    sei, mei = _name_pools(kokyaku)
+    spaces, spaces_w = value_weights(kokyaku["顧客名"].str.extract(r"^\S+(\s*)\S+$")[0].fillna(""))
+    regions, regions_w = value_weights(kokyaku["地域"])
+    serial_rate = kokyaku["登録日"].map(lambda v: not isinstance(v, str)).mean()
+    reg = pd.to_datetime(kokyaku["登録日"].map(lambda v: v if isinstance(v, str) else None))
+    n_customer = int(len(kokyaku) * scale)
+
+    rng = _rng(seed, 2, 0)
+    i_sei = rng.integers(0, len(sei), n_customer)
+    i_mei = rng.integers(0, len(mei), n_customer)
+    clean_name = np.array([sei[a][0] + mei[b][0] for a, b in zip(i_sei, i_mei)], dtype=object)
+    kana = np.array([sei[a][1] + " " + mei[b][1] for a, b in zip(i_sei, i_mei)], dtype=object)
+    # 同姓同名でもメールアドレスは一意になるよう連番を付ける
+    mail = np.array(["{}_{}{}@example.com".format(sei[a][2], mei[b][2], "" if k < len(kokyaku) else k)
+                     for k, (a, b) in enumerate(zip(i_sei, i_mei))], dtype=object)
+    sep = sample_from(rng, spaces, n_customer, spaces_w)
+    dirty_name = np.array([sei[a][0] + s + mei[b][0] for a, b, s in zip(i_sei, i_mei, sep)], dtype=object)
+    region = sample_from(rng, regions, n_customer, regions_w)
+    registered = random_times(rng, reg.min(), reg.max(), n_customer, sort=False).normalize()
+    serial = rng.random(n_customer) < serial_rate
+    reg_value = np.where(serial, (registered - pd.Timestamp("1899-12-30")).days,
+                         registered.strftime("%Y/%m/%d")).astype(object)
+    reg_value[serial] = reg_value[serial].astype(int)
+    _write_excel(os.path.join(out, "kokyaku_daicho.xlsx"), ["顧客名", "かな", "地域", "メールアドレス", "登録日"],
+                 zip(dirty_name, kana, region, mail, reg_value))
+
+    canonical = uriage["item_name"].str.fullmatch(r"商品[A-Z]")
+    dirty_rate = 1 - canonical.mean()
+    missing_rate = uriage["item_price"].isna().mean()
+    price_of = uriage.loc[canonical].groupby("item_name")["item_price"].agg(lambda s: s.mode().iloc[0])
+    item_names, item_w = value_weights(uriage.loc[canonical, "item_name"])
+    purchase = pd.to_datetime(uriage["purchase_date"])
+    n_sales = int(len(uriage) * scale)
+    uriage_sink = CsvSink(os.path.join(out, "uriage.csv"))
+    dump_sink = CsvSink(os.path.join(out, "dump_data.csv"))
+    for c, start, stop in _chunks(n_sales, chunksize):
+        rng = _rng(seed, 2, 1, c)
+        n = stop - start
+        name = sample_from(rng, item_names, n, item_w)
+        buyer = rng.integers(0, n_customer, n)
+        date = random_times(rng, purchase.min(), purchase.max(), n, sort=False)
+        price = price_of.reindex(name).values
+        uriage_sink.write(pd.DataFrame({
+            "purchase_date": date.strftime(DATE_FORMAT), "item_name": _dirty_item_names(rng, name, dirty_rate),
+            "item_price": np.where(rng.random(n) < missing_rate, np.nan, price).astype(object),
+            "customer_name": clean_name[buyer]}).astype({"item_price": "Int64"}))
+        # ノック20で作るクレンジング済みのデータ
+        dump = pd.DataFrame({"purchase_date": date.strftime(DATE_FORMAT), "item_name": name,
+                             "item_price": price.astype(float), "purchase_month": date.strftime("%Y%m"),
+                             "顧客名": clean_name[buyer], "かな": kana[buyer], "地域": region[buyer],
+                             "メールアドレス": mail[buyer],
+                             "登録日": registered[buyer].strftime(DATE_FORMAT),
+                             "登録月": registered[buyer].strftime("%Y%m")})
+        dump_sink.write(dump.sort_values("purchase_date", kind="stable"))
+
+
+def _write_excel(path, columns, rows):
+    """openpyxl の書き込み専用モードで1行ずつ書き出す(表全体をメモリに載せない)"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(columns)
+    for row in rows:
+        ws.append([v.item() if hasattr(v, "item") else v for v in row])
+    wb.save(path)
+
+
+# --------------------------------------------------------------------------------------
+# 3〜5章 スポーツジムの会員データ
+# --------------------------------------------------------------------------------------
+
+LOG_START = pd.Timestamp("2018-04-01")
+LOG_END = pd.Timestamp("2019-03-31")
+
+
+def _gym_logs(rng, customers, mean_uses, routine_rate, first_log_id):
+    """会員ごとに月ごとの利用回数を決めて use_log を作る
+
+    定期利用の会員は同じ曜日に通うようにする(ノック26の routine_flg が立つように)。
+    """
+    start = pd.to_datetime(customers["start_date"]).values
+    end = pd.to_datetime(customers["end_date"]).fillna(pd.Timestamp("2262-01-01")).values
+    customer_ids = customers["customer_id"].values
+    lam = sample_from(rng, mean_uses, len(customers))
+    routine = rng.random(len(customers)) < routine_rate
+    weekday = rng.integers(0, 7, len(customers))
+    ids, dates = [], []
+    for m in pd.date_range(LOG_START, LOG_END, freq="MS"):
+        days = pd.date_range(m, m + pd.offsets.MonthEnd(0))
+        active = np.flatnonzero((start <= np.datetime64(days[-1])) & (end > np.datetime64(m)))
+        n = np.minimum(np.maximum(1, rng.poisson(lam[active])), len(days))
+        # 日ごとに乱数を振って小さい順に n 日選ぶ。定期利用の会員は決まった曜日を必ず選ぶ
+        same = days.weekday.values[None, :] == weekday[active, None]
+        score = rng.random((len(active), len(days))) - (same & routine[active, None])
+        n = np.where(routine[active], np.maximum(n, same.sum(axis=1)), n)
+        rank = score.argsort(axis=1).argsort(axis=1)
+        row, col = np.nonzero(rank < n[:, None])
+        ids.append(customer_ids[active[row]])
+        dates.append(days.values[col])
+    ids = np.concatenate(ids) if ids else np.array([], dtype=object)
+    dates = np.concatenate(dates) if dates else np.array([], dtype="datetime64[ns]")
+    log = pd.DataFrame({"customer_id": ids, "usedate": pd.DatetimeIndex(dates)})
+    log = log.sort_values("usedate", kind="stable").reset_index(drop=True)
+    log.insert(0, "log_id", ["L{:08d}".format(first_log_id + i) for i in range(len(log))])
+    log["usedate"] = log["usedate"].dt.strftime("%Y-%m-%d")
+    return log
+
+
+def derive_customer_join(customers, class_master, campaign_master, use_log):
+    """ノック22〜28の処理で customer_join.csv と同じ列の表を作る(common.pipeline と同じ処理)"""
+    customer = customer_base(customers, class_master, campaign_master)
+    return customer_join(customer, month_counts(use_log), weekday_counts(use_log))
+
+
+def generate_gym(out_dir, scale, seed, chunksize, chapters=(3, 4, 5)):
+    customer = read_seed(3, "customer_master.csv")
+    class_master = read_seed(3, "class_master.csv")
+    campaign_master = read_seed(3, "campaign_master.csv")
+    joined = read_seed(4, "customer_join.csv")
+    mean_uses = joined["mean"].values
+    routine_rate = joined["routine_flg"].mean()
+    prefixes = id_prefixes(customer["customer_id"])
+    n_customer = int(len(customer) * scale)
+    width = max(6, len(str(n_customer)))
+
+    sinks = {}
+    for ch in chapters:
+        out = os.path.join(out_dir, "{}章".format(ch))
+        sinks[ch, "use_log"] = CsvSink(os.path.join(out, "use_log.csv"))
+        if ch == 3:
+            sinks[ch, "customer_master"] = CsvSink(os.path.join(out, "customer_master.csv"))
+            class_master.to_csv(os.path.join(out, "class_master.csv"), index=False)
+            campaign_master.to_csv(os.path.join(out, "campaign_master.csv"), index=False)
+        else:
+            sinks[ch, "customer_join"] = CsvSink(os.path.join(out, "customer_join.csv"))
+        if ch == 5:
+            sinks[ch, "use_log_months"] = CsvSink(os.path.join(out, "use_log_months.csv"))
+
+    log_id = 0
+    # 会員をチャンクに分け、会員ごとの利用履歴と集計をそのチャンクの中で完結させる
+    for c, start, stop in _chunks(n_customer, max(1, chunksize // 50)):
+        rng = _rng(seed, 3, c)
+        rows = customer.iloc[rng.integers(0, len(customer), stop - start)].reset_index(drop=True)
+        rows["customer_id"] = make_ids(prefixes, np.arange(start, stop), width)
+        log = _gym_logs(rng, rows, mean_uses, routine_rate, log_id)
+        log_id += len(log)
+        join = None
+        for ch in chapters:
+            sinks[ch, "use_log"].write(log)
+            if ch == 3:
+                sinks[ch, "customer_master"].write(rows)
+                continue
+            if join is None:
+                join = derive_customer_join(rows, class_master, campaign_master, log)
+            sinks[ch, "customer_join"].write(join)
+            if ch == 5:
+                sinks[ch, "use_log_months"].write(month_counts(log))
+
+
+# --------------------------------------------------------------------------------------
+# 6・7章 物流ネットワーク
+# --------------------------------------------------------------------------------------
+
+def _side(n, scale):
+    """行列の各辺を sqrt(scale) 倍にして、セルの数が scale 倍になるようにする"""
+    return max(1, int(round(n * math.sqrt(scale))))
+
+
+def generate_chapter6(out_dir, scale, seed, chunksize):
+    factory = read_seed(6, "tbl_factory.csv")
+    warehouse = read_seed(6, "tbl_warehouse.csv")
+    rel_cost = read_seed(6, "rel_cost.csv")
+    transaction = read_seed(6, "tbl_transaction.csv")
+    out = os.path.join(out_dir, "6章")
+    os.makedirs(out, exist_ok=True)
+    rng = _rng(seed, 6, 0)
+
+    # 工場・倉庫は地域ごとに増やし、輸送ルートは同じ地域の中だけに張る(元データと同じ)
+    n_fc, n_wh = int(len(factory) * scale), int(len(warehouse) * scale)
+    fc = factory.iloc[np.arange(n_fc) % len(factory)].reset_index(drop=True)
+    fc["FCID"] = ["FC{:05d}".format(i + 1) for i in range(n_fc)]
+    fc["FCName"] = [n if i < len(factory) else "{}{}".format(n, i // len(factory)) for i, n in enumerate(fc["FCName"])]
+    fc["FCDemand"] = sample_from(rng, factory["FCDemand"], n_fc)
+    wh = warehouse.iloc[np.arange(n_wh) % len(warehouse)].reset_index(drop=True)
+    wh["WHID"] = ["WH{:05d}".format(i + 1) for i in range(n_wh)]
+    wh["WHName"] = [n if i < len(warehouse) else "{}{}".format(n, i // len(warehouse)) for i, n in enumerate(wh["WHName"])]
+    wh["WHSupply"] = sample_from(rng, warehouse["WHSupply"], n_wh)
+    fc.to_csv(os.path.join(out, "tbl_factory.csv"), index=False, encoding="utf-8-sig")
+    wh.to_csv(os.path.join(out, "tbl_warehouse.csv"), index=False, encoding="utf-8-sig")
+
+    per_fc = rel_cost.groupby("FCID").size().max()
+    pairs = []
+    for region, group in fc.groupby("FCRegion"):
+        candidates = wh.loc[wh["WHRegion"] == region, "WHID"].values
+        for fcid in group["FCID"]:
+            for whid in rng.choice(candidates, min(per_fc, len(candidates)), replace=False):
+                pairs.append((fcid, whid))
+    rel = pd.DataFrame(pairs, columns=["FCID", "WHID"])
+    rel.insert(0, "RCostID", np.arange(1, len(rel) + 1))
+    rel["Cost"] = sample_from(rng, rel_cost["Cost"], len(rel))
+    rel.to_csv(os.path.join(out, "rel_cost.csv"), index=False, encoding="utf-8-sig")
+
+    quantities, quantities_w = value_weights(transaction["Quantity"])
+    date = pd.to_datetime(transaction["TransactionDate"])
+    n_tr = int(len(transaction) * scale)
+    span = (date.max() - date.min()) / max(1, math.ceil(n_tr / chunksize))
+    sink = CsvSink(os.path.join(out, "tbl_transaction.csv"))
+    for c, start, stop in _chunks(n_tr, chunksize):
+        rng_c = _rng(seed, 6, 1, c)
+        n = stop - start
+        route = rel.iloc[rng_c.integers(0, len(rel), n)]
+        sink.write(pd.DataFrame({
+            "TRID": np.arange(start, stop),
+            "TransactionDate": random_times(rng_c, date.min() + span * c, date.min() + span * (c + 1),
+                                            n).strftime(DATE_FORMAT),
+            "ToFC": route["FCID"].values, "FromWH": route["WHID"].values,
+            "Quantity": sample_from(rng_c, quantities, n, quantities_w)}))
+
+    _generate_network(out, 6, scale, rng)
+    _generate_transport(out, 6, scale, rng, with_routes=True)
+
+
+def _generate_network(out, chapter, scale, rng):
+    """network_weight.csv / network_pos.csv(ノック55)を、0の割合を保って大きくする"""
+    weight = read_seed(chapter, "network_weight.csv")
+    n = _side(len(weight.columns), scale)
+    names = [_node_name(i) for i in range(n)]
+    zero_rate = (weight.values == 0).mean()
+    values = np.round(rng.random((n, n)), 6)
+    values[rng.random((n, n)) < zero_rate] = 0
+    pd.DataFrame(values, columns=names).to_csv(os.path.join(out, "network_weight.csv"), index=False)
+    pos = pd.DataFrame(rng.integers(0, max(3, int(math.sqrt(n)) + 2), (2, n)), columns=names)
+    pos.to_csv(os.path.join(out, "network_pos.csv"), index=False)
+
+
+def _node_name(i):
+    name = ""
+    i += 1
+    while i > 0:
+        i, r = divmod(i - 1, 26)
+        name = chr(65 + r) + name
+    return name
+
+
+def _generate_transport(out, chapter, scale, rng, with_routes):
+    """trans_cost.csv などの倉庫×工場の表を sqrt(scale) 倍ずつ大きくする"""
+    cost = read_seed(chapter, "trans_cost.csv", index_col="工場")
+    demand = read_seed(chapter, "demand.csv")
+    supply = read_seed(chapter, "supply.csv")
+    n_w, n_f = _side(len(cost.index), scale), _side(len(cost.columns), scale)
+    w_names = ["W{}".format(i + 1) for i in range(n_w)]
+    f_names = ["F{}".format(i + 1) for i in range(n_f)]
+    cost_df = pd.DataFrame(sample_from(rng, cost.values.ravel(), n_w * n_f).reshape(n_w, n_f),
+                           index=pd.Index(w_names, name="工場"), columns=f_names)
+    cost_df.to_csv(os.path.join(out, "trans_cost.csv"))
+    demand_v = sample_from(rng, demand.values.ravel(), n_f)
+    # 供給の合計が需要の合計を下回らないようにする(元データと同じく少し余裕を持たせる)
+    ratio = supply.values.sum() / demand.values.sum()
+    supply_v = sample_from(rng, supply.values.ravel(), n_w).astype(float)
+    supply_v = np.ceil(supply_v * demand_v.sum() * ratio / supply_v.sum()).astype(int)
+    pd.DataFrame([demand_v], columns=f_names).to_csv(os.path.join(out, "demand.csv"), index=False)
+    pd.DataFrame([supply_v], columns=w_names).to_csv(os.path.join(out, "supply.csv"), index=False)
+    pos = pd.DataFrame([[0] * n_w + [4] * n_f,
+                        list(range(1, n_w + 1)) + [i + 0.5 for i in range(n_f)]], columns=w_names + f_names)
+    pos.to_csv(os.path.join(out, "trans_route_pos.csv"), index=False)
+    if with_routes:
+        for name in ("trans_route.csv", "trans_route_new.csv"):
+            route = _northwest_corner(supply_v.copy(), demand_v.copy())
+            pd.DataFrame(route, index=pd.Index(w_names, name="工場"), columns=f_names).to_csv(
+                os.path.join(out, name))
+
+
+def _northwest_corner(supply, demand):
+    """需要をすべて満たす輸送ルート(ノック56の trans_route と同じ形)"""
+    route = np.zeros((len(supply), len(demand)), dtype=int)
+    i = j = 0
+    while i < len(supply) and j < len(demand):
+        q = min(supply[i], demand[j])
+        route[i, j] = q
+        supply[i] -= q
+        demand[j] -= q
+        if demand[j] == 0:
+            j += 1
+        else:
+            i += 1
+    return route
+
+
+def generate_chapter7(out_dir, scale, seed, chunksize):
+    out = os.path.join(out_dir, "7章")
+    os.makedirs(out, exist_ok=True)
+    rng = _rng(seed, 7, 0)
+    _generate_transport(out, 7, scale, rng, with_routes=False)
+
+    material = read_seed(7, "product_plan_material.csv", index_col="製品")
+    profit = read_seed(7, "product_plan_profit.csv", index_col="製品", skipinitialspace=True)
+    stock = read_seed(7, "product_plan_stock.csv", index_col="項目")
+    n_p, n_m = _side(len(material.index), scale), _side(len(material.columns), scale)
+    products = ["製品{}".format(i + 1) for i in range(n_p)]
+    materials = ["原料{}".format(i + 1) for i in range(n_m)]
+    pd.DataFrame(sample_from(rng, material.values.ravel(), n_p * n_m).reshape(n_p, n_m),
+                 index=pd.Index(products, name="製品"), columns=materials).to_csv(
+        os.path.join(out, "product_plan_material.csv"))
+    pd.DataFrame({"製品": products, " 利益": sample_from(rng, profit.values.ravel(), n_p)}).to_csv(
+        os.path.join(out, "product_plan_profit.csv"), index=False)
+    pd.DataFrame([sample_from(rng, stock.values.ravel(), n_m) * max(1, n_p // len(material.index))],
+                 index=pd.Index(["在庫"], name="項目"), columns=materials).to_csv(
+        os.path.join(out, "product_plan_stock.csv"))
+    pd.DataFrame({"製品": products, " 生産量": np.zeros(n_p, dtype=int)}).to_csv(
+        os.path.join(out, "product_plan.csv"), index=False)
+
+
+# --------------------------------------------------------------------------------------
+# 8章 人間関係のネットワーク
+# --------------------------------------------------------------------------------------
+
+# 隣接行列のCSVはノード数の2乗の大きさになるので、これを超えたら辺のリストで書き出す
+DENSE_LIMIT = 20000
+
+
+def random_graph(rng, degrees):
+    """リンク数の列 degrees を保つように辺を張る(configuration model)
+
+    自己ループと多重辺は取り除くので、リンク数は元の値より少し小さくなることがある。
+    """
+    degrees = np.asarray(degrees, dtype=np.int64)
+    if degrees.sum() % 2:
+        degrees[rng.integers(0, len(degrees))] += 1
+    stubs = np.repeat(np.arange(len(degrees)), degrees)
+    rng.shuffle(stubs)
+    a, b = stubs[0::2], stubs[1::2]
+    keep = a != b
+    edges = np.stack([np.minimum(a, b)[keep], np.maximum(a, b)[keep]], axis=1)
+    return np.unique(edges, axis=0)
+
+
+def _write_links(path, n, edges, chunksize):
+    names = ["Node{}".format(i) for i in range(n)]
+    if n > DENSE_LIMIT:
+        edge_path = path.replace(".csv", "_edges.csv")
+        pd.DataFrame(edges, columns=["source", "target"]).to_csv(edge_path, index=False)
+        return
+    # 行ごとに隣接行列を作って書き出す
+    both = np.vstack([edges, edges[:, ::-1]])
+    both = both[np.argsort(both[:, 0], kind="stable")]
+    bounds = np.searchsorted(both[:, 0], np.arange(n + 1))
+    sink = CsvSink(path, index=True)
+    rows = max(1, chunksize // max(1, n // 100))
+    for c, start, stop in _chunks(n, rows):
+        block = np.zeros((stop - start, n))
+        lo, hi = bounds[start], bounds[stop]
+        block[both[lo:hi, 0] - start, both[lo:hi, 1]] = 1.0
+        sink.write(pd.DataFrame(block, index=names[start:stop], columns=names))
+
+
+def generate_chapter8(out_dir, scale, seed, chunksize):
+    out = os.path.join(out_dir, "8章")
+    os.makedirs(out, exist_ok=True)
+    for filename, code in (("links.csv", 0), ("links_members.csv", 1)):
+        links = read_seed(8, filename, index_col=0)
+        degrees = links.values.sum(axis=1).astype(int)
+        n = int(len(links) * scale)
+        rng = _rng(seed, 8, code)
+        edges = random_graph(rng, sample_from(rng, degrees, n))
+        _write_links(os.path.join(out, filename), n, edges, chunksize)
+
+    info = read_seed(8, "info_members.csv", index_col=0)
+    n = int(len(info) * scale)
+    sink = CsvSink(os.path.join(out, "info_members.csv"), index=True)
+    for c, start, stop in _chunks(n, chunksize):
+        rng = _rng(seed, 8, 2, c)
+        rows = info.iloc[rng.integers(0, len(info), stop - start)]
+        rows.index = ["Node{}".format(i) for i in range(start, stop)]
+        sink.write(rows)
+
+
+# --------------------------------------------------------------------------------------
+# 10章 アンケート
+# --------------------------------------------------------------------------------------
+
+def generate_chapter10(out_dir, scale, seed, chunksize):
+    survey = read_seed(10, "survey.csv")
+    date = pd.to_datetime(survey["datetime"], format="%Y/%m/%d")
+    n = int(len(survey) * scale)
+    sink = CsvSink(os.path.join(out_dir, "10章", "survey.csv"), encoding="utf-8-sig")
+    for c, start, stop in _chunks(n, chunksize):
+        rng = _rng(seed, 10, c)
+        # コメントと満足度は組のまま取り出し、コメントの欠損や「(AA駅)」などの書き方も残す
+        rows = survey.iloc[rng.integers(0, len(survey), stop - start)].reset_index(drop=True)
+        days = random_times(rng, date.min(), date.max(), stop - start, sort=False)
+        rows["datetime"] = [d.strftime("%Y/") + str(d.month) + "/" + str(d.day) for d in days]
+        sink.write(rows)
+
+
+GENERATORS = {
+    1: generate_chapter1,
+    2: generate_chapter2,
+    3: generate_gym,
+    6: generate_chapter6,
+    7: generate_chapter7,
+    8: generate_chapter8,
+    10: generate_chapter10,
+}
+
+
+def generate(out_dir, scale=10, chapters=(1, 2, 3, 4, 5, 6, 7, 8, 10), seed=0, chunksize=100000):
+    """指定した章のデータを scale 倍の規模で out_dir/{章}章/ に作る"""
+    chapters = list(chapters)
+    gym = [ch for ch in chapters if ch in (3, 4, 5)]
+    if gym:
+        generate_gym(out_dir, scale, seed, chunksize, chapters=gym)
+    for ch in chapters:
+        if ch in (3, 4, 5):
+            continue
+        if ch not in GENERATORS:
+            raise ValueError("{}章のデータは作れません".format(ch))
+        GENERATORS[ch](out_dir, scale, seed, chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="各章のデータを大きな規模で作る")
+    parser.add_argument("--scale", type=float, default=10)
+    parser.add_argument("--chapters", type=int, nargs="*", default=[1, 2, 3, 4, 5, 6, 7, 8, 10])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("--out", default="synthetic")
+    args = parser.parse_args(argv)
+    generate(args.out, args.scale, args.chapters, args.seed, args.chunksize)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# 6章の輸送実績を、工場・倉庫を番号にした表と、あらかじめ足し合わせた集計で持つ
+#
+# ノック51は tbl_transaction.csv に rel_cost.csv(ToFC/FromWH で)、tbl_factory.csv、tbl_warehouse.csv を順に結合し、
+# ノック52はその表から関東・東北の行を取り出して、支社ごとに Cost・Quantity の合計と1個あたりのコストを計算している。
+# 輸送実績が増えるたびに、3回の結合と地域ごとの絞り込みを全ての行についてやり直すことになる。
+# ここでは
+# - FCID・WHID を 0 から始まる番号にし、コストは[工場, 倉庫]の配列、名前・地域は番号で引く配列にする(結合しない)
+# - 輸送ルート(rel_cost の工場・倉庫の組)に番号を付け、[期間, ルート]ごとの件数・Quantity・Cost の合計を持つ
+#   (期間は日・週・月など)。工場×倉庫の全ての組ではなく、実績のあるルートの分だけメモリを使う
+# - 新しい輸送実績は append で、その実績に出てくる期間・ルートの所だけに足し込む
+# 地域・工場・倉庫・期間ごとの集計は、足し込んだ配列(期間×ルート)を足し合わせるだけで作れる。
+# 元の行は keep_rows=True のときだけ残す(ノック51の結合結果は、load したファイルを読み直しても作れる)。
+#
+# 使い方:
+#   from common.transport import TransportFacts
+#   facts = TransportFacts.load()                     # 6章のフォルダから読む。root="synthetic/x10" なども指定できる
+#   facts.totals("WHRegion")                          # ノック52: 支社ごとの Cost・Quantity・1個あたりのコスト
+#   facts.totals("FCID", start="2019-03-01")          # 期間を絞る
+#   facts.append(new_transactions)                    # 輸送実績を追加する
+#   join_data = facts.join_data()                     # ノック51の結合結果が必要なとき
+
+import numpy as np
+import pandas as pd
+
+from common.schema import read_options, read_table, table_path
+
+MEASURES = ("count", "Quantity", "Cost")
+
+
+class TransportFacts(object):
+    """工場・倉庫を番号にした輸送実績と、期間×ルートごとの集計
+
+    factories  : tbl_factory.csv(FCID が索引)
+    warehouses : tbl_warehouse.csv(WHID が索引)
+    cost       : rel_cost.csv(FCID・WHID・Cost の列)
+    freq       : 集計する期間の単位(to_period に渡す "D"・"W"・"M" など)
+    keep_rows  : append した行を join_data のために残すか
+    """
+
+    def __init__(self, factories, warehouses, cost, freq="D", keep_rows=False):
+        self.factories = factories
+        self.warehouses = warehouses
+        self.freq = freq
+        self.keep_rows = keep_rows
+        self.fc_ids = pd.Index(factories.index.astype(str), name="FCID")
+        self.wh_ids = pd.Index(warehouses.index.astype(str), name="WHID")
+        fc = self._codes(self.fc_ids, cost["FCID"], "FCID")
+        wh = self._codes(self.wh_ids, cost["WHID"], "WHID")
+        # 組み合わせのないところは NaN(ノック51の left 結合と同じ)
+        self.cost = np.full((len(self.fc_ids), len(self.wh_ids)), np.nan)
+        self.cost[fc, wh] = cost["Cost"].to_numpy(dtype=np.float64)
+        # [工場, 倉庫] → ルートの番号(-1 はまだ実績のない組)。rel_cost にない組も実績が来たら追加する
+        self.route = np.full((len(self.fc_ids), len(self.wh_ids)), -1, dtype=np.int64)
+        self.route_fc = np.zeros(0, dtype=np.int64)
+        self.route_wh = np.zeros(0, dtype=np.int64)
+        self._add_routes(fc, wh)
+        # 期間は追加した順に番号を付ける(period の通し番号 → 行)
+        self.bucket_ordinals = np.zeros(0, dtype=np.int64)
+        self._bucket_row = {}
+        self.sums = np.zeros((0, len(MEASURES), len(self.route_fc)))
+        self.n_rows = 0
+        self._chunks = []
+        self._sources = []
+        self._unkept = 0
+
+    @staticmethod
+    def _codes(ids, values, name):
+        codes = ids.get_indexer(pd.Index(values).astype(str))
+        if (codes < 0).any():
+            unknown = pd.Index(values)[codes < 0].unique()
+            raise KeyError("{} に登録されていない値です: {}".format(name, ", ".join(map(str, unknown[:5]))))
+        return codes
+
+    @classmethod
+    def load(cls, root=None, freq="D", chunksize=None, keep_rows=False):
+        """6章の4つの CSV を読む。chunksize を指定すると輸送実績を分割して足し込む"""
+        factories = read_table(6, "tbl_factory.csv", root=root)
+        warehouses = read_table(6, "tbl_warehouse.csv", root=root)
+        cost = read_table(6, "rel_cost.csv", root=root)
+        facts = cls(factories, warehouses, cost, freq, keep_rows)
+        path = table_path(6, "tbl_transaction.csv", root)
+        for chunk in facts._read(path, chunksize):
+            facts._append(chunk, path)
+        return facts
+
+    @staticmethod
+    def _read(path, chunksize=None):
+        if chunksize is None:
+            return [read_table(6, "tbl_transaction.csv", path=path)]
+        return pd.read_csv(path, chunksize=chunksize, **read_options(6, "tbl_transaction.csv", path=path))
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def buckets(self):
+        """足し込んだ期間(追加した順)"""
+        return pd.PeriodIndex(pd.arrays.PeriodArray(self.bucket_ordinals, dtype=pd.PeriodDtype(self.freq)),
+                              name="TransactionDate")
+
+    def _add_routes(self, fc, wh):
+        """まだ番号のない[工場, 倉庫]の組にルートの番号を付ける"""
+        new = self.route[fc, wh] < 0
+        if not new.any():
+            return
+        pairs = np.unique(np.asarray(fc)[new] * len(self.wh_ids) + np.asarray(wh)[new])
+        self.route.flat[pairs] = len(self.route_fc) + np.arange(len(pairs))
+        self.route_fc = np.concatenate([self.route_fc, pairs // len(self.wh_ids)])
+        self.route_wh = np.concatenate([self.route_wh, pairs % len(self.wh_ids)])
+
+    def _grow(self, n_buckets, n_routes):
+        """sums の領域が足りなければ倍々に広げる(使っているのは先頭の期間・ルートの分だけ)"""
+        rows, _, cols = self.sums.shape
+        if n_buckets <= rows and n_routes <= cols:
+            return
+        shape = (max(n_buckets, 2 * rows if n_buckets > rows else rows, 16), len(MEASURES),
+                 max(n_routes, 2 * cols if n_routes > cols else cols))
+        sums = np.zeros(shape)
+        sums[:rows, :, :cols] = self.sums
+        self.sums = sums
+
+    def append(self, trans):
+        """輸送実績(TransactionDate・ToFC・FromWH・Quantity の列)を足し込む"""
+        return self._append(trans, None)
+
+    def _append(self, trans, source):
+        fc = self._codes(self.fc_ids, trans["ToFC"], "ToFC")
+        wh = self._codes(self.wh_ids, trans["FromWH"], "FromWH")
+        dates = pd.to_datetime(trans["TransactionDate"])
+        quantity = trans["Quantity"].to_numpy(dtype=np.int64)
+        cost = self.cost[fc, wh]
+        ordinals = pd.PeriodIndex(dates.dt.to_period(self.freq)).asi8
+        self._add_routes(fc, wh)
+        route = self.route[fc, wh]
+        # このバッチに出てくる期間にだけ行の番号を付ける
+        values, inverse = np.unique(ordinals, return_inverse=True)
+        new = [v for v in values.tolist() if v not in self._bucket_row]
+        if new:
+            for ordinal in new:
+                self._bucket_row[ordinal] = len(self._bucket_row)
+            self.bucket_ordinals = np.concatenate([self.bucket_ordinals, np.array(new, dtype=np.int64)])
+        bucket = np.array([self._bucket_row[v] for v in values.tolist()], dtype=np.int64)[inverse.ravel()]
+        self._grow(len(self._bucket_row), len(self.route_fc))
+        # バッチに出てくる[期間, ルート]の組だけを数えて、その所に足し込む
+        cells, where = np.unique(bucket * len(self.route_fc) + route, return_inverse=True)
+        where = where.ravel()
+        rows, cols = cells // len(self.route_fc), cells % len(self.route_fc)
+        for i, weights in enumerate((None, quantity, np.nan_to_num(cost))):
+            self.sums[rows, i, cols] += np.bincount(where, weights=weights, minlength=len(cells))
+        self.n_rows += len(quantity)
+        if self.keep_rows:
+            self._chunks.append({"TransactionDate": dates.to_numpy(), "fc": fc.astype(np.int32),
+                                 "wh": wh.astype(np.int32), "Quantity": quantity})
+        elif source is None:
+            self._unkept += len(quantity)
+        elif source not in self._sources:
+            self._sources.append(source)
+        return self
+
+    def _labels(self, by):
+        """by の列について、工場ごと・倉庫ごとのラベルの配列と、どちらの軸のものか"""
+        if by == "FCID":
+            return 1, self.fc_ids
+        if by == "WHID":
+            return 2, self.wh_ids
+        if by in self.factories:
+            return 1, pd.Index(self.factories[by].astype(str).to_numpy(), name=by)
+        if by in self.warehouses:
+            return 2, pd.Index(self.warehouses[by].astype(str).to_numpy(), name=by)
+        raise KeyError("集計に使えない列です: " + by)
+
+    def totals(self, by="WHRegion", start=None, end=None):
+        """by(列名か列名のリスト。"TransactionDate" は期間)ごとの件数・Quantity・Cost と1個あたりの Cost
+
+        start・end で期間を絞る(両端を含む)。Cost は輸送実績ごとのコスト(万円)の合計。
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        buckets = self.buckets
+        keep = np.ones(len(buckets), dtype=bool)
+        if start is not None:
+            keep &= buckets.end_time >= pd.Timestamp(start)
+        if end is not None:
+            keep &= buckets.start_time <= pd.Timestamp(end)
+        n_routes = len(self.route_fc)
+        sums = self.sums[:len(buckets), :, :n_routes][keep]
+        if "TransactionDate" not in by:
+            sums = sums.sum(axis=0, keepdims=True)
+        # 期間×ルートの小さな表にしてから by でまとめる
+        n_bucket = sums.shape[0]
+        table = pd.DataFrame({name: sums[:, i].ravel() for i, name in enumerate(MEASURES)})
+        for name in by:
+            if name == "TransactionDate":
+                table[name] = np.repeat(buckets[keep], n_routes)
+                continue
+            axis, labels = self._labels(name)
+            codes = self.route_fc if axis == 1 else self.route_wh
+            table[name] = np.tile(labels.to_numpy()[codes], n_bucket)
+        result = table.loc[table["count"] > 0].groupby(by, sort=True)[list(MEASURES)].sum()
+        result["count"] = result["count"].astype(np.int64)
+        result["Quantity"] = result["Quantity"].astype(np.int64)
+        result["unit_cost"] = result["Cost"] / result["Quantity"]
+        return result
+
+    def join_data(self):
+        """ノック51の join_data と同じ列の表を、結合ではなく配列を番号で引いて作る
+
+        keep_rows=False のときは、load したファイルを読み直して作る。
+        """
+        if self._unkept:
+            raise ValueError("keep_rows=False で append した {} 行は残していません".format(self._unkept))
+        chunks = list(self._chunks)
+        for path in self._sources:
+            trans = self._read(path)[0]
+            chunks.append({"TransactionDate": pd.to_datetime(trans["TransactionDate"]).to_numpy(),
+                           "fc": self._codes(self.fc_ids, trans["ToFC"], "ToFC").astype(np.int32),
+                           "wh": self._codes(self.wh_ids, trans["FromWH"], "FromWH").astype(np.int32),
+                           "Quantity": trans["Quantity"].to_numpy(dtype=np.int64)})
+        if not chunks:
+            chunk = {"TransactionDate": np.empty(0, "datetime64[ns]"), "fc": np.empty(0, np.int32),
+                     "wh": np.empty(0, np.int32), "Quantity": np.empty(0, np.int64)}
+        else:
+            chunk = {name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]}
+        fc, wh = chunk["fc"], chunk["wh"]
+
+        def lookup(frame, column, codes):
+            values = frame[column]
+            if values.dtype.kind in "iuf":
+                return values.to_numpy()[codes]
+            labels = pd.Categorical(values.astype(str))
+            return pd.Categorical.from_codes(labels.codes[codes], labels.categories)
+
+        return pd.DataFrame({
+            "TransactionDate": chunk["TransactionDate"], "Quantity": chunk["Quantity"],
+            "Cost": self.cost[fc, wh],
+            "ToFC": pd.Categorical.from_codes(fc, self.fc_ids), "FCName": lookup(self.factories, "FCName", fc),
+            "FCDemand": lookup(self.factories, "FCDemand", fc),
+            "FromWH": pd.Categorical.from_codes(wh, self.wh_ids), "WHName": lookup(self.warehouses, "WHName", wh),
+            "WHSupply": lookup(self.warehouses, "WHSupply", wh),
+            "WHRegion": lookup(self.warehouses, "WHRegion", wh),
+        })